@@ -23,7 +23,7 @@ def autodiscover():
     from importlib import import_module
     from django.apps import apps
     from django.utils.module_loading import module_has_submodule
-    from appsearch.registry import search  # noqa: F401
+    from appsearch.registry import search
 
     for config in apps.get_app_configs():
         if module_has_submodule(config.module, "search"):
@@ -36,3 +36,8 @@ def autodiscover():
                 raise
             except Exception:
                 raise ImportError("Loading {}.search module failed".format(config.name))
+
+    # Rebuild the registry snapshot if the registrations found it missing or stale
+    from appsearch.snapshot import refresh_snapshot
+
+    refresh_snapshot(search)
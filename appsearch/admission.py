@@ -0,0 +1,115 @@
+"""admission.py: Bounded concurrency for running searches"""
+
+import logging
+
+from django.core.cache import caches
+
+
+log = logging.getLogger(__name__)
+
+
+class SearchBusy(Exception):
+    """Raised when a search can't be admitted because its in-flight limits are reached."""
+
+
+class CacheSemaphore(object):
+    """
+    Counts the slots held under a cache ``key``, refusing to go beyond ``limit``.
+
+    The count lives in a Django cache so that it can be shared between processes (with a shared
+    backend) or kept local (with the local-memory backend).  Every acquisition pushes its expiry
+    back to ``timeout`` seconds, so the count only expires once no slot has been taken for that
+    long, which returns the slots leaked by a crashed process.  ``timeout`` should exceed the
+    longest search.
+
+    """
+
+    def __init__(self, key, limit, timeout=300, cache_alias="default"):
+        self.key = key
+        self.limit = limit
+        self.timeout = timeout
+        self.cache = caches[cache_alias]
+
+    def acquire(self, slots=1):
+        """Takes ``slots`` (at most ``limit``), returning ``False`` if they aren't available."""
+
+        slots = min(slots, self.limit)
+        self.cache.add(self.key, 0, self.timeout)
+        try:
+            value = self.cache.incr(self.key, slots)
+        except ValueError:
+            # The count expired between the add and the increment
+            self.cache.add(self.key, 0, self.timeout)
+            value = self.cache.incr(self.key, slots)
+
+        if value > self.limit:
+            self.release(slots)
+            return False
+        # ``incr()`` keeps the expiry set by ``add()``, which would drop the count of searches
+        # still running every ``timeout`` seconds under steady load
+        self.cache.touch(self.key, self.timeout)
+        return True
+
+    def release(self, slots=1):
+        slots = min(slots, self.limit)
+        try:
+            value = self.cache.decr(self.key, slots)
+        except ValueError:
+            # Already expired
+            return
+        if value < 0:
+            # The count expired and was started over while these slots were held
+            self.cache.incr(self.key, -value)
+
+
+class Admission(object):
+    """
+    The slots taken from several semaphores for one search.  Used as a context manager, or with
+    ``wrap()`` to hold the slots while a response is streamed.
+
+    """
+
+    def __init__(self, semaphores, slots):
+        self.semaphores = semaphores
+        self.slots = slots
+        self.acquired = []
+
+    def acquire(self):
+        """Takes the slots from every semaphore or, failing that, none of them."""
+
+        for semaphore in self.semaphores:
+            if not semaphore.acquire(self.slots):
+                self.release()
+                log.info("Refused a search of %d slots at %r", self.slots, semaphore.key)
+                raise SearchBusy(semaphore.key)
+            self.acquired.append(semaphore)
+        return self
+
+    def release(self):
+        while self.acquired:
+            self.acquired.pop().release(self.slots)
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+    def wrap(self, iterable):
+        """Returns an iterable over ``iterable`` that releases the slots when done or closed."""
+        return ReleasingIterable(iterable, self)
+
+
+class ReleasingIterable(object):
+    def __init__(self, iterable, admission):
+        self.iterable = iterable
+        self.admission = admission
+
+    def __iter__(self):
+        try:
+            yield from self.iterable
+        finally:
+            self.admission.release()
+
+    def close(self):
+        self.admission.release()
@@ -0,0 +1,6 @@
+from django.apps import AppConfig
+
+
+class AppsearchConfig(AppConfig):
+    name = "appsearch"
+    default_auto_field = "django.db.models.BigAutoField"
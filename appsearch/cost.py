@@ -0,0 +1,163 @@
+"""cost.py: Search cost heuristics"""
+
+import json
+import logging
+
+from django.db import connections
+from django.db.models.constants import LOOKUP_SEP
+
+from .engine import CONSTRAINT_TYPES, SearchSpecError, iter_leaf_constraints
+from .ormutils import get_indexed_field_names, get_many_valued_hops, resolve_orm_path
+
+
+log = logging.getLogger(__name__)
+
+# Extra cost of a "contains" lookup, whose leading wildcard scans every row, on an unindexed field
+LEADING_WILDCARD_COST = 2
+
+# Extra cost of each reverse or many-to-many relationship crossed, and when negated, which turns
+# it into a subquery over the whole related table
+JOIN_COST = 1
+NEGATED_JOIN_COST = 3
+
+# Extra cost of a negation, which can't narrow an index scan
+NEGATION_COST = 1
+
+# Extra cost of each related path in an OR, which keeps the database from joining selectively
+OR_JOIN_COST = 2
+
+# Operators of a constraint that can narrow a search through an index
+NARROWING_OPERATORS = ("exact", "iexact", "in", "range", "gt", "lt")
+
+WARNING_MESSAGE = "This search may be slow to run."
+NARROWING_MESSAGE = (
+    "This search is too broad to run as it is.  Add an 'equal' or 'between' constraint on an "
+    "indexed field to narrow it."
+)
+REJECTION_MESSAGE = "This search is too expensive to run.  Remove or narrow some constraints."
+
+
+def get_constraint_cost(configuration, constraint):
+    """
+    Returns the estimated cost of one cleaned constraint: one unit, plus the costs above for a
+    leading-wildcard "contains" on an unindexed field, a negation, the many-valued relationships
+    crossed by each of the field's ORM paths, and related paths fanned out by an OR.
+
+    Sibling paths of a compound field, which end on the same related row, are searched in one
+    pass (see ``appsearch.engine.get_compound_query()``), so their relationship is only counted
+    once.
+
+    """
+
+    type, field, operator, _ = constraint
+    negative = operator.startswith("!")
+    lookup = operator.lstrip("!")
+    ored = type is CONSTRAINT_TYPES["or"] or len(field) > 1
+    concatenated = field in configuration._concatenated_fields
+
+    # Dictionary fields are answered by an ``__in`` lookup on their matching values instead
+    dictionary = field in configuration._value_dictionary_fields
+    wildcard = lookup in ("icontains", "contains") and not dictionary
+    single_pass = concatenated or not (negative or lookup in ("isnull", "in"))
+
+    cost = 1
+    if negative:
+        cost += NEGATION_COST
+    prefixes = set()
+    for path in field:
+        if wildcard and not is_indexed(configuration.model, path):
+            if not (concatenated and prefixes):
+                cost += LEADING_WILDCARD_COST
+        prefix = path.rpartition(LOOKUP_SEP)[0]
+        if prefix in prefixes and single_pass:
+            continue
+        prefixes.add(prefix)
+        hops = get_many_valued_hops(configuration.model, path)
+        cost += hops * (NEGATED_JOIN_COST if negative else JOIN_COST)
+        if ored and LOOKUP_SEP in path:
+            cost += OR_JOIN_COST
+    return cost
+
+
+def estimate_cost(configuration, constraints):
+    """Returns the estimated cost of a search on ``configuration`` with cleaned ``constraints``."""
+    return sum(
+        get_constraint_cost(configuration, constraint)
+        for constraint in iter_leaf_constraints(constraints)
+    )
+
+
+def is_indexed(model, path):
+    """Indicates if the field at the end of ``path`` leads an index on its table."""
+
+    field = resolve_orm_path(model, path)
+    if not getattr(field, "concrete", False):
+        return False
+    return field.name in get_indexed_field_names(field.model)
+
+
+def is_narrowed(configuration, constraints):
+    """
+    Indicates if ``constraints`` include an indexed, selective constraint that applies to the whole
+    search, i.e., one that isn't followed by an OR in the left-to-right fold.
+
+    """
+
+    for i, (_, field, operator, _) in enumerate(constraints):
+        if any(type is CONSTRAINT_TYPES["or"] for type, _, _, _ in constraints[i + 1 :]):
+            continue
+        if len(field) == 1 and operator in NARROWING_OPERATORS:
+            if is_indexed(configuration.model, field[0]):
+                return True
+    return False
+
+
+def get_explain_cost(queryset):
+    """
+    Returns the database's estimated total cost for ``queryset`` from its EXPLAIN output, or
+    ``None`` for databases without a cost estimate.
+
+    """
+
+    vendor = connections[queryset.db].vendor
+    try:
+        if vendor == "postgresql":
+            plan = json.loads(queryset.explain(format="json"))
+            return float(plan[0]["Plan"]["Total Cost"])
+        elif vendor == "mysql":
+            plan = json.loads(queryset.explain(format="json"))
+            return float(plan["query_block"]["cost_info"]["query_cost"])
+    except (KeyError, IndexError, TypeError, ValueError):
+        log.warning("Unable to read the EXPLAIN cost for %s", queryset.model.__name__)
+    return None
+
+
+def check_cost(configuration, constraints, queryset=None):
+    """
+    Checks the cleaned ``constraints`` against ``configuration``'s cost thresholds, returning a list
+    of warning messages or raising ``SearchSpecError`` when the search is rejected or must be
+    narrowed.  When ``queryset`` is given and ``max_explain_cost`` is set, the database's own
+    estimate is checked as well.
+
+    """
+
+    cost = estimate_cost(configuration, constraints)
+
+    rejection = configuration.cost_rejection_threshold
+    if rejection is not None and cost > rejection:
+        raise SearchSpecError(REJECTION_MESSAGE)
+
+    narrowing = configuration.cost_narrowing_threshold
+    if narrowing is not None and cost > narrowing and not is_narrowed(configuration, constraints):
+        raise SearchSpecError(NARROWING_MESSAGE)
+
+    if queryset is not None and configuration.max_explain_cost is not None:
+        explain_cost = get_explain_cost(queryset)
+        if explain_cost is not None and explain_cost > configuration.max_explain_cost:
+            raise SearchSpecError(REJECTION_MESSAGE)
+
+    warnings = []
+    warning = configuration.cost_warning_threshold
+    if warning is not None and cost > warning:
+        warnings.append(WARNING_MESSAGE)
+    return warnings
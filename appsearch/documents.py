@@ -0,0 +1,174 @@
+"""documents.py: Denormalized search documents for related search paths"""
+
+import logging
+from collections import OrderedDict
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
+from django.db.models.constants import LOOKUP_SEP
+from django.db.models.query import Q
+
+from .ormutils import get_many_valued_hops, get_model_at_related_field
+
+
+log = logging.getLogger(__name__)
+
+# Joins the values of a many-valued path in ``SearchDocument.value``
+VALUE_SEPARATOR = "\n"
+
+# Operators answered from ``SearchDocument.value``, for any path
+CONTAINS_OPERATORS = ("icontains", "!icontains")
+
+# Operators answered from ``SearchDocument.first_value``, only for paths without many-valued hops
+EXACT_OPERATORS = ("iexact", "!iexact")
+
+# Stored length of ``SearchDocument.first_value``, which is indexed; longer values are cut, and
+# exact terms that long are answered by the regular query instead
+FIRST_VALUE_LENGTH = 255
+
+
+def get_document_paths(configuration):
+    """
+    Returns an ``OrderedDict`` mapping the related text search paths of ``configuration`` to
+    whether they cross a many-valued (reverse foreign key or many-to-many) relationship.
+
+    """
+
+    paths = OrderedDict()
+    for orm_paths in configuration._fields:
+        if configuration.get_field_classification(orm_paths) != "text":
+            continue
+        for path in orm_paths:
+            bits = path.split(LOOKUP_SEP)
+            if len(bits) == 1 or path in paths:
+                continue
+
+            paths[path] = get_many_valued_hops(configuration.model, path) > 0
+    return paths
+
+
+def get_document_query(configuration, path, operator, term):
+    """
+    Returns the ``Q`` answering a constraint on ``path`` from the search documents, or ``None``
+    when the path isn't denormalized or the operator can't be answered from a document.
+
+    """
+
+    many_valued = configuration.get_document_paths().get(path)
+    if many_valued is None or not isinstance(term, str):
+        return None
+
+    if operator in CONTAINS_OPERATORS:
+        lookup = {"value__contains": term.lower()}
+    elif operator in EXACT_OPERATORS and not many_valued:
+        if len(term) >= FIRST_VALUE_LENGTH:
+            return None
+        lookup = {"first_value": term.lower()}
+    else:
+        return None
+
+    from .models import SearchDocument
+
+    documents = SearchDocument.objects.filter(
+        content_type=ContentType.objects.get_for_model(configuration.model), path=path, **lookup
+    )
+    query = Q(pk__in=documents.values("object_id"))
+    if operator.startswith("!"):
+        query = ~query
+    return query
+
+
+def get_affected_pks(configuration, instance):
+    """
+    Returns the set of primary keys of ``configuration.model`` objects whose documents read
+    values from ``instance``, an object of the model itself or of a model along a document path.
+
+    """
+
+    if isinstance(instance, configuration.model):
+        return {instance.pk}
+
+    queries = []
+    for path in configuration.get_document_paths():
+        bits = path.split(LOOKUP_SEP)[:-1]
+        model = configuration.model
+        for i, bit in enumerate(bits):
+            model = get_model_at_related_field(model, bit)
+            if isinstance(instance, model):
+                queries.append(Q(**{LOOKUP_SEP.join(bits[: i + 1] + ["pk"]): instance.pk}))
+
+    if not queries:
+        return set()
+    query = queries[0]
+    for q in queries[1:]:
+        query |= q
+    manager = configuration.model._default_manager
+    return set(manager.filter(query).values_list("pk", flat=True))
+
+
+def update_search_documents(configuration, pks):
+    """Replaces the search documents of the ``configuration.model`` objects in ``pks``."""
+
+    from .models import SearchDocument
+
+    pks = list(pks)
+    if not pks:
+        return 0
+
+    content_type = ContentType.objects.get_for_model(configuration.model)
+    manager = configuration.model._default_manager
+
+    documents = []
+    for path in configuration.get_document_paths():
+        # Read the related values in related row order, so the first one is stable
+        related_pk_path = LOOKUP_SEP.join(path.split(LOOKUP_SEP)[:-1] + ["pk"])
+        rows = (
+            manager.filter(pk__in=pks, **{path + "__isnull": False})
+            .order_by("pk", related_pk_path)
+            .values_list("pk", path)
+        )
+        values = OrderedDict()
+        for pk, value in rows:
+            values.setdefault(pk, []).append(str(value).lower())
+        for pk, object_values in values.items():
+            documents.append(
+                SearchDocument(
+                    content_type=content_type,
+                    object_id=pk,
+                    path=path,
+                    value=VALUE_SEPARATOR.join(object_values),
+                    first_value=object_values[0][:FIRST_VALUE_LENGTH],
+                )
+            )
+
+    with transaction.atomic():
+        SearchDocument.objects.filter(content_type=content_type, object_id__in=pks).delete()
+        SearchDocument.objects.bulk_create(documents)
+    return len(documents)
+
+
+def delete_search_documents(configuration, pks):
+    """Removes the search documents of the ``configuration.model`` objects in ``pks``."""
+
+    from .models import SearchDocument
+
+    content_type = ContentType.objects.get_for_model(configuration.model)
+    SearchDocument.objects.filter(content_type=content_type, object_id__in=list(pks)).delete()
+
+
+def rebuild_search_documents(configuration, batch_size=1000):
+    """Rebuilds every search document of ``configuration.model``, returning how many were made."""
+
+    from .models import SearchDocument
+
+    content_type = ContentType.objects.get_for_model(configuration.model)
+    pks = configuration.model._default_manager.order_by("pk").values_list("pk", flat=True)
+
+    count = 0
+    with transaction.atomic():
+        SearchDocument.objects.filter(content_type=content_type).delete()
+        pks = list(pks)
+        for start in range(0, len(pks), batch_size):
+            count += update_search_documents(configuration, pks[start : start + batch_size])
+    log.debug("Rebuilt %d search documents for %s", count, configuration.model._meta.label)
+    return count
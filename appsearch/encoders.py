@@ -0,0 +1,19 @@
+"""encoders.py: JSON encoding of stored search values"""
+
+import datetime
+
+from django.core.serializers.json import DjangoJSONEncoder
+
+
+class PreciseJSONEncoder(DjangoJSONEncoder):
+    """
+    ``DjangoJSONEncoder`` that keeps the microseconds of datetimes and times, which it otherwise
+    truncates to milliseconds.  Values compared against the database again, such as cursor sort
+    values and watermarks, must round-trip exactly, or a ``__gt`` filter matches the same row again.
+
+    """
+
+    def default(self, o):
+        if isinstance(o, (datetime.datetime, datetime.time)):
+            return o.isoformat()
+        return super(PreciseJSONEncoder, self).default(o)
@@ -0,0 +1,515 @@
+"""engine.py: Form-free search engine underneath the appsearch forms"""
+
+import logging
+import operator
+from collections import OrderedDict
+from functools import reduce
+
+from django.db.models import CharField, Count, F, Value
+from django.db.models.constants import LOOKUP_SEP
+from django.db.models.functions import Concat, Lower
+from django.db.models.lookups import IContains, IExact, In
+from django.db.models.query import Q
+
+from .documents import get_document_query
+from .ormutils import get_many_valued_hops
+from .registry import search
+
+
+log = logging.getLogger(__name__)
+
+CONSTRAINT_TYPES = {
+    "and": operator.and_,
+    "or": operator.or_,
+}
+
+# Operator of a cleaned constraint holding a parenthesized group of constraints as its term
+GROUP = "()"
+
+# Lookups of a concatenated compound field (see ``ModelSearch.concatenated_fields``)
+CONCATENATED_LOOKUPS = {"icontains": IContains, "iexact": IExact}
+
+# Lookups of a ``ModelSearch.value_dictionary_fields`` entry answered from its dictionary
+DICTIONARY_LOOKUPS = ("icontains", "iexact")
+
+# Lookups whose varying terms can be merged into a single ``__in`` query by ``bulk_search()``.
+BATCHABLE_OPERATORS = ("exact", "iexact")
+BATCHABLE_CLASSIFICATIONS = ("text", "number", "boolean", "choices")
+
+
+class SearchSpecError(ValueError):
+    """Raised when a constraint spec can't be validated against a ``ModelSearch``."""
+
+
+class SearchEngine(object):
+    """
+    Validates constraint specs against a ``ModelSearch`` configuration and builds the ``Q`` query
+    they describe, without constructing any of the appsearch forms.
+
+    A constraint spec is a sequence of ``(type, field, operator, term)`` or ``(type, field,
+    operator, term, end_term)`` tuples.  ``type`` is "and" or "or" (ignored on the first
+    constraint), ``field`` is either the field hash sent to the frontend or the ORM path (or tuple
+    of paths) from the configuration's ``search_fields``, and ``operator`` is either the ORM query
+    type (e.g., "icontains" or "!iexact") or its UI label (e.g., "contains").
+
+    A ``(type, [constraint, ...])`` item is a parenthesized group of constraints, combined with
+    the preceding ones as a whole.
+
+    Field and operator resolution is cached on the engine instance, so a single engine should be
+    reused for many specs against the same configuration.
+
+    """
+
+    def __init__(self, configuration):
+        self.configuration = configuration
+        self._plans = {}
+
+    def resolve_field(self, field):
+        """Returns the configuration's ORM path tuple for the hash or path in ``field``."""
+
+        if isinstance(field, str):
+            if field in self.configuration._field_hashes:
+                return self.configuration._field_hashes[field]
+            field = (field,)
+        field = tuple(field)
+        if field not in self.configuration._fields:
+            raise SearchSpecError("Unknown search field {!r}".format(field))
+        return field
+
+    def resolve_operator(self, field, operator):
+        """Returns the ORM query type for ``operator``, which may be given as its UI label."""
+
+        lookups = self.configuration.get_operator_lookups(field=field)
+        if operator in lookups:
+            return lookups[operator]
+        if operator in lookups.values():
+            return operator
+        raise SearchSpecError(
+            "Operator {!r} is not valid for {}".format(operator, self.configuration._fields[field])
+        )
+
+    def get_plan(self, field, operator):
+        """Returns the cached 2-tuple of resolved (field, operator) for a constraint."""
+
+        key = (field if isinstance(field, str) else tuple(field), operator)
+        try:
+            return self._plans[key]
+        except KeyError:
+            pass
+        field = self.resolve_field(field)
+        plan = self._plans[key] = (field, self.resolve_operator(field, operator))
+        return plan
+
+    def clean_constraints(self, constraints):
+        """
+        Validates the sequence of ``constraints``, returning a list of 4-tuples of
+        (type_operator, orm_path_tuple, orm_operator, term) ready for ``build_query()``.  Groups
+        are cleaned to ``(type_operator, (), GROUP, [cleaned constraints])``.
+
+        """
+
+        if not constraints:
+            raise SearchSpecError("At least one constraint is required.")
+        limit = self.configuration.max_constraints
+        if limit is not None and count_constraints(constraints) > limit:
+            raise SearchSpecError("Searches are limited to {} constraints.".format(limit))
+
+        cleaned = []
+        for constraint in constraints:
+            group = get_group_constraints(constraint)
+            if group is not None:
+                type = constraint[0]
+                if not callable(type):
+                    type = CONSTRAINT_TYPES.get(type)
+                if type is None:
+                    raise SearchSpecError("Unknown constraint type {!r}".format(constraint[0]))
+                cleaned.append((type, (), GROUP, self.clean_constraints(group)))
+                continue
+
+            try:
+                type, field, operator, term = constraint[:4]
+            except (TypeError, ValueError):
+                raise SearchSpecError("Malformed constraint {!r}".format(constraint))
+            end_term = constraint[4] if len(constraint) > 4 else None
+            if not isinstance(operator, str):
+                raise SearchSpecError("Unknown operator {!r}".format(operator))
+
+            if not callable(type):
+                try:
+                    type = CONSTRAINT_TYPES[type]
+                except KeyError:
+                    raise SearchSpecError("Unknown constraint type {!r}".format(type))
+
+            field, operator = self.get_plan(field, operator)
+            term = clean_term(self.configuration, field, operator, term)
+            if operator == "range":
+                term = [term, clean_end_term(self.configuration, field, end_term)]
+            cleaned.append((type, field, operator, term))
+        return cleaned
+
+    def build_query(self, constraints, optimize=True):
+        """
+        Returns the ``Q`` instance for the cleaned ``constraints``.  Constraints are folded left
+        to right (with groups folded as a whole), and the ORM paths of a compound field are ORed
+        together.  Paths denormalized into search documents are looked up there instead of through
+        their joins.
+
+        The folded tree is simplified by ``appsearch.optimizer.optimize()`` before the ``Q`` is
+        built, unless ``optimize`` is False.
+
+        """
+
+        from .optimizer import compile_tree, get_tree, optimize as optimize_tree
+
+        tree = get_tree(constraints)
+        if optimize:
+            tree = optimize_tree(self.configuration, tree)
+        return compile_tree(self.configuration, tree)
+
+    def get_queryset(self, constraints, request=None, user=None):
+        """
+        Validates the raw ``constraints`` and returns the configuration's base queryset filtered
+        by them.
+
+        """
+
+        query = self.build_query(self.clean_constraints(constraints))
+        return self.configuration.get_queryset(request, user).filter(query).distinct()
+
+
+def get_group_constraints(constraint):
+    """Returns the constraints of a group spec item, or ``None`` for a plain constraint."""
+
+    if not isinstance(constraint, (list, tuple)):
+        return None
+    if len(constraint) == 2 and isinstance(constraint[1], (list, tuple)):
+        return constraint[1]
+    if len(constraint) == 4 and constraint[2] == GROUP:
+        return constraint[3]
+    return None
+
+
+def count_constraints(constraints):
+    """Returns the number of plain constraints in a search spec, descending into groups."""
+
+    count = 0
+    for constraint in constraints:
+        group = get_group_constraints(constraint)
+        count += 1 if group is None else count_constraints(group)
+    return count
+
+
+def iter_leaf_constraints(constraints):
+    """Yields the cleaned constraints, descending into groups."""
+
+    for constraint in constraints:
+        if constraint[2] == GROUP:
+            yield from iter_leaf_constraints(constraint[3])
+        else:
+            yield constraint
+
+
+def get_field_query(field, operator, term, configuration=None):
+    """
+    Returns the ``Q`` for one constraint, ORing together the paths of a compound field.  When
+    ``configuration`` is given, its denormalized paths are answered from search documents, and
+    compound fields are compiled by ``get_compound_query()`` where possible.
+
+    """
+
+    if configuration is not None and len(field) > 1 and not configuration.denormalize:
+        query = get_compound_query(configuration, field, operator, term)
+        if query is not None:
+            return query
+
+    if configuration is not None and field in configuration._value_dictionary_fields:
+        query = get_dictionary_query(configuration, field, operator, term)
+        if query is not None:
+            return query
+
+    query = None
+    for path in field:
+        q = None
+        if configuration is not None and configuration.denormalize:
+            q = get_document_query(configuration, path, operator, term)
+        if q is None and operator == "in" and configuration is not None:
+            ignore_case = configuration.get_field_classification(field) == "text"
+            q = get_in_query(path, term, configuration.in_chunk_size, ignore_case)
+        if q is None:
+            q = get_path_query(path, operator, term)
+
+        if query is None:
+            query = q
+        else:
+            query |= q
+    return query
+
+
+def get_compound_query(configuration, field, operator, term):
+    """
+    Returns the ``Q`` for a compound ``field`` that reads each related row once, or ``None`` if
+    the paths are better ORed one by one.
+
+    A field listed in the configuration's ``concatenated_fields`` is matched against its paths'
+    values joined into a single column by ``Concat``.  Otherwise, sibling paths that cross the
+    same many-valued relationship are ORed inside one ``pk__in`` subquery, so that the search
+    joins the relationship once and the outer query needs no join at all.  Negated and "isnull"
+    lookups are left alone, since ORing their negations doesn't describe a single related row.
+
+    """
+
+    model = configuration.model
+    lookup = operator.lstrip("!")
+
+    if field in configuration._concatenated_fields and lookup in CONCATENATED_LOOKUPS:
+        return get_concatenated_query(configuration, field, operator, term)
+
+    if operator.startswith("!") or lookup in ("isnull", "in"):
+        return None
+
+    siblings = OrderedDict()
+    for path in field:
+        siblings.setdefault(path.rpartition(LOOKUP_SEP)[0], []).append(path)
+
+    if not any(
+        len(paths) > 1 and get_many_valued_hops(model, paths[0]) for paths in siblings.values()
+    ):
+        return None  # No relationship is joined more than once by ORing the paths
+
+    query = None
+    for paths in siblings.values():
+        q = get_field_query(paths, operator, term)
+        if len(paths) > 1 and get_many_valued_hops(model, paths[0]):
+            q = Q(pk__in=model._base_manager.filter(q).values("pk"))
+        query = q if query is None else query | q
+    return query
+
+
+def get_dictionary_query(configuration, field, operator, term):
+    """
+    Returns the ``Q`` for a "contains" or "equal" constraint on a field of the configuration's
+    ``value_dictionary_fields``, as an ``__in`` lookup on the values of its dictionary that match
+    ``term``, or ``None`` if the dictionary can't answer it.
+
+    """
+
+    lookup = operator.lstrip("!")
+    if lookup not in DICTIONARY_LOOKUPS or not isinstance(term, str):
+        return None
+    values = configuration.get_value_dictionary(field)
+    if values is None:
+        return None
+
+    term = term.lower()
+    if lookup == "icontains":
+        matches = [value for value in values if value is not None and term in value.lower()]
+    else:
+        matches = [value for value in values if value is not None and term == value.lower()]
+
+    q = Q(**{LOOKUP_SEP.join((field[0], "in")): matches})
+    if len(matches) > configuration.in_chunk_size:
+        q = get_in_query(field[0], matches, configuration.in_chunk_size)
+    if operator.startswith("!"):
+        q = ~q
+    return q
+
+
+def get_concatenated_query(configuration, field, operator, term):
+    """
+    Returns the ``Q`` matching ``term`` against the values of ``field``'s paths joined by the
+    configuration's ``concatenation_separator``, e.g., "first_name last_name".
+
+    """
+
+    negative = operator.startswith("!")
+    parts = []
+    for path in field:
+        if parts:
+            parts.append(Value(configuration.concatenation_separator))
+        parts.append(F(path))
+    expression = Concat(*parts, output_field=CharField())
+    q = Q(CONCATENATED_LOOKUPS[operator.lstrip("!")](expression, term))
+
+    model = configuration.model
+    if get_many_valued_hops(model, field[0]):
+        q = Q(pk__in=model._base_manager.filter(q).values("pk"))
+    if negative:
+        q = ~q
+    return q
+
+
+def get_path_query(path, operator, term):
+    """Returns the ``Q`` for one ORM path, handling the "!" negation prefix and "isnull"."""
+
+    value = term
+
+    # Prep an inverted lookup
+    lookup = operator
+    negative = lookup.startswith("!")
+    if negative:
+        lookup = lookup[1:]
+
+    if lookup == "isnull":
+        value = not negative
+        negative = False
+
+    q = Q(**{LOOKUP_SEP.join((path, lookup)): value})
+    if negative:
+        q = ~q
+    return q
+
+
+def get_in_query(path, values, chunk_size, ignore_case=False):
+    """
+    Returns the ``Q`` matching any of ``values`` on ``path``, as one ``__in`` lookup per
+    ``chunk_size`` values so that long lists stay within the database's parameter limits.
+
+    With ``ignore_case``, the lowercased column is matched against the lowercased values instead,
+    like the "iexact" lookup of "= equal" on text fields.
+
+    """
+
+    if ignore_case:
+        values = list(OrderedDict.fromkeys(value.lower() for value in values))
+    chunks = [values[i : i + chunk_size] for i in range(0, len(values), chunk_size)]
+    if ignore_case:
+        return reduce(operator.or_, (Q(In(Lower(path), chunk)) for chunk in chunks))
+    lookup = LOOKUP_SEP.join((path, "in"))
+    return reduce(operator.or_, (Q(**{lookup: chunk}) for chunk in chunks))
+
+
+def clean_term(configuration, field, operator, term):
+    """
+    Normalizes ``term`` to what makes sense for ``operator`` on the configuration's ``field``,
+    through the field's cached ``appsearch.terms.TermCoercer``.
+
+    """
+
+    return configuration.get_term_coercer(field).clean(operator, term)
+
+
+def clean_end_term(configuration, field, term):
+    """Normalizes the second term of a "range" constraint."""
+    return configuration.get_term_coercer(field).clean_end(term)
+
+
+def bulk_search(model, specs, user, request=None, registry=search, count=False):
+    """
+    Runs many constraint ``specs`` against ``model`` in as few queries as possible, returning a list
+    parallel to ``specs`` of matching primary key lists (or of counts, when ``count`` is set).
+    Every spec gets its own list, even when identical specs were answered by one query.
+
+    The permission check and the base queryset are shared by every spec, as is the field and
+    operator resolution of the ``SearchEngine``.  Specs that only differ in the term of a single
+    ANDed "exact"/"iexact" constraint are run as one ``__in`` query and split back apart by value.
+    With ``count``, the queries only aggregate: a ``COUNT`` per spec, or one grouped by the
+    varying term for batched specs.
+
+    """
+
+    configuration = registry.get_configuration(model, user=user)
+    if configuration is None:
+        raise SearchSpecError("No searchable configuration for {!r}".format(model))
+
+    engine = configuration.get_engine()
+    cleaned_specs = [engine.clean_constraints(spec) for spec in specs]
+    queryset = configuration.get_queryset(request, user)
+
+    # Group the specs by everything but their terms
+    groups = OrderedDict()
+    for i, constraints in enumerate(cleaned_specs):
+        signature = tuple((type, field, operator) for type, field, operator, _ in constraints)
+        groups.setdefault(signature, []).append(i)
+
+    results = [None] * len(specs)
+    for indexes in groups.values():
+        constraints_list = [cleaned_specs[i] for i in indexes]
+        varying = [
+            position
+            for position in range(len(constraints_list[0]))
+            if any(c[position][3] != constraints_list[0][position][3] for c in constraints_list)
+        ]
+
+        if not varying:
+            result = _get_pks(queryset, engine.build_query(constraints_list[0]), count)
+            for i in indexes:
+                results[i] = result if count else list(result)
+        elif len(varying) == 1 and _is_batchable(configuration, constraints_list[0], varying[0]):
+            buckets = _get_batched_pks(
+                configuration, engine, queryset, constraints_list, varying[0], count
+            )
+            for i, result in zip(indexes, buckets):
+                results[i] = result
+        else:
+            for i, constraints in zip(indexes, constraints_list):
+                results[i] = _get_pks(queryset, engine.build_query(constraints), count)
+
+    return results
+
+
+def _get_pks(queryset, query, count=False):
+    queryset = queryset.filter(query)
+    if count:
+        return queryset.aggregate(count=Count("pk", distinct=True))["count"]
+    return list(queryset.values_list("pk", flat=True).distinct())
+
+
+def _is_batchable(configuration, constraints, position):
+    """Checks if the constraint at ``position`` can be merged into an ``__in`` lookup."""
+
+    _, field, operator, _ = constraints[position]
+    if len(field) != 1 or operator not in BATCHABLE_OPERATORS:
+        return False
+    if configuration.get_field_classification(field) not in BATCHABLE_CLASSIFICATIONS:
+        return False
+    # Only a pure conjunction lets the varying constraint be pulled out of the fold.
+    return all(type is CONSTRAINT_TYPES["and"] for type, _, _, _ in constraints[1:])
+
+
+def _get_batched_pks(configuration, engine, queryset, constraints_list, position, count=False):
+    """
+    Runs one query for all ``constraints_list`` entries, which differ only in the term at
+    ``position``, and returns their pk lists (or counts, when ``count`` is set) in order.
+
+    """
+
+    _, field, operator, _ = constraints_list[0][position]
+    path = field[0]
+    field_type = configuration.field_types[field]
+
+    def get_key(value):
+        value = field_type.to_python(value)
+        if operator == "iexact" and isinstance(value, str):
+            value = value.lower()
+        return value
+
+    keys = [get_key(constraints[position][3]) for constraints in constraints_list]
+
+    shared = constraints_list[0][:position] + constraints_list[0][position + 1 :]
+    if shared:
+        queryset = queryset.filter(engine.build_query(shared))
+
+    if operator == "iexact":
+        queryset = queryset.annotate(_bulk_key=Lower(path)).filter(_bulk_key__in=set(keys))
+        key_path = "_bulk_key"
+    else:
+        queryset = queryset.filter(**{LOOKUP_SEP.join((path, "in")): set(keys)})
+        key_path = path
+
+    if count:
+        counts = OrderedDict((key, 0) for key in keys)
+        rows = queryset.order_by().values_list(key_path).annotate(Count("pk", distinct=True))
+        for value, value_count in rows:
+            key = get_key(value)
+            if key in counts:
+                counts[key] += value_count
+        return [counts[key] for key in keys]
+
+    rows = queryset.values_list("pk", key_path)
+    buckets = OrderedDict((key, []) for key in keys)
+    for pk, value in rows.distinct():
+        bucket = buckets.get(get_key(value))
+        if bucket is not None:
+            bucket.append(pk)
+
+    return [list(buckets[key]) for key in keys]
@@ -1,14 +1,53 @@
 """forms.py: appsearch forms"""
 
-import operator
-
 from django import forms
 from django.contrib.contenttypes.models import ContentType
 from django.db.models.fields import BLANK_CHOICE_DASH
 from django.forms import ValidationError
-from django.forms.formsets import BaseFormSet
+from django.forms.formsets import TOTAL_FORM_COUNT, BaseFormSet
+
+from .engine import CONSTRAINT_TYPES, GROUP, SearchSpecError, clean_end_term, clean_term
+from .terms import (
+    LIST_OPERATORS,
+    check_list_size,
+    check_term_length,
+    check_upload_size,
+    split_list,
+)
+
+# Deepest parenthesized group a single constraint can open or close
+MAX_GROUP_DEPTH = 3
+
+
+def check_limits(configuration, data, files, prefix):
+    """
+    Checks the raw constraint formset ``data`` and ``files`` against the configuration's
+    ``max_constraints``, ``max_term_length`` and ``max_list_size``, raising ``SearchSpecError``
+    for the first limit a submission exceeds.  Only the management form count, the operator, the
+    terms and the sizes of uploaded values files are read, so oversized submissions are refused
+    before a form is built for each of their constraints or a file is read.
+
+    """
 
-import dateutil.parser
+    try:
+        total = int(data.get("{}-{}".format(prefix, TOTAL_FORM_COUNT)))
+    except (TypeError, ValueError):
+        return  # Reported by the management form
+    limit = configuration.max_constraints
+    if limit is not None and total > limit:
+        raise SearchSpecError("Searches are limited to {} constraints.".format(limit))
+
+    for i in range(total):
+        term = data.get("{}-{}-term".format(prefix, i)) or ""
+        lookups = configuration.get_operator_lookups(hash=data.get("{}-{}-field".format(prefix, i)))
+        if lookups.get(data.get("{}-{}-operator".format(prefix, i))) in LIST_OPERATORS:
+            check_list_size(configuration, split_list(term))
+        else:
+            check_term_length(configuration, term)
+        check_term_length(configuration, data.get("{}-{}-end_term".format(prefix, i)) or "")
+        upload = files.get("{}-{}-term_file".format(prefix, i)) if files else None
+        if upload:
+            check_upload_size(configuration, upload)
 
 
 class ModelSelectionForm(forms.Form):
@@ -56,6 +95,30 @@ class ModelSelectionForm(forms.Form):
         return self.get_selected_configuration().model
 
 
+class OperatorField(forms.ChoiceField):
+    """
+    Select of the UI labels of a field's operators, such as "= equal".  The frontend never sees
+    the ORM lookups, so the field validates a label against the ``lookups`` dictionary given by
+    ``ModelSearch.get_operator_lookups()`` and cleans it to its lookup, such as "iexact".
+
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(OperatorField, self).__init__(*args, **kwargs)
+        self.lookups = {}
+
+    def set_lookups(self, lookups):
+        self.lookups = lookups
+        self.choices = [(label, label) for label in lookups]
+
+    def valid_value(self, value):
+        return value in self.lookups
+
+    def clean(self, value):
+        value = super(OperatorField, self).clean(value)
+        return self.lookups.get(value, value)
+
+
 class ConstraintForm(forms.Form):
     """
     Using an additional constructor parameter ``configuration``, an instance of
@@ -75,11 +138,34 @@ class ConstraintForm(forms.Form):
     field = forms.ChoiceField(label="Filter by", choices=[])
 
     # Dynamically populated list of valid operators for the chosen ``field``
-    operator = forms.ChoiceField(label="Constraint type", choices=[])
+    operator = OperatorField(label="Constraint type")
 
     term = forms.CharField(label="Search term", required=False)
     end_term = forms.CharField(label="End term", required=False)
 
+    # Newline- or comma-separated values added to the term of an "is one of" constraint
+    term_file = forms.FileField(
+        label="Values file",
+        required=False,
+        widget=forms.FileInput(attrs={"accept": ".txt,.csv,text/plain,text/csv"}),
+    )
+
+    # Number of parenthesized groups opened before and closed after the constraint
+    open_groups = forms.TypedChoiceField(
+        label="Open",
+        choices=[(i, "(" * i) for i in range(MAX_GROUP_DEPTH + 1)],
+        coerce=int,
+        empty_value=0,
+        required=False,
+    )
+    close_groups = forms.TypedChoiceField(
+        label="Close",
+        choices=[(i, ")" * i) for i in range(MAX_GROUP_DEPTH + 1)],
+        coerce=int,
+        empty_value=0,
+        required=False,
+    )
+
     def __init__(self, configuration, *args, **kwargs):
         """
         Receives the configuration for the model to represent (potentially ``None`` if the original
@@ -92,108 +178,44 @@ class ConstraintForm(forms.Form):
         self.configuration = configuration
         if configuration:
             self.fields["field"].choices = configuration.get_searchable_field_choices()
-
-    def _clean_fields(self):
-        """
-        Workaround for displaying stripped info in the ``operator`` select, and running validation
-        against reversed (name, value) choices.
-
-        Because the frontend strips away the queryset language from the operator choices (leaving
-        behind doubled 2-tuples of UI text such as ("= equal", "= equal")), the default field-level
-        validation of the ``operator`` field will fail by default, since "iexact" is valid but
-        "= equal" is not.  To solve the problem, this method sets the choices appropriately in
-        reverse: ("= equal", "iexact").  When field validation inspects the value, everything will
-        check out.  During that time, the ``clean_operator()`` method will be called to further
-        process the ``operator`` value back to "iexact" (the reversed, faked UI text).
-
-        Once all of the trickery is done, the choices are mapped once more to ("= equal", "= equal")
-        so that when the template is rendered with this form, the choices are as they were before.
-
-        """
-
-        field_field = self.fields["field"]
-        field_hash = field_field.widget.value_from_datadict(self.data, {}, self.add_prefix("field"))
-        operators = self.configuration.get_operator_choices(hash=field_hash)
-        self.fields["operator"].choices = map(list, map(reversed, operators))
-
-        # Allow default validation to occur, including the "clean_operator" method below.
-        super(ConstraintForm, self)._clean_fields()
-
-        # Set the operators back to the flat choices of frontend-only values
-        self.fields["operator"].choices = map(lambda o: (o[1], o[1]), operators)
+            if self.is_bound:
+                field_field = self.fields["field"]
+                field_hash = field_field.widget.value_from_datadict(
+                    self.data, self.files, self.add_prefix("field")
+                )
+                self.fields["operator"].set_lookups(
+                    configuration.get_operator_lookups(hash=field_hash)
+                )
 
     def clean_type(self):
         """Convert type into an ``operator.and_`` or ``operator.or_`` reference."""
-
-        type = self.cleaned_data["type"]
-
-        if type == "and":
-            type = operator.and_
-        elif type == "or":
-            type = operator.or_
-
-        return type
+        return CONSTRAINT_TYPES[self.cleaned_data["type"]]
 
     def clean_field(self):
         """Convert ``field`` hash into ORM path tuple."""
         return self.configuration.reverse_field_hash(self.cleaned_data["field"])
 
-    def clean_operator(self):
-        """Convert operator into ORM query type such as "icontains" """
-
-        # The default cleaned_value will be the text from the UI, so the choices (which have been
-        # reversed for default validation to accept the text as a valid choice) are converted to a
-        # dictionary for accessing the intended ORM queryset language value.
-
-        # Input: "= equal"
-        # Output: "iexact"
-
-        operator = self.cleaned_data["operator"]
-        operator = dict(self.fields["operator"].choices)[operator]
-
-        return operator
-
-    def clean_term(self):  # noqa: C901
+    def clean_term(self):
         """Normalizes the ``term`` field to what makes sense for the operator."""
 
         if "field" not in self.cleaned_data or "operator" not in self.cleaned_data:
             return self.cleaned_data["term"]
 
-        classification = self.configuration.get_field_classification(self.cleaned_data["field"])
-        operator = self.cleaned_data["operator"]
-        term = self.cleaned_data["term"].strip()
-        field_type = self.configuration.field_types[self.cleaned_data["field"]]
-
-        if field_type.choices:
-            # The field's database values aren't the display values, but the display values are
-            # what the user will search for.  e.g., choices=[(1, 'Bob'), (2, 'Mary')]
-            choices = {k.lower(): v for v, k in field_type.choices}
-            if term.lower() in choices:
-                term = choices[term.lower()]
-        else:
-            # Numbers and strings don't need processing, but the other types should be inspected.
-            if classification == "date":
-                try:
-                    term = dateutil.parser.parse(term)
-                except (TypeError, ValueError):
-                    raise ValidationError("Unable to parse a date from '{}'".format(term))
-            elif classification == "boolean":
-                if term.lower() in ("true", "yes"):
-                    term = True
-                elif term.lower() in ("false", "no"):
-                    term = False
-                else:
-                    raise ValidationError("Boolean value must be either true/false or yes/no.")
-            elif classification == "number":
-                try:
-                    float(term)
-                except TypeError:
-                    raise ValidationError("Value must be numeric.")
-
-        if operator not in ("isnull", "!isnull") and term in [None, ""]:
-            raise ValidationError("This field is required.")
-
-        return term
+        term = self.cleaned_data["term"]
+        upload = self.files.get(self.add_prefix("term_file"))
+        try:
+            if upload and self.cleaned_data["operator"] == "in":
+                check_upload_size(self.configuration, upload)
+                values = upload.read().decode("utf-8-sig", "replace")
+                term = "\n".join(filter(None, [term, values]))
+            return clean_term(
+                self.configuration,
+                self.cleaned_data["field"],
+                self.cleaned_data["operator"],
+                term,
+            )
+        except SearchSpecError as e:
+            raise ValidationError(str(e))
 
     def clean_end_term(self):
         """
@@ -212,19 +234,14 @@ class ConstraintForm(forms.Form):
         ):
             return self.cleaned_data["end_term"]
 
-        classification = self.configuration.get_field_classification(self.cleaned_data["field"])
-        operator = self.cleaned_data["operator"]
-        begin_term = self.cleaned_data["term"]
-        term = self.cleaned_data["end_term"]
-
-        if operator == "range":
-            if classification == "date":
-                term = dateutil.parser.parse(term)
-            elif classification == "number":
-                term = int(term)
-            else:
-                raise ValidationError("Unknown range type %r." % classification)
-            self.cleaned_data["term"] = [begin_term, term]
+        if self.cleaned_data["operator"] == "range":
+            try:
+                term = clean_end_term(
+                    self.configuration, self.cleaned_data["field"], self.cleaned_data["end_term"]
+                )
+            except SearchSpecError as e:
+                raise ValidationError(str(e))
+            self.cleaned_data["term"] = [self.cleaned_data["term"], term]
 
         return ""
 
@@ -232,13 +249,102 @@ class ConstraintForm(forms.Form):
 class ConstraintFormset(BaseFormSet):
     """Removes the first ``ConstraintForm``'s ``type`` field."""
 
-    def __init__(self, configuration, *args, **kwargs):
-        """Stores the configuration until the forms are constructed."""
+    # Messages about a valid search that may be slow, set by ``clean()``
+    cost_warnings = ()
+
+    # The reason a search was refused before its forms were validated, such as a size limit the
+    # submission exceeded (see ``check_limits()``) or a saved search that no longer validates
+    spec_error = None
+
+    def __init__(self, configuration, data=None, files=None, *args, **kwargs):
+        """
+        Stores the configuration until the forms are constructed.  Submitted ``data`` that exceeds
+        the configuration's size limits is dropped, leaving an unbound formset that reports the
+        exceeded limit as its error.
+
+        """
+
         self.configuration = configuration
-        super(ConstraintFormset, self).__init__(*args, **kwargs)
+        if configuration is not None and data is not None:
+            try:
+                prefix = kwargs.get("prefix") or self.get_default_prefix()
+                check_limits(configuration, data, files, prefix)
+            except SearchSpecError as e:
+                self.spec_error = str(e)
+                data = files = None
+        super(ConstraintFormset, self).__init__(data, files, *args, **kwargs)
+
+    def non_form_errors(self):
+        if self.spec_error is not None:
+            return self.error_class([self.spec_error], error_class="nonform")
+        return super(ConstraintFormset, self).non_form_errors()
 
     def _construct_form(self, i, **kwargs):
         """Sends the specified model configuration to the form."""
         return super(ConstraintFormset, self)._construct_form(
             i, configuration=self.configuration, **kwargs
         )
+
+    def clean(self):
+        """
+        Checks that the parentheses of the constraints balance, and the estimated cost of the
+        search against the configuration's thresholds, so that searches that are rejected or must
+        be narrowed are reported as formset errors.
+
+        """
+
+        if self.configuration is None or any(self.errors):
+            return
+
+        depth = 0
+        for form in self.forms:
+            depth += form.cleaned_data.get("open_groups") or 0
+            depth -= form.cleaned_data.get("close_groups") or 0
+            if depth < 0:
+                raise ValidationError("A closing parenthesis has no matching opening one.")
+        if depth:
+            raise ValidationError("An opening parenthesis is never closed.")
+
+        constraints = self.get_constraints()
+        queryset = None
+        if self.configuration.max_explain_cost is not None:
+            query = self.configuration.get_engine().build_query(constraints)
+            queryset = self.configuration.model._default_manager.filter(query)
+        try:
+            self.cost_warnings = self.configuration.check_search_cost(constraints, queryset)
+        except SearchSpecError as e:
+            raise ValidationError(str(e))
+
+    def get_constraints(self):
+        """
+        Given that the formset has passed validation, returns the cleaned constraints as the
+        4-tuples of (type_operator, orm_path_tuple, orm_operator, term) used by
+        ``appsearch.engine.SearchEngine``.  Parenthesized constraints are nested into
+        ``(type_operator, (), GROUP, [constraint, ...])`` groups, which take the type of the
+        constraint that opens them.
+
+        """
+
+        constraints = []
+        stack = [constraints]
+        for form in self.forms:
+            type = form.cleaned_data["type"]
+            for i in range(form.cleaned_data.get("open_groups") or 0):
+                group = []
+                stack[-1].append((type, (), GROUP, group))
+                stack.append(group)
+                type = CONSTRAINT_TYPES["and"]  # The first type in a group is ignored
+
+            stack[-1].append(
+                (
+                    type,
+                    form.cleaned_data["field"],
+                    form.cleaned_data["operator"],
+                    form.cleaned_data["term"],
+                )
+            )
+
+            for i in range(form.cleaned_data.get("close_groups") or 0):
+                if len(stack) > 1:
+                    stack.pop()
+        return constraints
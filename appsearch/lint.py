@@ -0,0 +1,113 @@
+"""lint.py: Static checks of search registrations"""
+
+import logging
+from collections import namedtuple
+
+from django.core.exceptions import FieldDoesNotExist
+from django.db import models
+from django.db.models.constants import LOOKUP_SEP
+
+from .cost import is_indexed
+from .ormutils import get_many_valued_hops, resolve_orm_path
+
+
+log = logging.getLogger(__name__)
+
+ERROR = "error"
+WARNING = "warning"
+
+# A problem found in one path of a configuration
+Issue = namedtuple("Issue", ["level", "path", "message"])
+
+
+class ConfigurationReport(object):
+    """The path statistics and issues of one ``ModelSearch``."""
+
+    def __init__(self, configuration):
+        self.configuration = configuration
+        self.label = configuration.model._meta.label
+        self.field_count = len(configuration._fields)
+        self.display_field_count = len(configuration._display_fields)
+        self.path_count = 0
+        self.indexed_path_count = 0
+        self.max_join_depth = 0
+        self.max_many_valued_hops = 0
+        self.issues = []
+
+    @property
+    def index_coverage(self):
+        """The fraction of search paths ending on an indexed column."""
+        if not self.path_count:
+            return 1.0
+        return self.indexed_path_count / self.path_count
+
+    @property
+    def errors(self):
+        return [issue for issue in self.issues if issue.level == ERROR]
+
+    @property
+    def warnings(self):
+        return [issue for issue in self.issues if issue.level == WARNING]
+
+    def add(self, level, path, message):
+        self.issues.append(Issue(level, path, message))
+
+
+def inspect_configuration(configuration):
+    """
+    Validates every search and display path of ``configuration`` with ``resolve_orm_path()`` and
+    returns its ``ConfigurationReport``.  Besides unresolvable paths, it flags:
+
+    * related search paths ending on an unindexed column,
+    * display paths crossing a reverse or many-to-many relationship,
+    * equality searches on ``TextField`` columns, which indexes rarely cover,
+    * nullable columns whose operators can't search for missing values.
+
+    """
+
+    model = configuration.model
+    report = ConfigurationReport(configuration)
+
+    for paths in configuration._fields:
+        operators = list(configuration.get_operator_lookups(field=paths).values())
+        for path in paths:
+            try:
+                field = resolve_orm_path(model, path)
+            except (FieldDoesNotExist, ValueError) as e:
+                report.add(ERROR, path, "Search path doesn't resolve: {}".format(e))
+                continue
+
+            report.path_count += 1
+            depth = path.count(LOOKUP_SEP)
+            hops = get_many_valued_hops(model, path)
+            report.max_join_depth = max(report.max_join_depth, depth)
+            report.max_many_valued_hops = max(report.max_many_valued_hops, hops)
+
+            indexed = is_indexed(model, path)
+            if indexed:
+                report.indexed_path_count += 1
+            elif depth:
+                report.add(
+                    WARNING, path, "Unindexed search path crosses {} relationships".format(depth)
+                )
+
+            if isinstance(field, models.TextField) and "iexact" in operators:
+                report.add(WARNING, path, "Equality search on a TextField can't use an index")
+            if getattr(field, "null", False) and "isnull" not in operators:
+                report.add(WARNING, path, "Nullable field has no operator for missing values")
+
+    for _, path, _ in configuration._display_fields:
+        try:
+            hops = get_many_valued_hops(model, path)
+        except (FieldDoesNotExist, ValueError) as e:
+            report.add(ERROR, path, "Display path doesn't resolve: {}".format(e))
+            continue
+        if hops:
+            report.add(WARNING, path, "Display path crosses a many-valued relationship")
+
+    return report
+
+
+def inspect_registry(registry):
+    """Returns the ``ConfigurationReport`` of every registration in ``registry``."""
+    return [inspect_configuration(registry[key]) for key in sorted(registry)]
@@ -0,0 +1,36 @@
+"""build_search_snapshot.py: Write the registry snapshot loaded by worker processes"""
+
+import logging
+
+from django.core.management.base import BaseCommand, CommandError
+
+import appsearch
+from appsearch.registry import search
+from appsearch.snapshot import get_snapshot_path, write_snapshot
+
+
+log = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = (
+        "Writes the processed search fields of every registered search to the registry snapshot "
+        "at APPSEARCH_SNAPSHOT_PATH, or to --output."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--output", help="Path of the snapshot file to write.")
+
+    def handle(self, *args, **options):
+        path = options["output"] or get_snapshot_path()
+        if not path:
+            raise CommandError("Set APPSEARCH_SNAPSHOT_PATH or pass --output.")
+
+        appsearch.autodiscover()
+
+        snapshot = write_snapshot(search, path)
+        self.stdout.write(
+            "Wrote the search fields of {} models to {}.".format(
+                len(snapshot["configurations"]), path
+            )
+        )
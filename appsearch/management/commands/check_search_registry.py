@@ -0,0 +1,88 @@
+"""check_search_registry.py: Report slow or broken search registrations"""
+
+import logging
+
+from django.core.management.base import BaseCommand, CommandError
+
+import appsearch
+from appsearch.lint import inspect_registry
+from appsearch.registry import search
+
+
+log = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = (
+        "Validates the paths of every registered search and reports join depth, many-valued "
+        "relationships, index coverage and field counts.  Exits non-zero on errors and on "
+        "any exceeded threshold."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--max-join-depth", type=int, default=None)
+        parser.add_argument("--max-many-valued-hops", type=int, default=None)
+        parser.add_argument("--max-fields", type=int, default=None)
+        parser.add_argument(
+            "--min-index-coverage",
+            type=float,
+            default=None,
+            help="Lowest fraction of search paths on indexed columns, from 0 to 1.",
+        )
+        parser.add_argument(
+            "--fail-on-warnings", action="store_true", help="Treat warnings as failures."
+        )
+
+    def handle(self, *args, **options):
+        appsearch.autodiscover()
+
+        failures = []
+        for report in inspect_registry(search):
+            self.stdout.write(
+                "{}: {} fields ({} paths), {} display fields, join depth {}, "
+                "many-valued hops {}, index coverage {:.0%}".format(
+                    report.label,
+                    report.field_count,
+                    report.path_count,
+                    report.display_field_count,
+                    report.max_join_depth,
+                    report.max_many_valued_hops,
+                    report.index_coverage,
+                )
+            )
+            for issue in report.issues:
+                self.stdout.write("  {}: {}: {}".format(issue.level, issue.path, issue.message))
+
+            failures.extend(
+                "{}: {}: {}".format(report.label, issue.path, issue.message)
+                for issue in (report.issues if options["fail_on_warnings"] else report.errors)
+            )
+            failures.extend(self.check_thresholds(report, options))
+
+        if failures:
+            raise CommandError(
+                "{} search registry problems:\n{}".format(len(failures), "\n".join(failures))
+            )
+
+    def check_thresholds(self, report, options):
+        """Returns the messages of the thresholds ``report`` exceeds."""
+
+        checks = [
+            ("max_join_depth", report.max_join_depth, "join depth"),
+            ("max_many_valued_hops", report.max_many_valued_hops, "many-valued hops"),
+            ("max_fields", report.field_count, "search fields"),
+        ]
+        messages = []
+        for option, value, name in checks:
+            limit = options[option]
+            if limit is not None and value > limit:
+                messages.append("{}: {} {} > {}".format(report.label, name, value, limit))
+
+        coverage = options["min_index_coverage"]
+        if coverage is not None and report.index_coverage < coverage:
+            messages.append(
+                "{}: index coverage {:.0%} < {:.0%}".format(
+                    report.label, report.index_coverage, coverage
+                )
+            )
+        return messages
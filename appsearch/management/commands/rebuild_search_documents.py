@@ -0,0 +1,42 @@
+"""rebuild_search_documents.py: Rebuild denormalized search documents"""
+
+import logging
+
+from django.core.management.base import BaseCommand, CommandError
+
+import appsearch
+from appsearch.documents import rebuild_search_documents
+from appsearch.registry import search
+
+
+log = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = (
+        "Rebuilds the denormalized search documents of registered searches with 'denormalize' "
+        "set, optionally limited to the given 'app_label.model' names."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("models", nargs="*", metavar="app_label.model")
+        parser.add_argument("--batch-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        appsearch.autodiscover()
+
+        keys = [key.lower() for key in options["models"]] or list(search)
+        for key in keys:
+            try:
+                configuration = search[key]
+            except KeyError:
+                raise CommandError("No registered search for {!r}".format(key))
+            if not configuration.denormalize:
+                if options["models"]:
+                    raise CommandError("The search for {!r} isn't denormalized".format(key))
+                continue
+
+            count = rebuild_search_documents(configuration, batch_size=options["batch_size"])
+            self.stdout.write(
+                "Rebuilt {} search documents for {}.".format(count, configuration.verbose_name)
+            )
@@ -0,0 +1,58 @@
+"""refresh_saved_searches.py: Refresh materialized saved search snapshots"""
+
+import logging
+import time
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+import appsearch
+from appsearch.models import SavedSearch
+
+
+log = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = (
+        "Refreshes the snapshots of materialized saved searches that are missing, dirty, or older "
+        "than their refresh interval."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--all",
+            action="store_true",
+            help="Refresh every materialized saved search, whether or not it is due.",
+        )
+        parser.add_argument(
+            "--loop",
+            action="store_true",
+            help="Keep running, checking for due saved searches every --interval seconds.",
+        )
+        parser.add_argument("--interval", type=int, default=60)
+
+    def handle(self, *args, **options):
+        appsearch.autodiscover()
+
+        while True:
+            count = self.refresh(refresh_all=options["all"])
+            if options["verbosity"] > 1 or not options["loop"]:
+                self.stdout.write("Refreshed {} saved searches.".format(count))
+            if not options["loop"]:
+                break
+            time.sleep(options["interval"])
+
+    def refresh(self, refresh_all=False):
+        now = timezone.now()
+        count = 0
+        for saved_search in SavedSearch.objects.filter(materialize=True).select_related("owner"):
+            if not refresh_all and not saved_search.is_due(now):
+                continue
+            try:
+                saved_search.refresh()
+            except Exception:
+                log.exception("Unable to refresh saved search %r", saved_search.pk)
+            else:
+                count += 1
+        return count
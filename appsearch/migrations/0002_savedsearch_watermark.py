@@ -0,0 +1,20 @@
+# Generated by Django 5.2.18 on 2026-10-19 01:04
+
+import django.core.serializers.json
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("appsearch", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="savedsearch",
+            name="watermark",
+            field=models.JSONField(
+                blank=True, encoder=django.core.serializers.json.DjangoJSONEncoder, null=True
+            ),
+        ),
+    ]
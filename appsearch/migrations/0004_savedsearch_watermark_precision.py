@@ -0,0 +1,20 @@
+# Generated by Django 5.2.18 on 2026-10-19 01:40
+
+import appsearch.encoders
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("appsearch", "0003_searchdocument"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="savedsearch",
+            name="watermark",
+            field=models.JSONField(
+                blank=True, encoder=appsearch.encoders.PreciseJSONEncoder, null=True
+            ),
+        ),
+    ]
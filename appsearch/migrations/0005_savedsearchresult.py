@@ -0,0 +1,59 @@
+# Generated by Django 5.2.18 on 2026-10-19 01:55
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def copy_snapshots(apps, schema_editor):
+    SavedSearch = apps.get_model("appsearch", "SavedSearch")
+    SavedSearchResult = apps.get_model("appsearch", "SavedSearchResult")
+    for saved_search in SavedSearch.objects.filter(snapshot__isnull=False):
+        SavedSearchResult.objects.bulk_create(
+            [
+                SavedSearchResult(saved_search=saved_search, object_id=pk)
+                for pk in saved_search.snapshot
+            ],
+            batch_size=1000,
+        )
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("appsearch", "0004_savedsearch_watermark_precision"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="SavedSearchResult",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True, primary_key=True, serialize=False, verbose_name="ID"
+                    ),
+                ),
+                ("object_id", models.PositiveBigIntegerField()),
+                (
+                    "saved_search",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="results",
+                        to="appsearch.savedsearch",
+                    ),
+                ),
+            ],
+            options={
+                "constraints": [
+                    models.UniqueConstraint(
+                        fields=("saved_search", "object_id"),
+                        name="appsearch_unique_saved_search_result",
+                    )
+                ],
+            },
+        ),
+        migrations.RunPython(copy_snapshots, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name="savedsearch",
+            name="snapshot",
+        ),
+    ]
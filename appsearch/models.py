@@ -1 +1,242 @@
-# Create your models here.
+"""models.py: Saved searches"""
+
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import models, transaction
+from django.db.models.query import Q
+from django.utils import timezone
+
+from .documents import FIRST_VALUE_LENGTH
+from .encoders import PreciseJSONEncoder
+
+
+log = logging.getLogger(__name__)
+
+
+class SavedSearch(models.Model):
+    """
+    A named search spec belonging to a user.
+
+    ``constraints`` holds the normalized spec: a list of ``[type, [orm_path, ...], operator, term]``
+    items (with a fifth ``end_term`` item for "range" constraints), using ORM operators rather
+    than UI labels so that the spec survives changes to the frontend.  Parenthesized groups are
+    stored as ``[type, [], "()", [constraint, ...]]``.
+
+    When ``materialize`` is set, the matching primary keys are kept as ``SavedSearchResult`` rows
+    and opening the search reads them through a subquery instead of re-running the query.  Snapshots are refreshed by the
+    ``refresh_saved_searches`` management command, either when ``refresh_interval`` seconds have
+    passed or when a change to a searched model has marked the search dirty (see
+    ``ModelSearch.track_saved_searches``).  A dirty snapshot is still read until it is refreshed.
+
+    """
+
+    name = models.CharField(max_length=100)
+    owner = models.ForeignKey(
+        settings.AUTH_USER_MODEL, related_name="saved_searches", on_delete=models.CASCADE
+    )
+    content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
+    constraints = models.JSONField(encoder=DjangoJSONEncoder)
+
+    materialize = models.BooleanField(default=False)
+    refresh_interval = models.PositiveIntegerField(default=86400)
+    snapshot_updated = models.DateTimeField(null=True, blank=True)
+    is_dirty = models.BooleanField(default=False, db_index=True)
+
+    # The highest ``ModelSearch.watermark_field`` value returned by ``get_new_objects()``, stored
+    # with full precision so that re-checks never return the last object again
+    watermark = models.JSONField(encoder=PreciseJSONEncoder, null=True, blank=True)
+
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ("name",)
+
+    def __str__(self):
+        return self.name
+
+    @classmethod
+    def normalize_constraints(cls, configuration, constraints):
+        """
+        Validates ``constraints`` in any format accepted by ``appsearch.engine.SearchEngine`` and
+        returns them in the normalized storage format.  Field hashes and operator labels are
+        resolved, while terms are kept as given so they are re-cleaned on every run.
+
+        """
+
+        from .engine import CONSTRAINT_TYPES, GROUP, get_group_constraints
+
+        type_names = {v: k for k, v in CONSTRAINT_TYPES.items()}
+        engine = configuration.get_engine()
+
+        # Validate the whole spec before storing any of it
+        engine.clean_constraints(constraints)
+
+        normalized = []
+        for constraint in constraints:
+            group = get_group_constraints(constraint)
+            if group is not None:
+                type = constraint[0]
+                group = cls.normalize_constraints(configuration, group)
+                normalized.append([type_names.get(type, type), [], GROUP, group])
+                continue
+
+            type, field, operator, term = constraint[:4]
+            field, operator = engine.get_plan(field, operator)
+            item = [type_names.get(type, type), list(field), operator, term]
+            if operator == "range":
+                if isinstance(term, (tuple, list)):
+                    item[3:] = list(term)
+                else:
+                    item.append(constraint[4])
+            normalized.append(item)
+        return normalized
+
+    @classmethod
+    def from_searcher(cls, searcher, name, **kwargs):
+        """Returns an unsaved ``SavedSearch`` for the validated search of a ``Searcher``."""
+        return cls(
+            name=name,
+            owner=searcher.request.user,
+            content_type=ContentType.objects.get_for_model(searcher.model),
+            constraints=cls.normalize_constraints(searcher.model_config, searcher.constraints),
+            **kwargs,
+        )
+
+    @property
+    def model(self):
+        return self.content_type.model_class()
+
+    def get_configuration(self, registry=None):
+        from .registry import search
+
+        return (registry or search)[self.model]
+
+    def is_due(self, now=None):
+        """
+        Indicates if a materialized search's snapshot is missing, marked dirty by a model change,
+        or older than ``refresh_interval``.
+
+        """
+
+        if not self.materialize:
+            return False
+        if self.snapshot_updated is None or self.is_dirty:
+            return True
+        now = now or timezone.now()
+        return self.snapshot_updated + timedelta(seconds=self.refresh_interval) <= now
+
+    def has_snapshot(self):
+        """Indicates if the search is materialized and has a snapshot to read from."""
+        return self.materialize and self.snapshot_updated is not None
+
+    def get_snapshot_query(self):
+        """
+        Returns the ``Q`` selecting the objects in the snapshot.  The primary keys are read by a
+        subquery on the indexed result rows, so the query's size doesn't grow with the snapshot.
+
+        """
+
+        results = SavedSearchResult.objects.filter(saved_search=self)
+        return Q(pk__in=results.values("object_id"))
+
+    def get_queryset(self, request=None, user=None, registry=None):
+        """
+        Returns the queryset of matching objects, read from the snapshot when it is current, or
+        otherwise by running the search.  ``user`` defaults to the owner.
+
+        """
+
+        configuration = self.get_configuration(registry)
+        user = user or self.owner
+        if self.has_snapshot():
+            return configuration.get_queryset(request, user).filter(self.get_snapshot_query())
+        return configuration.get_engine().get_queryset(self.constraints, request, user)
+
+    def get_new_objects(self, request=None, user=None, registry=None):
+        """
+        Returns the list of matching objects beyond the stored ``watermark``, in watermark order,
+        and advances the watermark past them.  With an index on the configuration's
+        ``watermark_field``, a re-check only costs as much as the number of new rows.
+
+        """
+
+        configuration = self.get_configuration(registry)
+        queryset = configuration.get_engine().get_queryset(
+            self.constraints, request, user or self.owner
+        )
+        queryset = configuration.filter_since(queryset, self.watermark)
+
+        watermark_field = configuration.get_watermark_field()
+        objects = list(queryset.order_by(watermark_field))
+        if objects:
+            self.watermark = getattr(objects[-1], watermark_field)
+            self.save(update_fields=["watermark"])
+        return objects
+
+    def refresh(self, registry=None, batch_size=1000):
+        """Re-runs the search as the owner and replaces the stored matching primary keys."""
+
+        configuration = self.get_configuration(registry)
+        queryset = configuration.get_engine().get_queryset(self.constraints, user=self.owner)
+        pks = list(queryset.order_by("pk").values_list("pk", flat=True))
+        results = [SavedSearchResult(saved_search=self, object_id=pk) for pk in pks]
+
+        with transaction.atomic():
+            SavedSearchResult.objects.filter(saved_search=self).delete()
+            SavedSearchResult.objects.bulk_create(results, batch_size=batch_size)
+            self.snapshot_updated = timezone.now()
+            self.is_dirty = False
+            self.save(update_fields=["snapshot_updated", "is_dirty"])
+        log.debug("Refreshed saved search %r with %d results", self.name, len(results))
+
+
+class SavedSearchResult(models.Model):
+    """One primary key in the snapshot of a materialized ``SavedSearch``."""
+
+    saved_search = models.ForeignKey(SavedSearch, related_name="results", on_delete=models.CASCADE)
+    object_id = models.PositiveBigIntegerField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["saved_search", "object_id"], name="appsearch_unique_saved_search_result"
+            ),
+        ]
+
+    def __str__(self):
+        return "{}: {}".format(self.saved_search_id, self.object_id)
+
+
+class SearchDocument(models.Model):
+    """
+    One related search path's values for one object of a ``ModelSearch`` with ``denormalize``
+    set, so that searches on the path can read a single indexed table instead of joining.
+
+    ``value`` holds every value found along the path, lowercased and joined by newlines, and
+    ``first_value`` the lowercased value of the first related row, cut to ``FIRST_VALUE_LENGTH``
+    characters so that it can be indexed on every backend.  See ``appsearch.documents``.
+
+    """
+
+    content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
+    object_id = models.PositiveBigIntegerField()
+    path = models.CharField(max_length=255)
+    value = models.TextField()
+    first_value = models.CharField(max_length=FIRST_VALUE_LENGTH)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["content_type", "path", "first_value"]),
+        ]
+        constraints = [
+            models.UniqueConstraint(
+                fields=["content_type", "path", "object_id"], name="appsearch_unique_document"
+            ),
+        ]
+
+    def __str__(self):
+        return "{}:{} {}".format(self.content_type_id, self.object_id, self.path)
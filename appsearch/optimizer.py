@@ -0,0 +1,138 @@
+"""optimizer.py: Boolean tree simplification of cleaned constraints"""
+
+import logging
+from collections import OrderedDict, namedtuple
+from functools import reduce
+from operator import and_, or_
+
+from .cost import NARROWING_OPERATORS, get_constraint_cost, is_indexed
+from .engine import CONSTRAINT_TYPES, GROUP, get_field_query
+
+
+log = logging.getLogger(__name__)
+
+AND = "and"
+OR = "or"
+CONNECTORS = {CONSTRAINT_TYPES[AND]: AND, CONSTRAINT_TYPES[OR]: OR}
+COMBINATORS = {AND: and_, OR: or_}
+
+# Operators of ORed constraints on one field that can be merged into a single "in"
+MERGEABLE_OPERATORS = ("exact", "in")
+
+# A single constraint, and a connector applied to two or more subtrees
+Leaf = namedtuple("Leaf", ["field", "operator", "term"])
+Node = namedtuple("Node", ["connector", "children"])
+
+
+def get_tree(constraints):
+    """
+    Returns the boolean tree of the cleaned ``constraints``, folded left to right exactly like the
+    constraint list reads: "A or B and C" is "(A or B) and C", and groups are folded on their own.
+
+    """
+
+    tree = None
+    for type, field, operator, term in constraints:
+        item = get_tree(term) if operator == GROUP else Leaf(field, operator, term)
+        if tree is None:
+            tree = item
+        else:
+            tree = Node(CONNECTORS[type], [tree, item])
+    return tree
+
+
+def optimize(configuration, tree):
+    """
+    Returns a simplified but equivalent ``tree``:
+
+    * chains of the same connector are flattened into one node,
+    * duplicate subtrees under a node are dropped,
+    * ORed "exact"/"in" constraints on the same single-path field are merged into one "in",
+    * ANDed subtrees are ordered with indexed narrowing constraints first and costlier ones last.
+
+    """
+
+    if isinstance(tree, Leaf):
+        return tree
+
+    children = []
+    for child in tree.children:
+        child = optimize(configuration, child)
+        if isinstance(child, Node) and child.connector == tree.connector:
+            children.extend(child.children)
+        else:
+            children.append(child)
+
+    children = list(OrderedDict((get_key(child), child) for child in children).values())
+    if tree.connector == OR:
+        children = merge_equalities(children)
+    else:
+        children.sort(key=lambda child: get_sort_key(configuration, child))
+
+    if len(children) == 1:
+        return children[0]
+    return Node(tree.connector, children)
+
+
+def merge_equalities(children):
+    """Merges ORed "exact"/"in" leaves on the same field into one "in" leaf, in place of the first."""
+
+    values = OrderedDict()
+    for child in children:
+        if is_mergeable(child):
+            terms = child.term if child.operator == "in" else [child.term]
+            values.setdefault(child.field, []).extend(terms)
+
+    done = set()
+    merged = []
+    for child in children:
+        if not is_mergeable(child) or len(values[child.field]) < 2:
+            merged.append(child)
+        elif child.field not in done:
+            merged.append(Leaf(child.field, "in", list(OrderedDict.fromkeys(values[child.field]))))
+            done.add(child.field)
+    return merged
+
+
+def is_mergeable(child):
+    return (
+        isinstance(child, Leaf) and len(child.field) == 1 and child.operator in MERGEABLE_OPERATORS
+    )
+
+
+def get_key(tree):
+    """Returns a hashable key identifying the condition of ``tree``."""
+
+    if isinstance(tree, Leaf):
+        term = tree.term
+        if isinstance(term, list):
+            term = tuple(term)
+        return (tree.field, tree.operator, term)
+    return (tree.connector, tuple(map(get_key, tree.children)))
+
+
+def get_cost(configuration, tree):
+    if isinstance(tree, Leaf):
+        return get_constraint_cost(configuration, (None,) + tuple(tree))
+    return 1 + sum(get_cost(configuration, child) for child in tree.children)
+
+
+def get_sort_key(configuration, tree):
+    """Sorts indexed narrowing constraints first, then by estimated cost."""
+
+    narrowing = (
+        isinstance(tree, Leaf)
+        and len(tree.field) == 1
+        and tree.operator in NARROWING_OPERATORS
+        and is_indexed(configuration.model, tree.field[0])
+    )
+    return (not narrowing, get_cost(configuration, tree))
+
+
+def compile_tree(configuration, tree):
+    """Returns the ``Q`` for ``tree``."""
+
+    if isinstance(tree, Leaf):
+        return get_field_query(tree.field, tree.operator, tree.term, configuration)
+    queries = [compile_tree(configuration, child) for child in tree.children]
+    return reduce(COMBINATORS[tree.connector], queries)
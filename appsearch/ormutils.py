@@ -3,6 +3,7 @@
 from functools import reduce
 
 from django.core.exceptions import FieldDoesNotExist
+from django.db import models
 
 
 from django.db.models.constants import LOOKUP_SEP
@@ -47,3 +48,54 @@ def get_model_at_related_field(model, attr):
             model.__name__, attr, field.__class__.__name__
         )
     )
+
+
+def get_many_valued_hops(model, orm_path):
+    """
+    Returns the number of relationships along ``orm_path`` from ``model`` that can match many rows
+    (reverse foreign keys and many-to-many fields), each of which can multiply the joined rows.
+
+    """
+
+    hops = 0
+    for bit in orm_path.split(LOOKUP_SEP)[:-1]:
+        field = model._meta.get_field(bit)
+        if field.many_to_many or field.one_to_many:
+            hops += 1
+        model = get_model_at_related_field(model, bit)
+    return hops
+
+
+def is_nullable_path(model, orm_path):
+    """
+    Returns whether ``orm_path`` from ``model`` can read as null, either because its final field
+    is nullable or because a relationship along the way can be empty.
+
+    """
+
+    for bit in orm_path.split(LOOKUP_SEP)[:-1]:
+        field = model._meta.get_field(bit)
+        if field.null or not field.concrete:
+            return True
+        model = get_model_at_related_field(model, bit)
+    return model._meta.get_field(orm_path.split(LOOKUP_SEP)[-1]).null
+
+
+def get_indexed_field_names(model):
+    """Returns the names of ``model``'s local fields that lead an index on its table."""
+
+    opts = model._meta
+    names = {
+        f.name
+        for f in opts.local_fields
+        if f.primary_key or f.unique or f.db_index or isinstance(f, models.ForeignKey)
+    }
+    for index in opts.indexes:
+        if index.fields:
+            names.add(index.fields[0].lstrip("-"))
+    for constraint in opts.constraints:
+        if isinstance(constraint, models.UniqueConstraint) and constraint.fields:
+            names.add(constraint.fields[0])
+    for fields in opts.unique_together:
+        names.add(fields[0])
+    return names
@@ -1,23 +1,37 @@
 import logging
 import sys
+import threading
+import time
 from collections import OrderedDict
 from functools import reduce
 from hashlib import sha1 as sha
-from itertools import chain
+from itertools import chain, count
 from operator import attrgetter, itemgetter
 
+from django.apps import apps
 from django.contrib.contenttypes.models import ContentType
-from django.core.exceptions import FieldDoesNotExist, ObjectDoesNotExist
-from django.db import OperationalError, ProgrammingError, models
+from django.core.exceptions import FieldDoesNotExist, ObjectDoesNotExist, ValidationError
+from django.db import OperationalError, ProgrammingError, models, router
+from django.db.models import Count, F, Max
 from django.db.models.constants import LOOKUP_SEP
 from django.forms.utils import pretty_name
+from django.utils.html import format_html
+from django.utils.safestring import mark_safe
 from django.utils.text import capfirst
 
-from .ormutils import resolve_orm_path
+from .ormutils import (
+    get_indexed_field_names,
+    get_model_at_related_field,
+    is_nullable_path,
+    resolve_orm_path,
+)
 
 
 log = logging.getLogger(__name__)
 
+# Guards the round-robin replica selection of ``ModelSearch.get_database()``
+_database_cycle_lock = threading.Lock()
+
 # Base fields to detect built-in operator types.  Fields that subclass these are implicitly included
 # in the type check.
 TEXT_FIELDS = (
@@ -42,6 +56,7 @@ OPERATOR_MAP = {
         ("!icontains", "doesn't contain"),
         ("iexact", "= equal"),
         ("!iexact", "≠ not equal"),
+        ("in", "is one of"),
         ("!isnull", "exists"),
         ("isnull", "doesn't exist"),
     ),
@@ -59,6 +74,7 @@ OPERATOR_MAP = {
         ("gt", "> greater than"),
         ("lt", "< less than"),
         ("range", "between"),
+        ("in", "is one of"),
         ("!isnull", "exists"),
         ("isnull", "doesn't exist"),
         ("icontains", "contains"),
@@ -74,10 +90,52 @@ OPERATOR_MAP = {
         ("isnull", "doesn't exist"),
     ),
     # If a field defines a "choices" list, we can't get very fancy with operator types
-    "choices": (("exact", "is"),),
+    "choices": (
+        ("exact", "is"),
+        ("in", "is one of"),
+    ),
 }
 
 
+# Size limits of a search that a ``ModelSearch`` inherits from its registry unless it sets them
+PAYLOAD_LIMITS = ("max_constraints", "max_term_length", "max_list_size")
+
+
+def get_field_hash(orm_paths):
+    """Returns the obscured frontend value for a tuple of ORM paths."""
+    return sha(",".join(orm_paths).encode("utf-8")).hexdigest()
+
+
+def get_verbose_name(model, field_name, prefix):
+    """
+    Derives the verbose name of ``model``'s field ``field_name``, prepending the model's own
+    verbose name when ``prefix`` is set.
+
+    """
+
+    verbose_name_bits = [model._meta.get_field(field_name).verbose_name]
+    if prefix:
+        verbose_name_bits.insert(0, model._meta.verbose_name)
+    return " ".join(map(pretty_name, verbose_name_bits))
+
+
+def get_explicit_verbose_names(field_list):
+    """
+    Yields the verbose name given by each 2-tuple of a ``search_fields`` list, or None for each
+    field whose verbose name is derived, in the order ``ModelSearch._get_field_info()`` returns
+    the fields.
+
+    """
+
+    for field_name in field_list:
+        if isinstance(field_name, dict):
+            yield from get_explicit_verbose_names(list(field_name.values())[0])
+        elif isinstance(field_name, (tuple, list)):
+            yield field_name[0]
+        else:
+            yield None
+
+
 class ModelSearch(object):
     """Contains search and display configuration for a single Model."""
 
@@ -88,9 +146,81 @@ class ModelSearch(object):
 
     display_fields = None
     search_fields = None
+    sortable_fields = None
+    safe_display_fields = ()
+    facet_fields = ()
+
+    # Facet tuning
+    facet_limit = 20
+    facet_cache_timeout = 300
+
+    # Mark materialized saved searches dirty when this model or a searched related model changes
+    track_saved_searches = False
+
+    # Local, monotonically increasing field marking how far an incremental search has read
+    watermark_field = None
+
+    # Answer searches on related text paths from denormalized ``SearchDocument`` rows
+    denormalize = False
+
+    # Database alias, or sequence of replica aliases used in turn, that searches read from
+    database = None
+
+    # "is one of" lists longer than this are split into several ORed ``__in`` lookups
+    in_chunk_size = 500
+
+    # Limits on the size of a submitted search, or ``None`` to use the registry's (see
+    # ``SearchRegistry``).  Submissions beyond them are refused before their forms are built.
+    max_constraints = None
+    max_term_length = None
+    max_list_size = None
+
+    # Seconds the display rows of result objects are kept in the ``row_cache_alias`` cache (see
+    # ``appsearch.rowcache``), or ``None`` to build every row on every search
+    row_cache_timeout = None
+    row_cache_alias = "default"
+
+    # Low-cardinality, single-path text ``search_fields`` whose distinct values are kept in a
+    # dictionary, so that "contains" and "equal" searches on them become indexed ``__in`` lookups.
+    # A dictionary is reloaded after ``value_dictionary_timeout`` seconds or when its model changes,
+    # and isn't used at all once it would hold more than ``value_dictionary_max_size`` values.
+    value_dictionary_fields = ()
+    value_dictionary_timeout = 300
+    value_dictionary_max_size = 500
+
+    # Typeahead suggestions (see ``appsearch.suggestions``): the values returned per prefix, and
+    # the low-cardinality fields whose whole value list is kept in process for a timeout
+    suggestion_limit = 10
+    cached_suggestion_fields = ()
+    suggestion_cache_timeout = 300
+
+    # Compound text ``search_fields`` entries, by their tuple of ORM paths, whose values are joined
+    # into one column for "contains" and "equal" searches, e.g., ("first_name", "last_name")
+    concatenated_fields = ()
+    concatenation_separator = " "
+
+    # Estimated search cost thresholds (see ``appsearch.cost``) above which a search is flagged as
+    # slow, must include a narrowing constraint, or is rejected.  ``None`` disables a threshold.
+    cost_warning_threshold = None
+    cost_narrowing_threshold = None
+    cost_rejection_threshold = None
+
+    # Rejects searches whose database EXPLAIN cost estimate is above this, where it is available
+    max_explain_cost = None
 
     _display_fields = None
     _fields = None
+    _sortable_fields = None
+    _facet_fields = None
+    _concatenated_fields = None
+    _value_dictionary_fields = None
+    _value_dictionaries = None
+    _display_version = None
+    _engine = None
+    _row_renderer = None
+    _related_models = None
+    _document_paths = None
+    _database_cycle = None
 
     def __init__(self, model):
         self.model = model
@@ -107,7 +237,21 @@ class ModelSearch(object):
 
         # Read the configured fields
         self._process_display_fields()
-        self._process_searchable_fields()
+        self._process_sortable_fields()
+        if not self._load_searchable_fields():
+            self._process_searchable_fields()
+            self._process_operators()
+        self._process_facet_fields()
+        self._process_concatenated_fields()
+        self._process_value_dictionary_fields()
+
+        if self.watermark_field is not None:
+            field = self.model._meta.get_field(self.watermark_field)
+            if not field.concrete or field.is_relation:
+                raise ValueError("Watermark field %r must be a local field." % self.watermark_field)
+
+        if self.denormalize and not isinstance(self.model._meta.pk, models.IntegerField):
+            raise ValueError("Denormalized searches require an integer primary key.")
 
         # Determine the ContentType in advance.
         try:
@@ -144,6 +288,39 @@ class ModelSearch(object):
             self._display_fields.append((capfirst(verbose_name), field_name, field))
         return self._display_fields
 
+    def _process_sortable_fields(self):
+        """
+        Maps the names of the display fields that results can be sorted by to 2-tuples of
+        (orm_path, nullable).
+
+        Unless ``sortable_fields`` explicitly lists the allowed display field names, only local
+        display fields backed by an index are sortable, so that a sorted page of results can be
+        read in index order instead of sorting the entire filtered result.
+
+        """
+
+        indexed_field_names = self._get_indexed_field_names()
+
+        self._sortable_fields = OrderedDict()
+        for _, field_name, field in self._display_fields:
+            if self.sortable_fields is not None:
+                if field_name not in self.sortable_fields:
+                    continue
+            elif LOOKUP_SEP in field_name or field.name not in indexed_field_names:
+                continue
+
+            if not getattr(field, "concrete", False):
+                continue
+
+            # Relationships are sorted by their raw key value, not the related Meta.ordering
+            path = LOOKUP_SEP.join(field_name.split(LOOKUP_SEP)[:-1] + [field.attname])
+            self._sortable_fields[field_name] = (path, is_nullable_path(self.model, path))
+        return self._sortable_fields
+
+    def _get_indexed_field_names(self):
+        """Returns the names of local fields that lead an index on the model's table."""
+        return get_indexed_field_names(self.model)
+
     def _process_searchable_fields(self):
         """
         Crunches the information in ``display_fields`` and the intricate ``search_fields`` to
@@ -156,6 +333,10 @@ class ModelSearch(object):
 
         self._fields = OrderedDict()
 
+        # The (model label, field name, prefix) that each derived verbose name is built from, so
+        # that registry snapshots can rebuild them in the active language
+        self._verbose_name_sources = {}
+
         # Get flattened sequence of 3-tuples: ([orm_path,...], verbose_name, Field)
         extended_info = self._get_field_info([], self.model, None, self.search_fields)
 
@@ -165,6 +346,118 @@ class ModelSearch(object):
         # Store each element's [::2] (that is, [0] and [2]) as a mapping to the field object
         self.field_types = dict(map(itemgetter(slice(0, None, 2)), extended_info))
 
+        # Index the obscured frontend hashes back to their ORM paths
+        self._field_hashes = {get_field_hash(orm_paths): orm_paths for orm_paths in self._fields}
+
+        # Term coercers are built on first use of each field
+        self._term_coercers = {}
+
+    def _load_searchable_fields(self):
+        """
+        Restores the indexes built by ``_process_searchable_fields()`` and
+        ``_process_operators()`` from the registry snapshot (see ``appsearch.snapshot``), returning
+        False when there is no current entry for them.
+
+        Verbose names are not read from the snapshot, which would freeze them in the language it
+        was built in: explicit ones are taken from ``search_fields`` as given, and derived ones are
+        rebuilt from their model field.
+
+        """
+
+        from .snapshot import get_entry
+
+        entry = get_entry(self)
+        if entry is None:
+            return False
+
+        self._fields = OrderedDict()
+        self._verbose_name_sources = {}
+        self.field_types = {}
+        self._field_hashes = {}
+        self._operators = {}
+        explicit_names = get_explicit_verbose_names(self.search_fields)
+        for info, verbose_name in zip(entry["fields"], explicit_names):
+            orm_paths = tuple(info["paths"])
+            if verbose_name is None:
+                source = tuple(info["verbose_name"])
+                verbose_name = get_verbose_name(apps.get_model(source[0]), *source[1:])
+                self._verbose_name_sources[orm_paths] = source
+            self._fields[orm_paths] = verbose_name
+            self.field_types[orm_paths] = apps.get_model(info["model"])._meta.get_field(
+                info["field"]
+            )
+            self._field_hashes[info["hash"]] = orm_paths
+            self._operators[orm_paths] = OrderedDict(map(tuple, info["operators"]))
+        self._term_coercers = {}
+        return True
+
+    def _process_operators(self):
+        """
+        Indexes the operators of every search field as a dictionary of UI labels to ORM lookups,
+        in the order of ``get_operator_choices()``, so that validating a constraint's operator is
+        a dictionary lookup.
+
+        """
+
+        self._operators = {}
+        for orm_paths in self._fields:
+            choices = self.get_operator_choices(field=orm_paths)
+            self._operators[orm_paths] = OrderedDict((label, lookup) for lookup, label in choices)
+
+    def _process_facet_fields(self):
+        """
+        Validates ``facet_fields``, a list of single-path ``search_fields`` entries with "choices"
+        or "boolean" classifications, into a list of their ORM path tuples.
+
+        """
+
+        self._facet_fields = []
+        for path in self.facet_fields:
+            orm_paths = (path,) if isinstance(path, str) else tuple(path)
+            if orm_paths not in self._fields or len(orm_paths) != 1:
+                raise ValueError("Facet field %r is not a single-path search field." % (path,))
+            if self.get_field_classification(orm_paths) not in ("choices", "boolean"):
+                raise ValueError("Facet field %r must have choices or be boolean." % (path,))
+            self._facet_fields.append(orm_paths)
+        return self._facet_fields
+
+    def _process_concatenated_fields(self):
+        """
+        Validates ``concatenated_fields``, a list of compound text ``search_fields`` entries whose
+        paths all end on the same model row, into a set of their ORM path tuples.
+
+        """
+
+        self._concatenated_fields = set()
+        for paths in self.concatenated_fields:
+            orm_paths = tuple(paths)
+            if orm_paths not in self._fields or len(orm_paths) < 2:
+                raise ValueError("Concatenated field %r is not a compound search field." % (paths,))
+            if self.get_field_classification(orm_paths) != "text":
+                raise ValueError("Concatenated field %r must be text." % (paths,))
+            if len({path.rpartition(LOOKUP_SEP)[0] for path in orm_paths}) != 1:
+                raise ValueError("Concatenated field %r must not span relationships." % (paths,))
+            self._concatenated_fields.add(orm_paths)
+        return self._concatenated_fields
+
+    def _process_value_dictionary_fields(self):
+        """
+        Validates ``value_dictionary_fields``, a list of single-path text ``search_fields`` entries,
+        into a set of their ORM path tuples.
+
+        """
+
+        self._value_dictionary_fields = set()
+        self._value_dictionaries = {}
+        for path in self.value_dictionary_fields:
+            orm_paths = (path,) if isinstance(path, str) else tuple(path)
+            if orm_paths not in self._fields or len(orm_paths) != 1:
+                raise ValueError("Dictionary field %r is not a single-path search field." % (path,))
+            if self.get_field_classification(orm_paths) != "text":
+                raise ValueError("Dictionary field %r must be text." % (path,))
+            self._value_dictionary_fields.add(orm_paths)
+        return self._value_dictionary_fields
+
     def _get_field_info(self, orm_path_bits, model, related_name, field_list):  # noqa: C901
         """
         Recurses the fields listed on the model to provide a complete index of their ORM paths and
@@ -251,6 +544,7 @@ class ModelSearch(object):
                 # Raw field name or 2-tuple
 
                 field = None
+                source = None
                 # Check for a 2-tuple of ("Friendly name", "field_name")
                 if isinstance(field_name, (tuple, list)):
                     verbose_name, field_name = field_name
@@ -258,12 +552,8 @@ class ModelSearch(object):
                     # Derive a verbose name.  If the field comes from a model other than the base
                     # model, prepend the relate model's own verbose name.
                     field = related_model._meta.get_field(field_name)
-
-                    if related_name:
-                        verbose_name_bits = [related_model._meta.verbose_name, field.verbose_name]
-                    else:
-                        verbose_name_bits = [field.verbose_name]
-                    verbose_name = " ".join(map(pretty_name, verbose_name_bits))
+                    source = (related_model._meta.label, field_name, bool(related_name))
+                    verbose_name = get_verbose_name(related_model, field_name, bool(related_name))
 
                 if not isinstance(field_name, (tuple, list)):
                     field_name = (field_name,)
@@ -281,6 +571,8 @@ class ModelSearch(object):
 
                 orm_info = tuple("__".join(orm_path_bits + [component]) for component in field_name)
                 sub_fields.append([orm_info, verbose_name, field])
+                if source is not None:
+                    self._verbose_name_sources[orm_info] = source
                 # print orm_info, field.name, related_model, verbose_name
 
             # print sub_fields
@@ -319,6 +611,19 @@ class ModelSearch(object):
 
         return list(choices)
 
+    def get_operator_lookups(self, field=None, hash=None):
+        """
+        Returns the precomputed dictionary of UI labels to ORM lookups, such as
+        {"= equal": "iexact", ...}, for the given ``field`` ORM path tuple, or given the ``hash``
+        representing that field.  Unknown fields get an empty dictionary.  The dictionary is shared
+        by every search and must not be modified.
+
+        """
+
+        if hash is not None:
+            field = self._field_hashes.get(hash)
+        return self._operators.get(field, {})
+
     def get_field_classification(self, field):
         """
         Use field (either a proper Django ``Field`` instance or a field definition tuple from the
@@ -360,26 +665,208 @@ class ModelSearch(object):
 
         # Perform a sha hash on the ORM path to get something unique and obscured for the frontend
         def encode_value(pair):
-            return (sha(",".join(pair[0]).encode("utf-8")).hexdigest(),) + tuple(pair[1:])
+            return (get_field_hash(pair[0]),) + tuple(pair[1:])
 
         return map(encode_value, choices)
 
     def reverse_field_hash(self, hash):
-        """Returns the hash of field ORM paths derived from the initial configuration."""
+        """Returns the field ORM paths for a hash derived from the initial configuration."""
 
-        hashes = list(map(itemgetter(0), self.get_searchable_field_choices()))
         try:
-            return list(self._fields.keys())[hashes.index(hash)]
-        except IndexError:
-            # raise ValueError("Unknown field hash")
-            # TODO Fix me!
-            log.exception("Unknown field hash")
+            return self._field_hashes[hash]
+        except KeyError:
+            log.warning("Unknown field hash %r", hash)
             return None
 
+    def get_related_models(self):
+        """
+        Returns the set of models, other than the registered one, that are traversed by the
+        configured search and display field paths.
+
+        """
+
+        if self._related_models is None:
+            paths = chain(
+                chain.from_iterable(self._fields), map(itemgetter(1), self._display_fields)
+            )
+            related_models = set()
+            for path in paths:
+                model = self.model
+                for bit in path.split(LOOKUP_SEP)[:-1]:
+                    model = get_model_at_related_field(model, bit)
+                    related_models.add(model)
+            related_models.discard(self.model)
+            self._related_models = related_models
+        return self._related_models
+
+    def get_document_paths(self):
+        """
+        Returns the related text search paths answered from search documents, mapped to whether
+        they cross a many-valued relationship.  Empty unless ``denormalize`` is set.
+
+        """
+
+        if self._document_paths is None:
+            from .documents import get_document_paths
+
+            self._document_paths = get_document_paths(self) if self.denormalize else {}
+        return self._document_paths
+
+    def get_document_models(self):
+        """Returns the set of related models whose values are copied into search documents."""
+
+        document_models = set()
+        for path in self.get_document_paths():
+            model = self.model
+            for bit in path.split(LOOKUP_SEP)[:-1]:
+                model = get_model_at_related_field(model, bit)
+                document_models.add(model)
+        document_models.discard(self.model)
+        return document_models
+
+    def get_engine(self):
+        """
+        Returns the ``appsearch.engine.SearchEngine`` validating and building queries for this
+        configuration.  The instance is kept so that its resolved fields and operators are shared
+        by every search.
+
+        """
+
+        if self._engine is None:
+            from .engine import SearchEngine
+
+            self._engine = SearchEngine(self)
+        return self._engine
+
+    def get_term_coercer(self, field):
+        """
+        Returns the ``appsearch.terms.TermCoercer`` normalizing search terms for ``field``, an ORM
+        path tuple.  Each coercer is built once and shared by every search.
+
+        """
+
+        try:
+            return self._term_coercers[field]
+        except KeyError:
+            from .terms import TermCoercer
+
+            coercer = self._term_coercers[field] = TermCoercer(self, field)
+            return coercer
+
+    def get_row_renderer(self):
+        """
+        Returns the ``appsearch.rendering.RowRenderer`` compiled from the display fields and
+        their escaping policy in ``safe_display_fields``.
+
+        """
+
+        if self._row_renderer is None:
+            from .rendering import RowRenderer
+
+            self._row_renderer = RowRenderer.for_configuration(self)
+        return self._row_renderer
+
     def get_display_fields(self):
         """Returns the list of labels for the display fields."""
         return list(map(itemgetter(0), self._display_fields))
 
+    def get_facet_fields(self):
+        """Returns the list of ORM path tuples for the configured ``facet_fields``."""
+        return list(self._facet_fields)
+
+    def get_facet_counts(self, queryset, field):
+        """
+        Returns a list of 2-tuples of (value, count) for the facet ``field`` within ``queryset``,
+        ordered by descending count and limited to ``facet_limit`` values.
+
+        """
+
+        path = field[0]
+        counts = (
+            queryset.order_by()
+            .values_list(path)
+            .annotate(facet_count=Count("pk", distinct=True))
+            .order_by("-facet_count", path)
+        )
+        return list(counts[: self.facet_limit])
+
+    def get_watermark_field(self):
+        """Returns the ``watermark_field`` name, defaulting to the primary key."""
+        return self.watermark_field or "pk"
+
+    def clean_watermark(self, value):
+        """
+        Returns ``value``, e.g., a ``since`` querystring parameter, converted by the watermark
+        field's ``to_python()``, raising ``appsearch.engine.SearchSpecError`` when it isn't a valid
+        value of the field.  ``None`` is returned as is.
+
+        """
+
+        from .engine import SearchSpecError
+
+        if value is None:
+            return None
+        if self.watermark_field is None:
+            field = self.model._meta.pk
+        else:
+            field = self.model._meta.get_field(self.watermark_field)
+        try:
+            return field.to_python(value)
+        except (TypeError, ValueError, ValidationError):
+            raise SearchSpecError("Invalid 'since' watermark {!r}.".format(value))
+
+    def filter_since(self, queryset, watermark):
+        """
+        Returns ``queryset`` limited to the objects beyond ``watermark``, a previous value of the
+        watermark field.  A ``None`` watermark leaves the queryset unlimited.
+
+        """
+
+        if watermark is None:
+            return queryset
+        return queryset.filter(**{self.get_watermark_field() + "__gt": watermark})
+
+    def get_watermark(self, queryset, default=None):
+        """Returns the highest watermark field value in ``queryset``, or ``default`` if empty."""
+
+        watermark = queryset.aggregate(watermark=Max(self.get_watermark_field()))["watermark"]
+        return default if watermark is None else watermark
+
+    def get_sortable_fields(self):
+        """Returns the list of display field names that results can be sorted by."""
+        return list(self._sortable_fields)
+
+    def get_sort_field(self, sort):
+        """
+        Returns a 3-tuple of (orm_path, descending, nullable) for a ``sort`` value, which is a
+        sortable display field name with an optional "-" prefix for descending order.  A
+        ``ValueError`` is raised for fields that aren't sortable.
+
+        """
+
+        descending = sort.startswith("-")
+        try:
+            path, nullable = self._sortable_fields[sort[1:] if descending else sort]
+        except KeyError:
+            raise ValueError("{!r} is not a sortable field".format(sort))
+        return path, descending, nullable
+
+    def get_ordering(self, sort):
+        """
+        Returns the ``order_by()`` arguments for a ``sort`` value.  The primary key is appended as
+        a tiebreaker so that the order is stable across pages, and null values sort last.
+
+        """
+
+        path, descending, nullable = self.get_sort_field(sort)
+        if nullable:
+            expression = (
+                F(path).desc(nulls_last=True) if descending else F(path).asc(nulls_last=True)
+            )
+        else:
+            expression = "-" + path if descending else path
+        return [expression, "pk"]
+
     def user_has_perm(self, user):
         """
         Returns ``True`` or ``False`` to indicate definitive user permission
@@ -390,6 +877,125 @@ class ModelSearch(object):
         permission = "{}.{}".format(self.model._meta.app_label, permission)
         return user.has_perm(permission)
 
+    def get_database_aliases(self, request, user):
+        """
+        Hook returning the list of database aliases searches may read from, in round-robin order.
+        By default this is ``database`` as a list, and an empty list leaves the choice to the
+        database routers.
+
+        """
+
+        if self.database is None:
+            return []
+        if isinstance(self.database, str):
+            return [self.database]
+        return list(self.database)
+
+    def check_replica(self, alias):
+        """
+        Hook to verify that the replica ``alias`` is fit to serve searches, e.g., that its
+        replication lag is acceptable.  Replicas failing the check are skipped.
+
+        """
+
+        return True
+
+    def get_database(self, request, user):
+        """
+        Returns the database alias for a search, taking the configured aliases in turn and
+        skipping those failing ``check_replica()``.  Falls back to the primary database for the
+        model when no alias passes, and returns ``None`` when no aliases are configured.
+
+        """
+
+        aliases = self.get_database_aliases(request, user)
+        if not aliases:
+            return None
+
+        with _database_cycle_lock:
+            if self._database_cycle is None:
+                self._database_cycle = count()
+            start = next(self._database_cycle) % len(aliases)
+        candidates = aliases[start:] + aliases[:start]
+
+        for alias in candidates:
+            if self.check_replica(alias):
+                return alias
+            log.warning("Database %r failed its replica check for %s", alias, self.verbose_name)
+        return router.db_for_write(self.model)
+
+    def check_search_cost(self, constraints, queryset=None):
+        """
+        Checks the cleaned ``constraints`` against the configured cost thresholds, returning a list
+        of warning messages, or raising ``appsearch.engine.SearchSpecError`` when the search must be
+        narrowed or is rejected.  ``queryset`` is the filtered queryset to EXPLAIN, if any.
+
+        """
+
+        from .cost import check_cost
+
+        return check_cost(self, constraints, queryset)
+
+    def get_value_dictionary(self, field):
+        """
+        Returns the distinct values of a ``value_dictionary_fields`` entry, read from the column's
+        own table and reused until ``value_dictionary_timeout`` passes or
+        ``clear_value_dictionary()`` is called, or ``None`` when there are too many of them.
+
+        """
+
+        now = time.monotonic()
+        entry = self._value_dictionaries.get(field)
+        if entry is not None and entry[0] > now:
+            return entry[1]
+
+        model_field = resolve_orm_path(self.model, field[0])
+        queryset = model_field.model._default_manager.order_by().values_list(model_field.name)
+        values = [value for (value,) in queryset.distinct()[: self.value_dictionary_max_size + 1]]
+        if len(values) > self.value_dictionary_max_size:
+            log.info("Too many values in %s to keep a dictionary of", field[0])
+            values = None
+        self._value_dictionaries[field] = (now + self.value_dictionary_timeout, values)
+        return values
+
+    def clear_value_dictionary(self, field=None):
+        """Discards the dictionary of ``field``, or all of them, so it is reloaded on next use."""
+
+        if field is None:
+            self._value_dictionaries.clear()
+        else:
+            self._value_dictionaries.pop(field, None)
+
+    def get_value_dictionary_models(self):
+        """Returns the set of models holding the columns of ``value_dictionary_fields``."""
+        return {
+            resolve_orm_path(self.model, field[0]).model for field in self._value_dictionary_fields
+        }
+
+    def get_suggestions(self, field, prefix, request=None, user=None, limit=None):
+        """
+        Returns the existing values of ``field`` that start with ``prefix``, for typeahead.  See
+        ``appsearch.suggestions.get_suggestions()``.
+
+        """
+
+        from .suggestions import get_suggestions
+
+        return get_suggestions(self, field, prefix, request, user, limit)
+
+    def get_suggestion_scope(self, request, user):
+        """
+        Returns the hashable scope that the cached value lists of ``cached_suggestion_fields`` are
+        shared within.  Lists are read from ``get_queryset(request, user)``, so each scope must
+        only hold users whose querysets match the same rows.  By default this is the user's
+        primary key, keeping a list per user; configurations whose ``get_queryset()`` scopes rows
+        more coarsely, or not at all, can share lists more widely by returning, e.g., the user's
+        company id or a constant.
+
+        """
+
+        return getattr(user, "pk", None)
+
     def get_queryset(self, request, user):
         """
         Hook for subclasses to modify querysets.  By default, this method returns the default
@@ -399,6 +1005,32 @@ class ModelSearch(object):
         """
         return self.model.objects.all()
 
+    def get_objects_data(self, objects):
+        """
+        Returns the list of ``get_object_data()`` rows for ``objects``, read from and stored in the
+        row cache when ``row_cache_timeout`` is set.
+
+        """
+
+        if self.row_cache_timeout is None:
+            return [self.get_object_data(obj) for obj in objects]
+
+        from .rowcache import get_rows
+
+        return get_rows(self, objects)
+
+    def get_row_version(self, obj):
+        """
+        Returns the version of ``obj`` its cached display row is stored under, by default the
+        value of ``watermark_field``.  Objects without a version rely on the save signals alone to
+        discard their rows.
+
+        """
+
+        if self.watermark_field is None:
+            return None
+        return getattr(obj, self.watermark_field)
+
     def get_object_data(self, obj):
         """
         Returns a list of values retrieved from ``obj``, automatically fetched according to the
@@ -421,7 +1053,9 @@ class ModelSearch(object):
 
         # Convert the first column's data into a link to the model instance
         if hasattr(obj, "get_absolute_url"):
-            data[0] = "<a href='{}'>{}</a>".format(obj.get_absolute_url(), data[0])
+            if self._display_fields[0][1] in self.safe_display_fields:
+                data[0] = mark_safe(data[0])
+            data[0] = format_html("<a href='{}'>{}</a>", obj.get_absolute_url(), data[0])
 
         return data
 
@@ -433,6 +1067,12 @@ class SearchRegistry(object):
 
     _registry = None
 
+    # Default limits on the number of constraints in a search, the length of a term and the number
+    # of values in an "is one of" list, for configurations that don't set their own
+    max_constraints = 100
+    max_term_length = 1000
+    max_list_size = 10000
+
     def __init__(self):
         self._registry = {}
 
@@ -478,7 +1118,35 @@ class SearchRegistry(object):
         """
         id_string = ".".join((model._meta.app_label, model.__name__)).lower()
         log.debug("Registering %r for appsearch configuration class %r", id_string, configuration)
-        self._registry[id_string] = configuration(model)
+        if id_string in self._registry:
+            from .signals import disconnect_tracking
+
+            disconnect_tracking(self._registry[id_string])
+        self._registry[id_string] = configuration = configuration(model)
+
+        for name in PAYLOAD_LIMITS:
+            if getattr(configuration, name) is None:
+                setattr(configuration, name, getattr(self, name))
+
+        if configuration.track_saved_searches:
+            from .signals import connect_saved_search_tracking
+
+            connect_saved_search_tracking(configuration)
+
+        if configuration.denormalize:
+            from .signals import connect_search_document_tracking
+
+            connect_search_document_tracking(configuration)
+
+        if configuration.row_cache_timeout is not None:
+            from .signals import connect_row_cache_tracking
+
+            connect_row_cache_tracking(configuration)
+
+        if configuration.value_dictionary_fields:
+            from .signals import connect_value_dictionary_tracking
+
+            connect_value_dictionary_tracking(configuration)
 
     def filter_configurations_by_permission(self, user):
         configurations = self._registry.values()
@@ -0,0 +1,89 @@
+"""rowcache.py: Cache of the display rows built for search results"""
+
+import logging
+from hashlib import sha1 as sha
+
+from django.core.cache import caches
+
+
+log = logging.getLogger(__name__)
+
+
+def get_display_version(configuration):
+    """
+    Returns a digest of the configuration's display settings, which is part of every row key so
+    that changing the displayed columns never serves rows of the old shape.
+
+    """
+
+    if configuration._display_version is None:
+        display = [field_name for _, field_name, _ in configuration._display_fields]
+        bits = [
+            configuration.model._meta.label,
+            repr(display),
+            repr(configuration.safe_display_fields),
+        ]
+        configuration._display_version = sha("\n".join(bits).encode("utf-8")).hexdigest()
+    return configuration._display_version
+
+
+def get_generation_key(configuration):
+    return "appsearch.rows.{}.generation".format(get_display_version(configuration))
+
+
+def get_row_key(configuration, generation, pk, version):
+    """Returns the cache key of the row of object ``pk`` at ``version``."""
+
+    bits = [get_display_version(configuration), str(generation), str(pk), str(version)]
+    return "appsearch.rows." + sha("\n".join(bits).encode("utf-8")).hexdigest()
+
+
+def get_rows(configuration, objects):
+    """
+    Returns the display rows of ``objects`` through ``configuration.get_object_data()``, reading
+    the rows of warm objects from the configuration's row cache in one ``get_many()`` and storing
+    the rest with one ``set_many()``.
+
+    """
+
+    cache = caches[configuration.row_cache_alias]
+    objects = list(objects)
+    generation = cache.get(get_generation_key(configuration), 0)
+    keys = [
+        get_row_key(configuration, generation, obj.pk, configuration.get_row_version(obj))
+        for obj in objects
+    ]
+    cached = cache.get_many(keys)
+
+    rows = []
+    missing = {}
+    for key, obj in zip(keys, objects):
+        row = cached.get(key)
+        if row is None:
+            row = missing[key] = configuration.get_object_data(obj)
+        rows.append(row)
+
+    if missing:
+        cache.set_many(missing, configuration.row_cache_timeout)
+    log.debug("Built %d of %d %s rows", len(missing), len(rows), configuration.model.__name__)
+    return rows
+
+
+def delete_row(configuration, obj):
+    """Discards the cached row of ``obj`` at its current version."""
+
+    cache = caches[configuration.row_cache_alias]
+    generation = cache.get(get_generation_key(configuration), 0)
+    cache.delete(get_row_key(configuration, generation, obj.pk, configuration.get_row_version(obj)))
+
+
+def expire_rows(configuration):
+    """Discards every cached row of ``configuration`` by moving on to a new key generation."""
+
+    cache = caches[configuration.row_cache_alias]
+    key = get_generation_key(configuration)
+    cache.add(key, 0, None)
+    try:
+        cache.incr(key)
+    except ValueError:  # Evicted in between
+        cache.set(key, 1, None)
@@ -0,0 +1,152 @@
+"""signals.py: Model change tracking for registered searches"""
+
+import logging
+from collections import defaultdict
+
+from django.contrib.contenttypes.models import ContentType
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete, pre_save
+
+
+log = logging.getLogger(__name__)
+
+# The (signal, sender, dispatch_uid) of each receiver connected on behalf of a configuration,
+# keyed by the configuration's id()
+_connections = defaultdict(list)
+
+
+def _connect(configuration, signal, receiver, sender, dispatch_uid):
+    signal.connect(receiver, sender=sender, weak=False, dispatch_uid=dispatch_uid)
+    _connections[id(configuration)].append((signal, sender, dispatch_uid))
+
+
+def disconnect_tracking(configuration):
+    """
+    Disconnects every receiver the ``connect_*_tracking()`` functions connected on behalf of
+    ``configuration``, e.g., when it is replaced in its registry or a test discards it.
+
+    """
+
+    for signal, sender, dispatch_uid in _connections.pop(id(configuration), ()):
+        signal.disconnect(sender=sender, dispatch_uid=dispatch_uid)
+
+
+def connect_saved_search_tracking(configuration):
+    """
+    Marks materialized saved searches on ``configuration``'s model dirty whenever an instance of
+    that model, or of any model its search and display paths reach, is saved or deleted.
+
+    """
+
+    def mark_dirty(sender, **kwargs):
+        from .models import SavedSearch
+
+        count = SavedSearch.objects.filter(
+            content_type=ContentType.objects.get_for_model(configuration.model),
+            materialize=True,
+            is_dirty=False,
+        ).update(is_dirty=True)
+        if count:
+            log.debug("Marked %d saved searches dirty after a %s change", count, sender.__name__)
+
+    for model in {configuration.model} | configuration.get_related_models():
+        dispatch_uid = "appsearch.saved_searches.{}.{}".format(id(configuration), model._meta.label)
+        for signal in (post_save, post_delete):
+            _connect(configuration, signal, mark_dirty, model, dispatch_uid)
+
+
+def connect_search_document_tracking(configuration):
+    """
+    Keeps the search documents of a ``ModelSearch`` with ``denormalize`` set current as objects of
+    its model, or of the models along its document paths, are saved, deleted or re-linked.
+
+    """
+
+    from .documents import delete_search_documents, get_affected_pks, update_search_documents
+
+    def collect_documents(sender, instance, **kwargs):
+        # A change can unlink objects from the instance, so find the affected objects beforehand
+        if not isinstance(instance, configuration.model) and instance.pk is not None:
+            instance._appsearch_document_pks = get_affected_pks(configuration, instance)
+
+    def update_documents(sender, instance, **kwargs):
+        pks = get_affected_pks(configuration, instance)
+        pks |= instance.__dict__.pop("_appsearch_document_pks", set())
+        update_search_documents(configuration, pks)
+
+    def delete_documents(sender, instance, **kwargs):
+        if isinstance(instance, configuration.model):
+            delete_search_documents(configuration, [instance.pk])
+        else:
+            update_search_documents(
+                configuration, instance.__dict__.pop("_appsearch_document_pks", ())
+            )
+
+    def relink_documents(sender, instance, action, model, pk_set, **kwargs):
+        pks = get_affected_pks(configuration, instance)
+        for obj in model._default_manager.filter(pk__in=pk_set or ()):
+            pks |= get_affected_pks(configuration, obj)
+
+        if action.startswith("pre_"):
+            instance._appsearch_document_pks = pks
+        else:
+            pks |= instance.__dict__.pop("_appsearch_document_pks", set())
+            update_search_documents(configuration, pks)
+
+    models = {configuration.model} | configuration.get_document_models()
+    for model in models:
+        dispatch_uid = "appsearch.search_documents.{}.{}".format(
+            id(configuration), model._meta.label
+        )
+        _connect(configuration, pre_save, collect_documents, model, dispatch_uid)
+        _connect(configuration, post_save, update_documents, model, dispatch_uid)
+        _connect(configuration, pre_delete, collect_documents, model, dispatch_uid)
+        _connect(configuration, post_delete, delete_documents, model, dispatch_uid)
+        for field in model._meta.local_many_to_many:
+            if field.related_model in models:
+                through = field.remote_field.through
+                _connect(configuration, m2m_changed, relink_documents, through, dispatch_uid)
+
+
+def connect_value_dictionary_tracking(configuration):
+    """
+    Discards the value dictionaries of a ``ModelSearch`` whenever an object of a model holding one
+    of its ``value_dictionary_fields`` columns is saved or deleted.
+
+    """
+
+    def clear_dictionaries(sender, **kwargs):
+        configuration.clear_value_dictionary()
+
+    for model in configuration.get_value_dictionary_models():
+        dispatch_uid = "appsearch.value_dictionaries.{}.{}".format(
+            id(configuration), model._meta.label
+        )
+        for signal in (post_save, post_delete):
+            _connect(configuration, signal, clear_dictionaries, model, dispatch_uid)
+
+
+def connect_row_cache_tracking(configuration):
+    """
+    Discards the cached display row of an object of a ``ModelSearch`` with ``row_cache_timeout``
+    set when it is saved or deleted, and every cached row of the configuration when an object of
+    a related model is.
+
+    """
+
+    from .rowcache import delete_row, expire_rows
+
+    def discard_row(sender, instance, **kwargs):
+        delete_row(configuration, instance)
+
+    def discard_rows(sender, **kwargs):
+        expire_rows(configuration)
+
+    uid = "appsearch.row_cache.{}.{}"
+    dispatch_uid = uid.format(id(configuration), configuration.model._meta.label)
+    for signal in (post_save, post_delete):
+        _connect(configuration, signal, discard_row, configuration.model, dispatch_uid)
+
+    for model in configuration.get_related_models():
+        dispatch_uid = uid.format(id(configuration), model._meta.label)
+        for signal in (post_save, post_delete):
+            _connect(configuration, signal, discard_rows, model, dispatch_uid)
@@ -0,0 +1,209 @@
+"""snapshot.py: Prebuilt registry field indexes shared by worker processes"""
+
+import json
+import logging
+import os
+import tempfile
+from collections import OrderedDict
+from hashlib import sha1 as sha
+
+from django.apps import apps
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.db import OperationalError, ProgrammingError
+
+
+log = logging.getLogger(__name__)
+
+# Bumped whenever the snapshot format changes, so that older files are rebuilt
+SNAPSHOT_VERSION = 2
+
+# The snapshot read by this process, and whether it needs rebuilding
+_state = {"loaded": False, "snapshot": None, "stale": False}
+
+
+def get_snapshot_path():
+    """Returns the ``APPSEARCH_SNAPSHOT_PATH`` setting, or ``None`` when snapshots are disabled."""
+    return getattr(settings, "APPSEARCH_SNAPSHOT_PATH", None)
+
+
+def get_schema_fingerprint():
+    """Returns a digest of the fields and relationships of every installed model."""
+
+    bits = []
+    for model in sorted(apps.get_models(include_auto_created=True), key=lambda m: m._meta.label):
+        for field in model._meta.get_fields(include_hidden=True):
+            related_model = getattr(field.related_model, "_meta", None)
+            bits.append(
+                "{}.{}:{}:{}".format(
+                    model._meta.label,
+                    field.name,
+                    field.__class__.__name__,
+                    related_model.label if related_model else "",
+                )
+            )
+    return sha("\n".join(bits).encode("utf-8")).hexdigest()
+
+
+def get_configuration_fingerprint(configuration):
+    """Returns a digest of the ``ModelSearch`` class and its ``search_fields``."""
+
+    cls = configuration.__class__
+    bits = [
+        configuration.model._meta.label,
+        "{}.{}".format(cls.__module__, cls.__qualname__),
+        repr(configuration.search_fields),
+    ]
+    return sha("\n".join(bits).encode("utf-8")).hexdigest()
+
+
+def load_snapshot(path=None):
+    """
+    Returns the snapshot stored at ``path`` (by default, ``APPSEARCH_SNAPSHOT_PATH``), or ``None``
+    if it is missing, of another format version, or was built for a different model schema.
+
+    """
+
+    path = path or get_snapshot_path()
+    if not path:
+        return None
+    try:
+        with open(path) as f:
+            snapshot = json.load(f)
+    except (OSError, ValueError):
+        log.info("No readable search registry snapshot at %s", path)
+        return None
+
+    if snapshot.get("version") != SNAPSHOT_VERSION:
+        log.info("The search registry snapshot at %s has an old format", path)
+        return None
+    if snapshot.get("fingerprint") != get_schema_fingerprint():
+        log.info("The search registry snapshot at %s was built for another schema", path)
+        return None
+
+    # Read every registered model's content type in one query, which registrations then reuse
+    labels = snapshot["configurations"].keys()
+    models = [model for model in map(get_model, labels) if model is not None]
+    try:
+        ContentType.objects.get_for_models(*models)
+    except (ProgrammingError, OperationalError):
+        pass
+    return snapshot
+
+
+def get_model(label):
+    try:
+        return apps.get_model(label)
+    except LookupError:
+        return None
+
+
+def get_entry(configuration):
+    """
+    Returns the snapshot entry of ``configuration`` when it is current, loading the snapshot on
+    first use.  A missing or outdated entry marks the snapshot for rebuilding.
+
+    """
+
+    if not get_snapshot_path():
+        return None
+    if not _state["loaded"]:
+        _state["snapshot"] = load_snapshot()
+        _state["stale"] = _state["snapshot"] is None
+        _state["loaded"] = True
+    if _state["snapshot"] is None:
+        return None
+
+    entry = _state["snapshot"]["configurations"].get(configuration.model._meta.label)
+    if entry is None or entry["fingerprint"] != get_configuration_fingerprint(configuration):
+        _state["stale"] = True
+        return None
+    return entry
+
+
+def dump_configuration(configuration):
+    """
+    Returns the snapshot entry of a processed ``ModelSearch``.  Instead of a field's verbose name,
+    which can be a lazy translation, the entry holds the model label, field name and prefix flag
+    that a derived verbose name is rebuilt from, or None for one given in ``search_fields``.
+
+    """
+
+    hashes = {paths: field_hash for field_hash, paths in configuration._field_hashes.items()}
+    fields = []
+    for paths in configuration._fields:
+        field = configuration.field_types[paths]
+        fields.append(
+            OrderedDict(
+                [
+                    ("paths", list(paths)),
+                    ("verbose_name", configuration._verbose_name_sources.get(paths)),
+                    ("model", field.model._meta.label),
+                    ("field", field.name),
+                    ("hash", hashes[paths]),
+                    (
+                        "operators",
+                        list(configuration.get_operator_lookups(field=paths).items()),
+                    ),
+                ]
+            )
+        )
+
+    content_type = getattr(configuration, "_content_type", None)
+    return OrderedDict(
+        [
+            ("fingerprint", get_configuration_fingerprint(configuration)),
+            ("content_type", content_type.pk if content_type else None),
+            ("fields", fields),
+        ]
+    )
+
+
+def dump_registry(registry):
+    """Returns the snapshot of every configuration in ``registry``."""
+
+    configurations = OrderedDict()
+    for key in sorted(registry):
+        configuration = registry[key]
+        configurations[configuration.model._meta.label] = dump_configuration(configuration)
+    return OrderedDict(
+        [
+            ("version", SNAPSHOT_VERSION),
+            ("fingerprint", get_schema_fingerprint()),
+            ("configurations", configurations),
+        ]
+    )
+
+
+def write_snapshot(registry, path=None):
+    """
+    Writes the snapshot of ``registry`` to ``path`` (by default, ``APPSEARCH_SNAPSHOT_PATH``),
+    replacing any previous file atomically so that starting workers never read half of it.
+
+    """
+
+    path = path or get_snapshot_path()
+    snapshot = dump_registry(registry)
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".appsearch-snapshot-")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(snapshot, f, indent=1)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+    _state.update(loaded=True, snapshot=snapshot, stale=False)
+    count = len(snapshot["configurations"])
+    log.info("Wrote the search registry snapshot of %d models to %s", count, path)
+    return snapshot
+
+
+def refresh_snapshot(registry):
+    """Rewrites the snapshot if this process found it missing or stale."""
+
+    if get_snapshot_path() and _state["stale"]:
+        try:
+            write_snapshot(registry)
+        except OSError as e:
+            log.warning("Unable to write the search registry snapshot: %s", e)
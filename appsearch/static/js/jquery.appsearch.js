@@ -62,12 +62,83 @@
                     termInputs.filter('.end-term').slideUp('fast');
                 }
             }
+            // list operator; offer to read the values from a file
+            constraintForm.find('.term-file').toggle(options.listOperators.indexOf(value) != -1);
+        });
+        form.on('submit.appsearch', function(){
+            // Lists and values files can outgrow a URL, so searches using them are sent as a
+            // multipart POST instead of a GET
+            var post = form.find('.term-file input[type=file]').filter(function(){
+                return this.files && this.files.length > 0;
+            }).size() > 0;
+            form.find('.constraint-operator select').each(function(){
+                post = post || options.listOperators.indexOf($(this).val()) != -1;
+            });
+            form.attr('method', post ? 'post' : 'get');
+            form.find('input[name=csrfmiddlewaretoken]').prop('disabled', !post);
+        });
+
+        var _suggestion_cache = {};
+        var _suggestion_timer = null;
+        form.on('input.appsearch', '.begin-term input[type=text]', function(){
+            // Ask for typeahead suggestions once the user stops typing, reusing earlier answers
+            if (!options.suggestionUrl) {
+                return;
+            }
+            var input = $(this);
+            var params = {
+                'model': options.modelSelect.val(),
+                'field': input.closest('.constraint-form').find('.constraint-field select').val(),
+                'term': $.trim(input.val())
+            };
+            clearTimeout(_suggestion_timer);
+            if (params.term.length < options.minSuggestionLength) {
+                return;
+            }
+            _suggestion_timer = setTimeout(function(){
+                var key = [params.model, params.field, params.term.toLowerCase()].join('\n');
+                if (_suggestion_cache.hasOwnProperty(key)) {
+                    form.trigger('show-suggestions', [input, _suggestion_cache[key]]);
+                    return;
+                }
+                $.getJSON(options.suggestionUrl, params, function(data){
+                    _suggestion_cache[key] = data.suggestions;
+                    form.trigger('show-suggestions', [input, data.suggestions]);
+                });
+            }, options.suggestionDelay);
+        });
+        form.on('show-suggestions.appsearch', function(e, input, suggestions){
+            // Offer the suggestions through a <datalist> attached to the term input
+            var list = $(document.getElementById(input.attr('list')));
+            if (list.size() == 0) {
+                list = $('<datalist />').attr('id', input.attr('id') + '-suggestions').insertAfter(input);
+                input.attr('list', list.attr('id'));
+            }
+            list.empty();
+            for (var i = 0; i < suggestions.length; i++) {
+                list.append(_option_template.clone().val(suggestions[i]));
+            }
+        });
+
+        form.on('change.appsearch', '.constraint-open-groups select, .constraint-close-groups select', function(){
+            form.trigger('update-group-depth');
+        });
+        form.on('update-group-depth.appsearch', function(){
+            // Indent each constraint by the number of parenthesized groups it sits in
+            var depth = 0;
+            form.find('.constraint-form').each(function(){
+                var constraintForm = $(this);
+                depth += parseInt(constraintForm.find('.constraint-open-groups select').val() || 0, 10);
+                constraintForm.css('margin-left', Math.max(depth, 0) * options.groupIndent);
+                depth -= parseInt(constraintForm.find('.constraint-close-groups select').val() || 0, 10);
+            });
         });
 
         form.on('configure-formset.appsearch', function(){
             // Re-initialize the formset after stripping out the add/remove links
             form.find('.add-row,.delete-row').remove(); // formset.js
             form.find('.constraint-form').formset(options.formsetOptions); // formset.js
+            form.trigger('update-group-depth');
         });
         form.on('update-field-list.appsearch', function(e){
             // Default handler that tries to call a user-supplied function or else the default one
@@ -183,6 +254,12 @@
 
         'termlessOperators': ["exists", "doesn't exist"],
         'twoTermOperators': ["between"],
+        'listOperators': ["is one of"],
+        'groupIndent': 20,
+
+        'suggestionUrl': null,
+        'suggestionDelay': 250,
+        'minSuggestionLength': 1,
 
         'formsetOptions': null,
     };
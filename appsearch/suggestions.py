@@ -0,0 +1,117 @@
+"""suggestions.py: Typeahead suggestions of existing search terms"""
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from django.db.models.constants import LOOKUP_SEP
+
+
+log = logging.getLogger(__name__)
+
+# Most value lists kept in process by ``value_cache``
+VALUE_CACHE_SIZE = 128
+
+
+class ValueCache(object):
+    """
+    Thread-safe, least-recently-used cache of the complete value lists of low-cardinality fields,
+    each kept for the timeout given when it is loaded.
+
+    """
+
+    def __init__(self, maxsize=VALUE_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, timeout, load):
+        """Returns the cached value list for ``key``, calling ``load()`` when missing or expired."""
+
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(key)
+                return entry[1]
+
+        values = load()
+        with self._lock:
+            self._entries[key] = (now + timeout, values)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return values
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+value_cache = ValueCache()
+
+
+def is_cached_field(configuration, field):
+    """Indicates if ``field`` is listed in the configuration's ``cached_suggestion_fields``."""
+
+    for paths in configuration.cached_suggestion_fields:
+        if ((paths,) if isinstance(paths, str) else tuple(paths)) == field:
+            return True
+    return False
+
+
+def get_suggestions(configuration, field, prefix, request=None, user=None, limit=None):
+    """
+    Returns up to ``limit`` (by default, the configuration's ``suggestion_limit``) sorted, distinct
+    values of the configuration's ``field`` that start with ``prefix``, ignoring case.
+
+    Choice fields suggest their labels.  Text fields are read from the configuration's queryset
+    for ``request`` and ``user`` with an ``istartswith`` lookup and a ``LIMIT`` per path, which an
+    index on the column can answer.  Fields in ``cached_suggestion_fields`` instead have all of
+    their values in that queryset loaded once into ``value_cache``, per
+    ``ModelSearch.get_suggestion_scope()``, and filtered in process.  Other fields have no
+    suggestions.
+
+    """
+
+    limit = limit or configuration.suggestion_limit
+    prefix = prefix.strip().lower()
+    classification = configuration.get_field_classification(field)
+
+    if classification == "choices":
+        values = [str(label) for _, label in configuration.field_types[field].flatchoices]
+    elif classification != "text":
+        return []
+    elif is_cached_field(configuration, field):
+        scope = configuration.get_suggestion_scope(request, user)
+        key = (configuration.model._meta.label, field, scope)
+        values = value_cache.get(
+            key,
+            configuration.suggestion_cache_timeout,
+            lambda: get_values(configuration.get_queryset(request, user), field),
+        )
+    else:
+        queryset = configuration.get_queryset(request, user)
+        values = get_values(queryset, field, prefix, limit)
+
+    return [value for value in values if value.lower().startswith(prefix)][:limit]
+
+
+def get_values(queryset, field, prefix=None, limit=None):
+    """
+    Returns the sorted, distinct non-empty values of ``field``'s paths in ``queryset``, limited to
+    those starting with ``prefix`` and to ``limit`` per path when given.
+
+    """
+
+    values = set()
+    for path in field:
+        rows = queryset
+        if prefix is not None:
+            rows = rows.filter(**{LOOKUP_SEP.join((path, "istartswith")): prefix})
+        rows = rows.order_by(path).values_list(path, flat=True).distinct()
+        if limit is not None:
+            rows = rows[:limit]
+        values.update(value for value in rows if value)
+    return sorted(values, key=lambda value: (value.lower(), value))
@@ -0,0 +1,227 @@
+"""terms.py: Precompiled coercion of search terms"""
+
+import logging
+import re
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+
+from django.db import models
+
+import dateutil.parser
+
+from .engine import SearchSpecError
+
+
+log = logging.getLogger(__name__)
+
+NULL_OPERATORS = ("isnull", "!isnull")
+LIST_OPERATORS = ("in",)
+CONTAINS_OPERATORS = ("icontains", "!icontains")
+
+BOOLEAN_TERMS = {"true": True, "yes": True, "false": False, "no": False}
+
+# Plain decimal notation only, so that "nan", "inf" and friends aren't accepted as numbers
+NUMBER_RE = re.compile(r"^[+-]?(\d+\.?\d*|\.\d+)([eE][+-]?\d+)?$")
+INTEGER_RE = re.compile(r"^[+-]?\d+$")
+
+# Separates the values of an "is one of" list
+LIST_SEPARATOR_RE = re.compile(r"[\r\n,]+")
+
+
+def split_list(term):
+    """Returns the non-blank values of an "is one of" list given as a string."""
+    return [value for value in map(str.strip, LIST_SEPARATOR_RE.split(term)) if value]
+
+
+def check_term_length(configuration, term):
+    """Raises ``SearchSpecError`` if ``term`` is longer than the ``max_term_length`` limit."""
+
+    limit = configuration.max_term_length
+    if limit is not None and len(term) > limit:
+        raise SearchSpecError("Search terms are limited to {} characters.".format(limit))
+
+
+def check_list_size(configuration, values):
+    """Raises ``SearchSpecError`` if ``values`` has more than ``max_list_size`` values."""
+
+    limit = configuration.max_list_size
+    if limit is not None and len(values) > limit:
+        raise SearchSpecError('"is one of" lists are limited to {} values.'.format(limit))
+
+
+def check_upload_size(configuration, upload):
+    """
+    Raises ``SearchSpecError`` if the ``upload`` of "is one of" values is larger than a full list
+    can be: ``max_list_size`` values of ``max_term_length`` characters and a separator each.
+
+    """
+
+    if configuration.max_list_size is None or configuration.max_term_length is None:
+        return
+    limit = configuration.max_list_size * (configuration.max_term_length + 1)
+    if upload.size > limit:
+        raise SearchSpecError("Values files are limited to {} bytes.".format(limit))
+
+
+def parse_date(term):
+    """Parses ``term`` as ISO-8601, falling back to dateutil's slower guessing of other formats."""
+
+    try:
+        return datetime.fromisoformat(term)
+    except ValueError:
+        pass
+    try:
+        return dateutil.parser.parse(term)
+    except (TypeError, ValueError, OverflowError):
+        raise SearchSpecError("Unable to parse a date from '{}'".format(term))
+
+
+def parse_boolean(term):
+    try:
+        return BOOLEAN_TERMS[term.lower()]
+    except KeyError:
+        raise SearchSpecError("Boolean value must be either true/false or yes/no.")
+
+
+def check_number(term):
+    """Raises ``SearchSpecError`` unless ``term`` is a number in plain decimal notation."""
+    if not NUMBER_RE.match(term):
+        raise SearchSpecError("Value must be numeric.")
+
+
+def get_number_parser(field_type):
+    """Returns the strict parser of numeric terms for the Python type of ``field_type``."""
+
+    if isinstance(field_type, (models.IntegerField, models.AutoField)):
+
+        def parse(term):
+            if not INTEGER_RE.match(term):
+                raise SearchSpecError("Value must be a whole number.")
+            return int(term)
+
+    elif isinstance(field_type, models.DecimalField):
+
+        def parse(term):
+            if not NUMBER_RE.match(term):
+                raise SearchSpecError("Value must be numeric.")
+            try:
+                return Decimal(term)
+            except InvalidOperation:
+                raise SearchSpecError("Value must be numeric.")
+
+    else:
+
+        def parse(term):
+            if not NUMBER_RE.match(term):
+                raise SearchSpecError("Value must be numeric.")
+            return float(term)
+
+    return parse
+
+
+class TermCoercer(object):
+    """
+    Normalizes terms for one search field of a ``ModelSearch``.  Everything that depends only on
+    the field, such as the lookup table of its choices and its parser, is prepared once when the
+    coercer is built, so a coercer should be kept (see ``ModelSearch.get_term_coercer()``) and
+    reused for every term on the field.
+
+    String terms from the UI are coerced; already typed values are passed through.
+
+    """
+
+    def __init__(self, configuration, field):
+        self.configuration = configuration
+        self.field = field
+        field_type = configuration.field_types[field]
+        self.classification = configuration.get_field_classification(field)
+
+        # The field's database values aren't the display values, but the display values are what
+        # the user will search for.  e.g., choices=[(1, 'Bob'), (2, 'Mary')]
+        self.choices = None
+        if field_type.choices:
+            self.choices = {str(label).lower(): value for value, label in field_type.flatchoices}
+
+        if self.classification == "date":
+            self.parse = parse_date
+        elif self.classification == "boolean":
+            self.parse = parse_boolean
+        elif self.classification == "number":
+            self.parse = get_number_parser(field_type)
+        else:
+            self.parse = None
+
+    def clean(self, operator, term):
+        """Returns ``term`` normalized for ``operator``."""
+
+        if operator in LIST_OPERATORS:
+            return self.clean_list(term)
+
+        if isinstance(term, str):
+            check_term_length(self.configuration, term)
+            term = term.strip()
+            if self.choices is not None:
+                term = self.choices.get(term.lower(), term)
+            elif term and self.parse is not None and operator not in NULL_OPERATORS:
+                if operator not in CONTAINS_OPERATORS:
+                    term = self.parse(term)
+                elif self.classification == "number":
+                    # Numbers are matched as text by "contains", so any number is accepted, even
+                    # a decimal one on an integer field
+                    check_number(term)
+                else:
+                    self.parse(term)
+
+        if operator not in NULL_OPERATORS and term in [None, ""]:
+            raise SearchSpecError("This field is required.")
+
+        return term
+
+    def clean_list(self, term):
+        """
+        Returns the deduplicated list of values for an "is one of" constraint, given as a list or
+        as a newline- or comma-separated string.
+
+        """
+
+        if isinstance(term, str):
+            terms = split_list(term)
+        elif isinstance(term, (list, tuple, set)):
+            terms = term
+        else:
+            terms = [term]
+        check_list_size(self.configuration, terms)
+
+        values = []
+        for value in terms:
+            if isinstance(value, str):
+                value = value.strip()
+                if not value:
+                    continue
+            values.append(self.clean("exact", value))
+
+        if not values:
+            raise SearchSpecError("This field is required.")
+        return list(dict.fromkeys(values))
+
+    def clean_end(self, term):
+        """Returns the second term of a "range" constraint normalized."""
+
+        if not isinstance(term, str):
+            return term
+        check_term_length(self.configuration, term)
+        if self.classification not in ("date", "number"):
+            raise SearchSpecError("Unknown range type %r." % self.classification)
+        try:
+            return self.parse(term.strip())
+        except SearchSpecError:
+            raise SearchSpecError("Unable to parse the end term '{}'".format(term))
+
+    def clean_many(self, operator, terms):
+        """Returns the list of ``terms`` normalized for ``operator``."""
+        return [self.clean(operator, term) for term in terms]
+
+
+def clean_terms(configuration, field, operator, terms):
+    """Normalizes a batch of ``terms`` for ``operator`` on the configuration's ``field``."""
+    return configuration.get_term_coercer(field).clean_many(operator, terms)
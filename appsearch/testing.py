@@ -0,0 +1,116 @@
+"""testing.py: Query count assertions for tests of search configurations"""
+
+import logging
+import re
+from collections import Counter
+from contextlib import ContextDecorator
+
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.test.utils import CaptureQueriesContext
+
+from .registry import search
+from .utils import Searcher
+
+
+log = logging.getLogger(__name__)
+
+# Literals stripped from captured SQL, so that the queries of an N+1 loop compare equal
+STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+NUMBER_LITERAL = re.compile(r"\b\d+(?:\.\d+)?\b")
+
+
+def get_query_shape(sql):
+    """Returns ``sql`` with its string and number literals replaced by ``?``."""
+    return NUMBER_LITERAL.sub("?", STRING_LITERAL.sub("?", sql))
+
+
+class QueryBudget(ContextDecorator):
+    """
+    Context manager and decorator failing with ``AssertionError`` when the queries run on the
+    ``using`` database exceed ``max_queries`` (when given), or when more than ``max_duplicates``
+    of them repeat an earlier query up to its literal values, which is how an N+1 loop over the
+    results looks.
+
+    The captured SQL is available as ``queries`` once the block exits.
+
+    """
+
+    def __init__(self, max_queries=None, max_duplicates=0, using=DEFAULT_DB_ALIAS):
+        self.max_queries = max_queries
+        self.max_duplicates = max_duplicates
+        self.using = using
+        self.queries = []
+
+    def __enter__(self):
+        self.context = CaptureQueriesContext(connections[self.using])
+        self.context.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.context.__exit__(exc_type, exc_value, traceback)
+        self.queries = [query["sql"] for query in self.context.captured_queries]
+        if exc_type is None:
+            self.check()
+        return False
+
+    def get_duplicates(self):
+        """Returns a dictionary of each repeated query shape to its number of extra executions."""
+        counts = Counter(get_query_shape(sql) for sql in self.queries)
+        return {shape: count - 1 for shape, count in counts.items() if count > 1}
+
+    def check(self):
+        problems = []
+        if self.max_queries is not None and len(self.queries) > self.max_queries:
+            problems.append(
+                "{} queries executed on {!r}, expected at most {}".format(
+                    len(self.queries), self.using, self.max_queries
+                )
+            )
+
+        duplicates = self.get_duplicates()
+        if sum(duplicates.values()) > self.max_duplicates:
+            problems.append(
+                "{} duplicate queries executed on {!r}, expected at most {}".format(
+                    sum(duplicates.values()), self.using, self.max_duplicates
+                )
+            )
+
+        if problems:
+            lines = ["{}. {}".format(i, sql) for i, sql in enumerate(self.queries, start=1)]
+            raise AssertionError("\n".join(problems + ["Captured queries:"] + lines))
+
+
+def run_search(request, model=None, constraints=None, querydict=None, registry=search, **kwargs):
+    """
+    Runs a ``Searcher`` end to end the way the search view does: validates the search (given as
+    ``model`` and ``constraints``, or else read from ``querydict`` or the request), executes it,
+    and renders its results list.  Returns the searcher, whose ``results`` hold the rows.
+
+    """
+
+    if constraints is not None:
+        searcher = Searcher(
+            request, model=model, constraints=constraints, registry=registry, **kwargs
+        )
+    else:
+        searcher = Searcher(request, querydict=querydict, registry=registry, **kwargs)
+    if not searcher.ready:
+        raise AssertionError("The search is invalid: {}".format(searcher.constraint_formset.errors))
+    searcher._perform_search()
+    searcher.render_results_list()
+    return searcher
+
+
+class SearchQueryTestMixin(object):
+    """``TestCase`` mixin asserting the queries of whole searches."""
+
+    def assertSearchQueries(self, max_queries, request, max_duplicates=0, **kwargs):
+        """
+        Runs the search described by ``kwargs`` through ``run_search()`` and fails if it exceeds
+        ``max_queries`` or ``max_duplicates``.  Returns the searcher.
+
+        """
+
+        using = kwargs.pop("using", DEFAULT_DB_ALIAS)
+        with QueryBudget(max_queries, max_duplicates=max_duplicates, using=using):
+            return run_search(request, **kwargs)
@@ -5,17 +5,89 @@ when you run "manage.py test".
 Replace this with more appropriate tests for your application.
 """
 
+import json
+import os
 import re
+import tempfile
+from io import StringIO
+from unittest import mock
+from datetime import timedelta
 from urllib.parse import urlencode
 
 from django.apps import apps
-from django.test import TestCase
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import CommandError, call_command
+from django.http import QueryDict
+from django.test import RequestFactory, TestCase, override_settings
 from django.urls import reverse
+from django.utils import timezone, translation
+from django.utils.translation import gettext_lazy
 
+import appsearch.snapshot
+from appsearch.admission import CacheSemaphore
+from appsearch.cost import estimate_cost
+from appsearch.documents import rebuild_search_documents
+from appsearch.engine import SearchEngine, SearchSpecError, bulk_search
+from appsearch.forms import ConstraintForm
+from appsearch.lint import inspect_configuration
+from appsearch.models import SavedSearch, SearchDocument
+from appsearch.registry import ModelSearch, SearchRegistry, get_field_hash, search
+from appsearch.signals import disconnect_tracking
+from appsearch.snapshot import get_snapshot_path, load_snapshot, write_snapshot
+from appsearch.suggestions import value_cache
+from appsearch.terms import clean_terms
+from appsearch.testing import QueryBudget, SearchQueryTestMixin
+from appsearch.utils import Searcher
+from appsearch.views import BaseSearchView, SearchAPIView
 
 Company = apps.get_model("company", "Company")
 
 
+def get_querydict(configuration, *constraints, total=None, **data):
+    """
+    Returns the search form data for ``constraints`` on ``configuration``, each given as a
+    ``(field path, operator label, term)`` tuple and joined with "and".  ``data`` adds or
+    overrides form keys, e.g., ``**{"form-1-type": "or"}``.
+
+    """
+
+    values = {
+        "form-TOTAL_FORMS": len(constraints) if total is None else total,
+        "form-INITIAL_FORMS": 0,
+        "model": configuration._content_type.id,
+    }
+    for i, (field, operator, term) in enumerate(constraints):
+        values.update(
+            {
+                "form-{}-type".format(i): "and",
+                "form-{}-field".format(i): get_field_hash((field,)),
+                "form-{}-operator".format(i): operator,
+                "form-{}-term".format(i): term,
+            }
+        )
+    values.update(data)
+    querydict = QueryDict(mutable=True)
+    querydict.update(values)
+    return querydict
+
+
+def register_search(testcase, model, configuration_class, registry=None):
+    """
+    Registers ``configuration_class`` for ``model`` in ``registry`` (a new ``SearchRegistry`` by
+    default) and disconnects its change tracking when ``testcase`` ends.  Returns the registry.
+
+    """
+
+    registry = SearchRegistry() if registry is None else registry
+    registry.register(model, configuration_class)
+    testcase.addCleanup(disconnect_tracking, registry[model])
+    return registry
+
+
 class SearchTests(TestCase):
     def test_object_contains_data(self):
         """Test a basic contains"""
@@ -112,3 +184,1347 @@ class SearchTests(TestCase):
         response = self.client.get(url)
         self.assertNotIn("<h2>1 Compan", str(response.content))
         self.assertNotIn(company.name, str(response.content))
+
+
+class BulkSearchTests(TestCase):
+    def setUp(self):
+        self.builder = Company.objects.create(name="Builder One", slug="b1", company_type="builder")
+        self.rater = Company.objects.create(name="Rater One", slug="r1", company_type="rater")
+        self.other = Company.objects.create(name="Builder Two", slug="b2", company_type="builder")
+
+    def test_engine_validates_without_forms(self):
+        engine = SearchEngine(search[Company])
+        constraints = engine.clean_constraints([("and", "name", "contains", "builder")])
+        self.assertEqual(constraints[0][1:], (("name",), "icontains", "builder"))
+        with self.assertRaises(SearchSpecError):
+            engine.clean_constraints([("and", "name", "between", "builder")])
+        with self.assertRaises(SearchSpecError):
+            engine.clean_constraints([("and", "slug", "icontains", "b1")])
+
+    def test_bulk_search_batches_term_values(self):
+        specs = [
+            [("and", "name", "icontains", "one"), ("and", "company_type", "is", "Builder")],
+            [("and", "name", "icontains", "one"), ("and", "company_type", "is", "rater")],
+            [("and", "name", "icontains", "one"), ("and", "company_type", "is", "provider")],
+        ]
+        with self.assertNumQueries(1):
+            results = bulk_search(Company, specs, AnonymousUser())
+        self.assertEqual(results, [[self.builder.pk], [self.rater.pk], []])
+
+        specs.append([("and", "name", "icontains", "builder")])
+        with QueryBudget(max_queries=2) as budget:
+            counts = bulk_search(Company, specs, AnonymousUser(), count=True)
+        self.assertEqual(counts, [1, 1, 0, 2])
+        self.assertTrue(all("COUNT(" in sql for sql in budget.queries))
+
+        # Identical specs share a query but not a result list
+        results = bulk_search(Company, [specs[3], specs[3]], AnonymousUser())
+        results[0].append(None)
+        self.assertEqual(results[1], [self.builder.pk, self.other.pk])
+
+    def test_searcher_accepts_constraints(self):
+        request = RequestFactory().get("/search/")
+        request.user = AnonymousUser()
+
+        searcher = Searcher(
+            request,
+            model=Company,
+            constraints=[
+                ("and", ("name",), "icontains", "builder"),
+                ("and", "company_type", "is", "Builder"),
+            ],
+        )
+        self.assertTrue(searcher.ready)
+        searcher._perform_search()
+        self.assertEqual(searcher.results["count"], 2)
+        self.assertEqual(
+            searcher.results["natural_string"],
+            "where Name contains builder, and Company type is builder",
+        )
+
+        engine = search[Company].get_engine()
+        queryset = engine.get_queryset([("and", "name", "iexact", "rater one")])
+        self.assertEqual(list(queryset), [self.rater])
+        with self.assertRaises(SearchSpecError):
+            engine.get_queryset([("and", "slug", "exact", "r1")])
+
+
+class SearchAPITests(TestCase):
+    def test_cursor_pagination(self):
+        companies = [
+            Company.objects.create(name="Builder %d" % i, slug="b%d" % i, company_type="builder")
+            for i in range(5)
+        ]
+        Company.objects.create(name="Rater", slug="r", company_type="rater")
+
+        spec = {
+            "model": ContentType.objects.get_for_model(Company).id,
+            "constraints": [["and", "company_type", "is", "builder"]],
+            "limit": 2,
+        }
+        url = reverse("search-api")
+        response = self.client.post(url, json.dumps(spec), content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(data["columns"], ["Name", "Slug", "Company type"])
+        self.assertEqual(data["count"], 5)
+        self.assertEqual([row[1] for row in data["rows"]], ["b0", "b1"])
+
+        pages = [data["rows"]]
+        while data["next"]:
+            spec["cursor"] = data["next"]
+            data = self.client.get(url, {"spec": json.dumps(spec)}).json()
+            self.assertNotIn("count", data)
+            pages.append(data["rows"])
+        self.assertEqual([len(page) for page in pages], [2, 2, 1])
+        self.assertEqual([row[1] for page in pages for row in page], [c.slug for c in companies])
+
+        spec["cursor"] = "bogus"
+        response = self.client.get(url, {"spec": json.dumps(spec)})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {"errors": ["Invalid cursor."]})
+
+    def test_invalid_specs(self):
+        Company.objects.create(name="Rater", slug="r", company_type="rater")
+        model = ContentType.objects.get_for_model(Company).id
+        constraints = [["and", "company_type", "is", "rater"]]
+        client = self.client_class(enforce_csrf_checks=True)
+        url = reverse("search-api")
+        for spec, error in (
+            ({"model": model, "constraints": 5}, "'constraints' must be a list."),
+            ({"model": model, "constraints": [5]}, None),
+            ({"model": model, "constraints": constraints, "sort": 5}, "'sort' must be a string."),
+            (
+                {"model": model, "constraints": constraints, "cursor": 5},
+                "'cursor' must be a string.",
+            ),
+        ):
+            response = client.post(url, json.dumps(spec), content_type="application/json")
+            self.assertEqual(response.status_code, 400)
+            if error is not None:
+                self.assertEqual(response.json(), {"errors": [error]})
+
+        # No CSRF token is needed, and the search page's querystring parameters don't apply
+        owner = get_user_model().objects.create(username="owner")
+        saved_search = SavedSearch.objects.create(
+            name="Builders",
+            owner=owner,
+            content_type=ContentType.objects.get_for_model(Company),
+            constraints=[["and", ["company_type"], "exact", "builder"]],
+        )
+        client.force_login(owner)
+        spec = {"model": model, "constraints": constraints}
+        response = client.post(
+            "{}?saved_search={}&since=abc".format(url, saved_search.pk),
+            json.dumps(spec),
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["count"], 1)
+        self.assertNotIn("watermark", response.json())
+
+    def test_sorted_cursor_pagination(self):
+        for slug in ("c", "a", "d", "b"):
+            Company.objects.create(name=slug, slug=slug, company_type="rater")
+
+        spec = {
+            "model": ContentType.objects.get_for_model(Company).id,
+            "constraints": [["and", "company_type", "is", "rater"]],
+            "sort": "-slug",
+            "limit": 3,
+        }
+        url = reverse("search-api")
+        data = self.client.get(url, {"spec": json.dumps(spec)}).json()
+        self.assertEqual([row[1] for row in data["rows"]], ["d", "c", "b"])
+        spec["cursor"] = data["next"]
+        data = self.client.get(url, {"spec": json.dumps(spec)}).json()
+        self.assertEqual([row[1] for row in data["rows"]], ["a"])
+        self.assertIsNone(data["next"])
+
+        spec["sort"] = "name"
+        response = self.client.get(url, {"spec": json.dumps(spec)})
+        self.assertEqual(response.status_code, 400)
+
+    def test_datetime_cursor_pagination(self):
+        User = get_user_model()
+        joined = timezone.now().replace(microsecond=500)
+        builder = Company.objects.create(name="Builder", slug="b", company_type="builder")
+        users = [
+            User.objects.create(
+                username="user%d" % i,
+                date_joined=joined + timedelta(microseconds=i),
+                company=builder if i else None,
+            )
+            for i in range(3)
+        ]
+
+        class JoinedUserSearch(ModelSearch):
+            display_fields = ("username", "date_joined", "company__name")
+            search_fields = ("username",)
+            sortable_fields = ("date_joined", "company__name")
+
+        registry = SearchRegistry()
+        registry.register(User, JoinedUserSearch)
+
+        class JoinedUserAPIView(SearchAPIView):
+            def get_searcher_kwargs(self):
+                return dict(super(JoinedUserAPIView, self).get_searcher_kwargs(), registry=registry)
+
+        view = JoinedUserAPIView.as_view()
+        # Null sort values, here through an empty relationship, are ordered last
+        orders = {
+            "date_joined": ["user0", "user1", "user2"],
+            "company__name": ["user1", "user2", "user0"],
+        }
+        for sort, expected in orders.items():
+            spec = {
+                "model": ContentType.objects.get_for_model(User).id,
+                "constraints": [["and", "username", "contains", "user"]],
+                "sort": sort,
+                "limit": 1,
+            }
+            usernames = []
+            for _ in range(len(users) + 1):
+                request = RequestFactory().get("/", {"spec": json.dumps(spec)})
+                request.user = users[0]
+                request.user.is_superuser = True
+                data = json.loads(view(request).content)
+                usernames.extend(row[0] for row in data["rows"])
+                if not data["next"]:
+                    break
+                spec["cursor"] = data["next"]
+            self.assertEqual(usernames, expected)
+
+
+class SortTests(TestCase):
+    def test_only_indexed_display_fields_are_sortable(self):
+        self.assertEqual(search[Company].get_sortable_fields(), ["slug"])
+        self.assertEqual(search[Company].get_ordering("-slug"), ["-slug", "pk"])
+        with self.assertRaises(ValueError):
+            search[Company].get_ordering("name")
+
+    def test_results_are_sorted(self):
+        for slug in ("b", "c", "a"):
+            Company.objects.create(name="Co %s" % slug, slug=slug, company_type="rater")
+
+        request = RequestFactory().get("/search/", {"sort": "slug"})
+        request.user = AnonymousUser()
+        constraints = [("and", "name", "icontains", "co")]
+        searcher = Searcher(request, model=Company, constraints=constraints)
+        searcher._perform_search()
+        self.assertEqual([row[1] for row in searcher.results["list"]], ["a", "b", "c"])
+
+        headers = searcher.results["headers"]
+        self.assertEqual([h["label"] for h in headers], ["Name", "Slug", "Company type"])
+        self.assertIsNone(headers[0]["url"])
+        self.assertEqual(headers[1]["sort"], "asc")
+        self.assertIn("sort=-slug", headers[1]["url"])
+
+        searcher = Searcher(request, model=Company, constraints=constraints, sort="name")
+        searcher._perform_search()
+        self.assertIsNone(searcher.sort)
+
+
+class FacetTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_facet_counts_narrow_search(self):
+        for i, company_type in enumerate(["builder", "builder", "rater"]):
+            Company.objects.create(name="Co %d" % i, slug="co%d" % i, company_type=company_type)
+        Company.objects.create(name="Other", slug="other", company_type="provider")
+
+        data = get_querydict(search[Company], ("name", "contains", "co"))
+        response = self.client.get(reverse("search"), data)
+        facets = response.context["search"].results["facets"]
+        self.assertEqual(len(facets), 1)
+        self.assertEqual(facets[0]["label"], "Company type")
+        values = facets[0]["values"]
+        self.assertEqual([(v["label"], v["count"]) for v in values], [("Builder", 2), ("Rater", 1)])
+
+        response = self.client.get(values[0]["url"])
+        self.assertEqual(response.context["search"].results["count"], 2)
+        self.assertContains(response, "Company type is builder")
+
+    def test_facet_fields_must_be_choices_or_boolean(self):
+        class BadSearch(ModelSearch):
+            display_fields = ("name",)
+            search_fields = ("name",)
+            facet_fields = ("name",)
+
+        with self.assertRaises(ValueError):
+            BadSearch(Company)
+
+
+class StreamingTests(TestCase):
+    def test_streamed_results_match_rendered_results(self):
+        for i in range(5):
+            Company.objects.create(name="Co %d" % i, slug="co%d" % i, company_type="rater")
+
+        request = RequestFactory().get("/search/")
+        request.user = AnonymousUser()
+        constraints = [("and", "name", "icontains", "co")]
+
+        searcher = Searcher(request, model=Company, constraints=constraints)
+        searcher._perform_search()
+        rendered = searcher.render_results_list()
+
+        searcher = Searcher(request, model=Company, constraints=constraints)
+        searcher.stream_chunk_size = 2
+        chunks = list(searcher.stream_results_list())
+        self.assertEqual(len(chunks), 5)  # head, 3 chunks of rows, tail
+        self.assertEqual("".join(chunks).split(), rendered.split())
+
+    def test_view_streams_results(self):
+        Company.objects.create(name="Co", slug="co", company_type="rater")
+        data = get_querydict(search[Company], ("name", "contains", "co"))
+        request = RequestFactory().get("/search/", data)
+        request.user = AnonymousUser()
+        view = BaseSearchView.as_view(template_name="appsearch/search.html", stream_results=True)
+        response = view(request)
+        self.assertTrue(response.streaming)
+        content = b"".join(response.streaming_content).decode()
+        self.assertIn("<h2>1 Compan", content)
+        self.assertIn("<td>co</td>", content)
+
+
+class RowRendererTests(TestCase):
+    def test_cells_are_escaped_by_policy(self):
+        class SafeSlugSearch(ModelSearch):
+            display_fields = ("name", "slug", "company_type")
+            search_fields = ("name",)
+            safe_display_fields = ("slug",)
+
+        renderer = SafeSlugSearch(Company).get_row_renderer()
+        html = renderer.render([["<b>Co</b>", "<i>co</i>", None], ["a & b", "c", "d", "<e>"]])
+        self.assertEqual(
+            html,
+            "<tr><td>&lt;b&gt;Co&lt;/b&gt;</td><td><i>co</i></td><td>None</td></tr>"
+            "<tr><td>a &amp; b</td><td>c</td><td>d</td><td>&lt;e&gt;</td></tr>",
+        )
+
+    def test_compiled_rows_match_template_rows(self):
+        for i in range(3):
+            Company.objects.create(name="Co %d" % i, slug="co%d" % i, company_type="rater")
+
+        request = RequestFactory().get("/search/")
+        request.user = AnonymousUser()
+        constraints = [("and", "name", "icontains", "co")]
+
+        searcher = Searcher(request, model=Company, constraints=constraints)
+        searcher._perform_search()
+        rendered = searcher.render_results_list()
+
+        searcher = Searcher(request, model=Company, constraints=constraints, compiled_rows=True)
+        searcher._perform_search()
+        compiled = searcher.render_results_list()
+        self.assertEqual("".join(compiled.split()), "".join(rendered.split()))
+
+
+class SavedSearchTests(TestCase):
+    def setUp(self):
+        self.owner = get_user_model().objects.create(username="owner", is_superuser=True)
+        self.rater = Company.objects.create(name="Rater", slug="r", company_type="rater")
+
+    def create_saved_search(self, **kwargs):
+        return SavedSearch.objects.create(
+            name="Raters",
+            owner=self.owner,
+            content_type=ContentType.objects.get_for_model(Company),
+            constraints=SavedSearch.normalize_constraints(
+                search[Company], [("and", "company_type", "is", "Rater")]
+            ),
+            **kwargs,
+        )
+
+    def test_normalized_constraints(self):
+        saved_search = self.create_saved_search()
+        self.assertEqual(saved_search.constraints, [["and", ["company_type"], "exact", "Rater"]])
+        self.assertEqual(list(saved_search.get_queryset()), [self.rater])
+
+    def test_materialized_snapshot(self):
+        saved_search = self.create_saved_search(materialize=True)
+        self.assertTrue(saved_search.is_due())
+
+        output = StringIO()
+        call_command("refresh_saved_searches", stdout=output)
+        self.assertEqual(output.getvalue().strip(), "Refreshed 1 saved searches.")
+        saved_search.refresh_from_db()
+        self.assertEqual(
+            list(saved_search.results.values_list("object_id", flat=True)), [self.rater.pk]
+        )
+        self.assertFalse(saved_search.is_due())
+
+        # Changes aren't seen until the next refresh, and the snapshot is read by a subquery
+        other = Company.objects.create(name="Other", slug="o", company_type="rater")
+        queryset = saved_search.get_queryset()
+        self.assertIn("appsearch_savedsearchresult", str(queryset.query))
+        self.assertEqual(list(queryset), [self.rater])
+        saved_search.refresh()
+        self.assertEqual(list(saved_search.get_queryset().order_by("pk")), [self.rater, other])
+
+    def test_model_changes_mark_snapshots_dirty(self):
+        class TrackedCompanySearch(ModelSearch):
+            display_fields = ("name",)
+            search_fields = ("company_type",)
+            track_saved_searches = True
+
+        class TrackedUserSearch(ModelSearch):
+            display_fields = ("username",)
+            search_fields = ({"company": ("name",)},)
+            track_saved_searches = True
+
+        User = get_user_model()
+        registry = register_search(self, Company, TrackedCompanySearch)
+        register_search(self, User, TrackedUserSearch, registry)
+
+        # Each configuration has its own receivers, which outlive the others' being disconnected
+        disconnect_tracking(registry[User])
+        saved_search = self.create_saved_search(materialize=True)
+        saved_search.refresh()
+        Company.objects.create(name="Other", slug="o", company_type="builder")
+        saved_search.refresh_from_db()
+        self.assertTrue(saved_search.is_dirty)
+        self.assertTrue(saved_search.is_due())
+
+    def test_searcher_reads_snapshot(self):
+        saved_search = self.create_saved_search(materialize=True)
+        saved_search.refresh()
+        Company.objects.filter(pk=self.rater.pk).update(company_type="builder")
+
+        self.client.force_login(self.owner)
+        response = self.client.get(reverse("search"), {"saved_search": saved_search.pk})
+        self.assertEqual(response.context["search"].results["count"], 1)
+
+    def test_invalid_saved_search_is_reported(self):
+        saved_search = self.create_saved_search()
+        saved_search.constraints = [["and", ["slug"], "iexact", "r"]]
+        saved_search.save()
+
+        self.client.force_login(self.owner)
+        response = self.client.get(reverse("search"), {"saved_search": saved_search.pk})
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.context["search"].ready)
+        self.assertContains(response, "The saved search can&#x27;t be opened")
+
+    def test_new_objects_since_watermark(self):
+        saved_search = self.create_saved_search()
+        self.assertEqual(saved_search.get_new_objects(), [self.rater])
+        self.assertEqual(saved_search.watermark, self.rater.pk)
+        self.assertEqual(saved_search.get_new_objects(), [])
+
+        other = Company.objects.create(name="Other", slug="o", company_type="rater")
+        Company.objects.create(name="Builder", slug="b", company_type="builder")
+        self.assertEqual(saved_search.get_new_objects(), [other])
+        saved_search.refresh_from_db()
+        self.assertEqual(saved_search.watermark, other.pk)
+
+    def test_new_objects_since_datetime_watermark(self):
+        User = get_user_model()
+        saved_search = SavedSearch.objects.create(
+            name="Raters' users",
+            owner=self.owner,
+            content_type=ContentType.objects.get_for_model(User),
+            constraints=SavedSearch.normalize_constraints(
+                search[User], [("and", "company__name", "contains", "rater")]
+            ),
+        )
+        first = User.objects.create(username="first", company=self.rater)
+        self.assertEqual(saved_search.get_new_objects(), [first])
+
+        # The stored watermark keeps the microseconds of ``last_update``
+        saved_search.refresh_from_db()
+        self.assertEqual(saved_search.get_new_objects(), [])
+        second = User.objects.create(username="second", company=self.rater)
+        saved_search.refresh_from_db()
+        self.assertEqual(saved_search.get_new_objects(), [second])
+        saved_search.refresh_from_db()
+        self.assertEqual(saved_search.get_new_objects(), [])
+
+
+class IncrementalSearchTests(TestCase):
+    def test_searcher_since_watermark(self):
+        request = RequestFactory().get("/")
+        request.user = get_user_model().objects.create(username="admin", is_superuser=True)
+        first = Company.objects.create(name="First", slug="f", company_type="rater")
+        constraints = [("and", "company_type", "is", "Rater")]
+
+        searcher = Searcher(request, model=Company, constraints=constraints, since=None)
+        searcher._perform_search()
+        self.assertEqual(searcher.results["count"], 1)
+        self.assertEqual(searcher.results["watermark"], first.pk)
+
+        second = Company.objects.create(name="Second", slug="s", company_type="rater")
+        since = searcher.results["watermark"]
+        searcher = Searcher(request, model=Company, constraints=constraints, since=since)
+        searcher._perform_search()
+        self.assertEqual(searcher.results["count"], 1)
+        self.assertEqual(searcher.results["watermark"], second.pk)
+
+        searcher = Searcher(request, model=Company, constraints=constraints)
+        searcher._perform_search()
+        self.assertNotIn("watermark", searcher.results)
+
+    def test_invalid_since(self):
+        request = RequestFactory().get("/")
+        request.user = AnonymousUser()
+        constraints = [("and", "company_type", "is", "Rater")]
+        with self.assertRaisesRegex(SearchSpecError, "Invalid 'since' watermark 'abc'"):
+            Searcher(request, model=Company, constraints=constraints, since="abc")
+
+        data = get_querydict(search[Company], ("name", "contains", "co"), since="abc")
+        response = self.client.get(reverse("search"), data)
+        self.assertEqual(response.status_code, 200)
+        formset = response.context["search"].constraint_formset
+        self.assertEqual(formset.non_form_errors(), ["Invalid 'since' watermark 'abc'."])
+
+    def test_api_since_watermark(self):
+        first = Company.objects.create(name="First", slug="f", company_type="rater")
+        second = Company.objects.create(name="Second", slug="s", company_type="rater")
+        spec = {
+            "model": search[Company]._content_type.id,
+            "constraints": [["and", "company_type", "is", "rater"]],
+            "since": str(first.pk),
+        }
+        url = reverse("search-api")
+        data = self.client.get(url, {"spec": json.dumps(spec)}).json()
+        self.assertEqual([row[1] for row in data["rows"]], ["s"])
+        self.assertEqual(data["watermark"], second.pk)
+
+        spec["since"] = "abc"
+        response = self.client.get(url, {"spec": json.dumps(spec)})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {"errors": ["Invalid 'since' watermark 'abc'."]})
+
+
+class SearchDocumentTests(TestCase):
+    def setUp(self):
+        class DenormalizedCompanySearch(ModelSearch):
+            display_fields = ("name",)
+            search_fields = ("name", {"users": (("User first name", "first_name"),)})
+            denormalize = True
+
+        self.registry = register_search(self, Company, DenormalizedCompanySearch)
+        self.configuration = self.registry[Company]
+
+        User = get_user_model()
+        self.rater = Company.objects.create(name="Rater", slug="r", company_type="rater")
+        self.builder = Company.objects.create(name="Builder", slug="b", company_type="builder")
+        User.objects.create(username="ann", first_name="Ann", company=self.rater)
+        self.bob = User.objects.create(username="bob", first_name="Bob", company=self.rater)
+
+    def search(self, operator, term):
+        engine = self.configuration.get_engine()
+        queryset = engine.get_queryset([("and", "users__first_name", operator, term)])
+        self.assertIn("appsearch_searchdocument", str(queryset.query))
+        return set(queryset)
+
+    def test_documents_answer_related_searches(self):
+        self.assertEqual(self.configuration.get_document_paths(), {"users__first_name": True})
+        self.assertEqual(self.search("contains", "bo"), {self.rater})
+        self.assertEqual(self.search("doesn't contain", "bo"), {self.builder})
+
+        # Exact lookups can't be answered by a many-valued path's document
+        queryset = self.configuration.get_engine().get_queryset(
+            [("and", "users__first_name", "iexact", "bob")]
+        )
+        self.assertNotIn("appsearch_searchdocument", str(queryset.query))
+
+    def test_documents_follow_related_changes(self):
+        self.bob.company = self.builder
+        self.bob.save()
+        self.assertEqual(self.search("contains", "bo"), {self.builder})
+
+        self.bob.delete()
+        self.assertEqual(self.search("contains", "bo"), set())
+
+        SearchDocument.objects.all().delete()
+        self.assertEqual(self.search("contains", "ann"), set())
+        self.assertEqual(rebuild_search_documents(self.configuration), 1)
+        self.assertEqual(self.search("contains", "ann"), {self.rater})
+
+    def test_long_first_values(self):
+        class DenormalizedUserSearch(ModelSearch):
+            display_fields = ("username",)
+            search_fields = ({"company": (("Company name", "name"),)},)
+            denormalize = True
+
+        User = get_user_model()
+        configuration = register_search(self, User, DenormalizedUserSearch)[User]
+        self.rater.name = "R" * 300
+        self.rater.save()
+        rebuild_search_documents(configuration)
+        document = SearchDocument.objects.get(path="company__name", object_id=self.bob.pk)
+        self.assertEqual(document.first_value, "r" * 255)
+
+        # Terms as long as the stored value can't be told apart from it, so they use the join
+        engine = configuration.get_engine()
+        for term, expected in (("r" * 300, 2), ("r" * 255, 0)):
+            queryset = engine.get_queryset([("and", "company__name", "iexact", term)])
+            self.assertNotIn("appsearch_searchdocument", str(queryset.query))
+            self.assertEqual(queryset.count(), expected)
+        queryset = engine.get_queryset([("and", "company__name", "iexact", "builder")])
+        self.assertIn("appsearch_searchdocument", str(queryset.query))
+
+
+class DatabaseRoutingTests(TestCase):
+    def setUp(self):
+        self.request = RequestFactory().get("/")
+        self.request.user = get_user_model().objects.create(username="admin", is_superuser=True)
+        Company.objects.create(name="Rater", slug="r", company_type="rater")
+
+    def get_configuration(self, **attrs):
+        registry = SearchRegistry()
+        attrs = dict(attrs, display_fields=("name",), search_fields=("name",))
+        registry.register(Company, type("RoutedCompanySearch", (ModelSearch,), attrs))
+        return registry[Company]
+
+    def test_replicas_are_used_in_turn(self):
+        configuration = self.get_configuration(database=("replica", "default"))
+        aliases = [configuration.get_database(self.request, self.request.user) for _ in range(3)]
+        self.assertEqual(aliases, ["replica", "default", "replica"])
+
+        searcher = Searcher(
+            self.request, model=Company, constraints=[("and", "name", "contains", "rat")]
+        )
+        searcher.model_config = configuration
+        queryset = searcher.build_queryset(Company, searcher.get_query())
+        self.assertEqual(queryset.db, "default")
+        self.assertEqual(queryset.count(), 1)
+
+    def test_lagging_replicas_fall_back_to_primary(self):
+        configuration = self.get_configuration(
+            database="replica", check_replica=lambda self, alias: False
+        )
+        self.assertEqual(configuration.get_database(self.request, self.request.user), "default")
+        self.assertIsNone(self.get_configuration().get_database(self.request, self.request.user))
+
+
+class AdmissionTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = get_user_model().objects.create(username="admin", is_superuser=True)
+        Company.objects.create(name="Co", slug="co", company_type="rater")
+
+    def get_request(self):
+        data = get_querydict(search[Company], ("name", "contains", "co"))
+        request = RequestFactory().get("/search/", data)
+        request.user = self.user
+        return request
+
+    def test_busy_searches_are_refused(self):
+        view = BaseSearchView.as_view(
+            template_name="appsearch/search.html", max_user_search_slots=2, max_search_slots=3
+        )
+        response = view(self.get_request())
+        self.assertEqual(response.status_code, 200)
+
+        # The slots are returned once the search has run
+        other_user = CacheSemaphore("appsearch.admission.user.other", 2)
+        self.assertTrue(other_user.acquire(2))
+        self.assertEqual(view(self.get_request()).status_code, 200)
+
+        # Another of this user's searches is still running
+        semaphore = CacheSemaphore("appsearch.admission.user.{}".format(self.user.pk), 2)
+        self.assertTrue(semaphore.acquire(2))
+        response = view(self.get_request())
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.content.decode(), BaseSearchView.busy_message)
+
+        # No slots were left taken overall
+        semaphore.release(2)
+        self.assertTrue(CacheSemaphore("appsearch.admission.all", 3).acquire(3))
+
+    def test_semaphore_expiry(self):
+        semaphore = CacheSemaphore("appsearch.admission.test", 3, timeout=60)
+        with mock.patch.object(semaphore.cache, "touch", wraps=semaphore.cache.touch) as touch:
+            self.assertTrue(semaphore.acquire(2))
+        touch.assert_called_once_with("appsearch.admission.test", 60)
+
+        # Releasing into a count that expired and started over never takes it below zero
+        cache.delete("appsearch.admission.test")
+        self.assertTrue(semaphore.acquire(1))
+        semaphore.release(2)
+        self.assertEqual(cache.get("appsearch.admission.test"), 0)
+        semaphore.release(1)
+        self.assertTrue(semaphore.acquire(3))
+        self.assertFalse(semaphore.acquire(1))
+
+    def test_expensive_searches_cost_more(self):
+        class UserCompanySearch(ModelSearch):
+            display_fields = ("name",)
+            search_fields = ("name", {"users": ("first_name",)})
+
+        configuration = UserCompanySearch(Company)
+        engine = configuration.get_engine()
+        cheap = engine.clean_constraints([("and", "name", "contains", "co")])
+        costly = engine.clean_constraints([("and", "users__first_name", "!icontains", "co")])
+        self.assertEqual(estimate_cost(configuration, cheap), 3)
+        self.assertEqual(estimate_cost(configuration, costly), 7)
+
+
+class CostTests(TestCase):
+    def setUp(self):
+        self.request = RequestFactory().get("/")
+        self.request.user = get_user_model().objects.create(username="admin", is_superuser=True)
+
+        class GuardedCompanySearch(ModelSearch):
+            display_fields = ("name",)
+            search_fields = ("name", "slug", {"users": ("first_name",)})
+            cost_warning_threshold = 2
+            cost_narrowing_threshold = 4
+            cost_rejection_threshold = 10
+
+        self.registry = SearchRegistry()
+        self.registry.register(Company, GuardedCompanySearch)
+
+    def get_searcher(self, constraints):
+        return Searcher(
+            self.request, model=Company, constraints=constraints, registry=self.registry
+        )
+
+    def test_thresholds(self):
+        self.assertEqual(self.get_searcher([("and", "slug", "iexact", "co")]).cost_warnings, [])
+        searcher = self.get_searcher([("and", "name", "contains", "co")])
+        self.assertEqual(searcher.cost_warnings, ["This search may be slow to run."])
+
+        broad = [("and", "name", "contains", "co"), ("and", "users__first_name", "contains", "a")]
+        with self.assertRaisesRegex(SearchSpecError, "too broad"):
+            self.get_searcher(broad)
+        self.assertTrue(self.get_searcher(broad + [("and", "slug", "iexact", "co")]).ready)
+        with self.assertRaisesRegex(SearchSpecError, "too broad"):
+            self.get_searcher(
+                broad + [("and", "slug", "iexact", "co"), ("or", "name", "iexact", "a")]
+            )
+
+        negated = [("and", "users__first_name", "!icontains", "a"), ("and", "slug", "iexact", "c")]
+        with self.assertRaisesRegex(SearchSpecError, "too expensive"):
+            self.get_searcher(negated + [("and", "name", "!icontains", "b")])
+
+    def test_formset_errors(self):
+        querydict = get_querydict(
+            self.registry[Company], ("users__first_name", "doesn't contain", "a")
+        )
+        searcher = Searcher(self.request, querydict=querydict, registry=self.registry)
+        self.assertFalse(searcher.ready)
+        self.assertIn("too broad", searcher.constraint_formset.non_form_errors()[0])
+
+
+class TermTests(TestCase):
+    def setUp(self):
+        class TermSearch(ModelSearch):
+            display_fields = ("username",)
+            search_fields = ({"company": ("company_type",)}, "last_update", "is_active", "id")
+
+        self.configuration = TermSearch(get_user_model())
+
+    def test_coercers_are_shared(self):
+        field = ("company__company_type",)
+        coercer = self.configuration.get_term_coercer(field)
+        self.assertIs(self.configuration.get_term_coercer(field), coercer)
+        self.assertEqual(coercer.choices["rater"], "rater")
+        self.assertEqual(
+            clean_terms(self.configuration, field, "exact", [" Rater", "x"]), ["rater", "x"]
+        )
+
+    def test_terms(self):
+        dates = clean_terms(
+            self.configuration, ("last_update",), "gt", ["2024-01-02T03:04:05", "Jan 2 2024"]
+        )
+        self.assertEqual([d.date().isoformat() for d in dates], ["2024-01-02", "2024-01-02"])
+        self.assertEqual(clean_terms(self.configuration, ("is_active",), "exact", ["Yes"]), [True])
+        self.assertEqual(clean_terms(self.configuration, ("id",), "exact", ["+7"]), [7])
+        self.assertEqual(clean_terms(self.configuration, ("id",), "icontains", ["7"]), ["7"])
+        self.assertEqual(clean_terms(self.configuration, ("id",), "icontains", ["1.5"]), ["1.5"])
+        with self.assertRaisesRegex(SearchSpecError, "numeric"):
+            clean_terms(self.configuration, ("id",), "icontains", ["7x"])
+        for term in ("nan", "inf", "7x"):
+            with self.assertRaisesRegex(SearchSpecError, "whole number"):
+                clean_terms(self.configuration, ("id",), "gt", [term])
+        with self.assertRaisesRegex(SearchSpecError, "whole number"):
+            clean_terms(self.configuration, ("id",), "gt", ["1.5"])
+
+
+class InListTests(TestCase):
+    def setUp(self):
+        self.request = RequestFactory().get("/")
+        self.request.user = get_user_model().objects.create(username="admin", is_superuser=True)
+        self.companies = [
+            Company.objects.create(name="Co %d" % i, slug="co%d" % i, company_type="rater")
+            for i in range(5)
+        ]
+
+    def test_list_terms(self):
+        constraints = [("and", "name", "is one of", "Co 1\nCo 2, Co 1,,Co 3\r\n")]
+        searcher = Searcher(self.request, model=Company, constraints=constraints)
+        self.assertEqual(searcher.constraints[0][3], ["Co 1", "Co 2", "Co 3"])
+        self.assertEqual(searcher.get_natural_string(), "where Name is one of Co 1, Co 2, Co 3")
+        searcher._perform_search()
+        self.assertEqual(searcher.results["count"], 3)
+
+        # Long lists are split into several lookups of one query
+        search[Company].in_chunk_size = 2
+        self.addCleanup(setattr, search[Company], "in_chunk_size", ModelSearch.in_chunk_size)
+        query = searcher.get_query()
+        self.assertEqual(len(query.children), 2)
+        self.assertEqual(Company.objects.filter(query).count(), 3)
+
+    def test_text_lists_ignore_case(self):
+        constraints = [("and", "name", "is one of", "co 1, CO 2, Co 9")]
+        searcher = Searcher(self.request, model=Company, constraints=constraints)
+        self.assertEqual(searcher.constraints[0][3], ["co 1", "CO 2", "Co 9"])
+        searcher._perform_search()
+        self.assertEqual(searcher.results["count"], 2)
+
+        # Choice values are matched exactly, as stored
+        constraints = [("and", "company_type", "is one of", "RATER, builder")]
+        searcher = Searcher(self.request, model=Company, constraints=constraints)
+        self.assertEqual(searcher.constraints[0][3], ["rater", "builder"])
+        searcher._perform_search()
+        self.assertEqual(searcher.results["count"], 5)
+
+    def test_values_file(self):
+        data = get_querydict(
+            search[Company],
+            ("name", "is one of", "Co 0"),
+            **{"form-0-term_file": SimpleUploadedFile("names.txt", b"Co 3\nCo 4\n")},
+        )
+        data["csrfmiddlewaretoken"] = "token"
+        self.client.force_login(self.request.user)
+        response = self.client.post(reverse("search"), data)
+        search_context = response.context["search"]
+        self.assertEqual(search_context.results["count"], 3)
+
+        # The form can post files, and links to variations of the search leave out the token
+        self.assertContains(response, 'name="form-0-term_file"')
+        url = search_context.get_narrowed_url(("company_type",), "rater")
+        self.assertIn("form-1-term=rater", url)
+        self.assertNotIn("csrfmiddlewaretoken", url)
+
+
+class GroupTests(TestCase):
+    def setUp(self):
+        self.request = RequestFactory().get("/")
+        self.request.user = get_user_model().objects.create(username="admin", is_superuser=True)
+        for i, company_type in enumerate(["builder", "rater", "provider", "rater"]):
+            Company.objects.create(name="Co %d" % i, slug="co%d" % i, company_type=company_type)
+
+    def test_groups(self):
+        constraints = [
+            ("and", "name", "contains", "Co"),
+            (
+                "and",
+                [
+                    ("and", "company_type", "is", "Builder"),
+                    ("or", "company_type", "is", "Provider"),
+                ],
+            ),
+        ]
+        searcher = Searcher(self.request, model=Company, constraints=constraints)
+        self.assertEqual(
+            searcher.get_natural_string(),
+            "where Name contains Co, and (Company type is builder, or Company type is provider)",
+        )
+        searcher._perform_search()
+        self.assertEqual(searcher.results["count"], 2)
+
+        saved = SavedSearch.from_searcher(searcher, "Grouped")
+        self.assertEqual(saved.constraints[1][:3], ["and", [], "()"])
+        saved.save()
+        self.assertEqual(saved.get_queryset().count(), 2)
+
+    def test_optimizer(self):
+        engine = search[Company].get_engine()
+        constraints = engine.clean_constraints(
+            [
+                ("and", "name", "contains", "Co"),
+                ("and", "name", "contains", "Co"),
+                (
+                    "and",
+                    [
+                        ("and", "company_type", "is", "Builder"),
+                        ("or", [("and", "company_type", "is", "Rater")]),
+                    ],
+                ),
+            ]
+        )
+        # Duplicates are dropped, the equalities merged and the cheaper constraint moved first
+        query = engine.build_query(constraints)
+        self.assertEqual(
+            query.children, [("company_type__in", ["builder", "rater"]), ("name__icontains", "Co")]
+        )
+        self.assertEqual(Company.objects.filter(query).count(), 3)
+        unoptimized = engine.build_query(constraints, optimize=False)
+        self.assertEqual(Company.objects.filter(unoptimized).count(), 3)
+
+    def test_formset_groups(self):
+        data = get_querydict(
+            search[Company],
+            ("name", "contains", "Co"),
+            ("company_type", "is", "Builder"),
+            ("company_type", "is", "Provider"),
+            **{"form-1-open_groups": "1", "form-2-type": "or", "form-2-close_groups": "1"},
+        )
+        self.client.force_login(self.request.user)
+        response = self.client.get(reverse("search"), data)
+        self.assertEqual(response.context["search"].results["count"], 2)
+
+        data["form-2-close_groups"] = "0"
+        response = self.client.get(reverse("search"), data)
+        formset = response.context["search"].constraint_formset
+        self.assertEqual(formset.non_form_errors(), ["An opening parenthesis is never closed."])
+
+
+class CompoundFieldTests(TestCase):
+    def setUp(self):
+        class UserNameCompanySearch(ModelSearch):
+            display_fields = ("name",)
+            search_fields = (
+                "name",
+                {"users": (("User name", ("first_name", "last_name")),)},
+            )
+
+        self.configuration = UserNameCompanySearch(Company)
+        self.company = Company.objects.create(name="Co", slug="co", company_type="rater")
+        Company.objects.create(name="Other", slug="other", company_type="rater")
+        for username, first_name, last_name in [("js", "John", "Smith"), ("jd", "Jane", "Smithy")]:
+            get_user_model().objects.create(
+                username=username, first_name=first_name, last_name=last_name, company=self.company
+            )
+
+    def test_sibling_paths_share_a_subquery(self):
+        engine = self.configuration.get_engine()
+        field = ("users__first_name", "users__last_name")
+        constraints = engine.clean_constraints([("and", field, "contains", "smith")])
+        query = engine.build_query(constraints)
+        self.assertEqual(query.children[0][0], "pk__in")
+        queryset = Company.objects.filter(query)
+        self.assertEqual(list(queryset), [self.company])
+        self.assertNotIn("JOIN", str(queryset.query).split("IN (")[0])
+
+        # The relationship is only joined, and counted, once
+        self.assertEqual(estimate_cost(self.configuration, constraints), 8)
+
+        # Negations keep ORing the paths
+        constraints = engine.clean_constraints([("and", field, "!icontains", "smith")])
+        self.assertEqual(len(engine.build_query(constraints).children), 2)
+
+    def test_concatenated_fields(self):
+        self.configuration.concatenated_fields = (("users__first_name", "users__last_name"),)
+        self.configuration._process_concatenated_fields()
+        engine = self.configuration.get_engine()
+        field = ("users__first_name", "users__last_name")
+        constraints = engine.clean_constraints([("and", field, "contains", "john smith")])
+        self.assertEqual(
+            list(Company.objects.filter(engine.build_query(constraints))), [self.company]
+        )
+        # Values from different related rows aren't concatenated together
+        constraints = engine.clean_constraints([("and", field, "contains", "john smithy")])
+        self.assertFalse(Company.objects.filter(engine.build_query(constraints)).exists())
+
+        self.configuration.concatenated_fields = (("name",),)
+        with self.assertRaises(ValueError):
+            self.configuration._process_concatenated_fields()
+
+
+class SuggestionTests(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create(username="admin", is_superuser=True)
+        for i, name in enumerate(["Alpha", "alpine", "Beta", "Alpha"]):
+            Company.objects.create(name=name, slug="co%d" % i, company_type="rater")
+        self.configuration = search[Company]
+
+    def get_suggestions(self, field, term):
+        response = self.client.get(
+            reverse("search-suggestions"),
+            {
+                "model": self.configuration._content_type.id,
+                "field": get_field_hash(field),
+                "term": term,
+            },
+        )
+        return response.json()["suggestions"]
+
+    def test_suggestions(self):
+        self.assertEqual(self.get_suggestions(("name",), "al"), ["Alpha", "alpine"])
+        self.assertEqual(self.get_suggestions(("company_type",), "r"), ["Rater"])
+        self.assertEqual(self.get_suggestions(("name",), " "), [])
+
+        with self.assertNumQueries(1):
+            self.configuration.get_suggestions(("name",), "al", limit=1)
+
+    def test_cached_suggestions(self):
+        self.addCleanup(value_cache.clear)
+        self.configuration.cached_suggestion_fields = ("name",)
+        self.addCleanup(delattr, self.configuration, "cached_suggestion_fields")
+
+        with self.assertNumQueries(1):
+            self.assertEqual(self.configuration.get_suggestions(("name",), "B"), ["Beta"])
+            self.assertEqual(
+                self.configuration.get_suggestions(("name",), "al"), ["Alpha", "alpine"]
+            )
+
+    def test_cached_suggestions_respect_queryset(self):
+        self.addCleanup(value_cache.clear)
+
+        class ScopedCompanySearch(ModelSearch):
+            display_fields = ("name",)
+            search_fields = ("name",)
+            cached_suggestion_fields = ("name",)
+
+            def get_queryset(self, request, user):
+                queryset = super(ScopedCompanySearch, self).get_queryset(request, user)
+                return queryset if user.is_superuser else queryset.exclude(name="Beta")
+
+        registry = SearchRegistry()
+        registry.register(Company, ScopedCompanySearch)
+        configuration = registry[Company]
+        other = get_user_model().objects.create(username="other")
+
+        self.assertEqual(configuration.get_suggestions(("name",), "b", user=self.user), ["Beta"])
+        self.assertEqual(configuration.get_suggestions(("name",), "b", user=other), [])
+        with self.assertNumQueries(0):
+            self.assertEqual(configuration.get_suggestions(("name",), "b", user=other), [])
+
+
+class ValueDictionaryTests(TestCase):
+    def setUp(self):
+        class DictionaryCompanySearch(ModelSearch):
+            display_fields = ("name",)
+            search_fields = ("name", "slug")
+            value_dictionary_fields = ("name",)
+
+        self.registry = register_search(self, Company, DictionaryCompanySearch)
+        self.configuration = self.registry[Company]
+
+        for i, name in enumerate(["Plumbing", "Heating & plumbing", "Roofing"]):
+            Company.objects.create(name=name, slug="co%d" % i, company_type="rater")
+
+    def test_terms_are_rewritten(self):
+        engine = self.configuration.get_engine()
+        constraints = engine.clean_constraints([("and", "name", "contains", "plumb")])
+        query = engine.build_query(constraints)
+        self.assertEqual(query.children[0][0], "name__in")
+        self.assertEqual(sorted(query.children[0][1]), ["Heating & plumbing", "Plumbing"])
+        self.assertEqual(Company.objects.filter(query).count(), 2)
+
+        constraints = engine.clean_constraints([("and", "name", "!iexact", "roofing")])
+        self.assertEqual(Company.objects.filter(engine.build_query(constraints)).count(), 2)
+
+        # The dictionary is reused until a change to the model discards it
+        with self.assertNumQueries(0):
+            engine.build_query(constraints)
+        Company.objects.create(name="Roofing Co", slug="co3", company_type="rater")
+        constraints = engine.clean_constraints([("and", "name", "contains", "roof")])
+        self.assertEqual(Company.objects.filter(engine.build_query(constraints)).count(), 2)
+
+    def test_large_dictionaries_are_skipped(self):
+        self.configuration.value_dictionary_max_size = 2
+        engine = self.configuration.get_engine()
+        constraints = engine.clean_constraints([("and", "name", "contains", "plumb")])
+        self.assertEqual(engine.build_query(constraints).children[0][0], "name__icontains")
+
+
+class RowCacheTests(TestCase):
+    def setUp(self):
+        class CachedCompanySearch(ModelSearch):
+            display_fields = ("name", "slug")
+            search_fields = ("name", {"users": ("first_name",)})
+            row_cache_timeout = 60
+
+        self.registry = register_search(self, Company, CachedCompanySearch)
+        self.configuration = self.registry[Company]
+        self.addCleanup(cache.clear)
+
+        self.company = Company.objects.create(name="Co", slug="co", company_type="rater")
+        Company.objects.create(name="Other", slug="other", company_type="rater")
+
+    def get_rows(self):
+        built = []
+        get_object_data = self.configuration.get_object_data
+
+        def build(obj):
+            built.append(obj.pk)
+            return get_object_data(obj)
+
+        self.configuration.get_object_data = build
+        try:
+            rows = self.configuration.get_objects_data(Company.objects.order_by("pk"))
+        finally:
+            del self.configuration.get_object_data
+        return rows, built
+
+    def test_rows_are_cached(self):
+        rows, built = self.get_rows()
+        self.assertEqual(rows, [["Co", "co"], ["Other", "other"]])
+        self.assertEqual(len(built), 2)
+        self.assertEqual(self.get_rows(), (rows, []))
+
+        # Saving an object discards its own row
+        self.company.name = "Co 2"
+        self.company.save()
+        rows, built = self.get_rows()
+        self.assertEqual(rows[0], ["Co 2", "co"])
+        self.assertEqual(built, [self.company.pk])
+
+        # A change to a related model discards every row
+        get_user_model().objects.create(username="user", company=self.company)
+        self.assertEqual(len(self.get_rows()[1]), 2)
+
+
+class SnapshotTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "snapshot.json")
+
+        state = dict(appsearch.snapshot._state)
+        self.addCleanup(appsearch.snapshot._state.update, state)
+
+    def test_snapshot_restores_fields(self):
+        call_command("build_search_snapshot", output=self.path, stdout=StringIO())
+        snapshot = load_snapshot(self.path)
+        entry = snapshot["configurations"]["company.Company"]
+        self.assertEqual(entry["content_type"], ContentType.objects.get_for_model(Company).pk)
+        self.assertIn(["is", "exact"], entry["fields"][1]["operators"])
+
+        appsearch.snapshot._state.update(loaded=False, snapshot=None, stale=False)
+        with override_settings(APPSEARCH_SNAPSHOT_PATH=self.path):
+            self.assertEqual(get_snapshot_path(), self.path)
+            with mock.patch.object(ModelSearch, "_process_searchable_fields") as process:
+                with mock.patch.object(ModelSearch, "_process_operators") as process_operators:
+                    configuration = search[Company].__class__(Company)
+            process.assert_not_called()
+            process_operators.assert_not_called()
+        self.assertEqual(configuration._fields, search[Company]._fields)
+        self.assertEqual(configuration._field_hashes, search[Company]._field_hashes)
+        self.assertEqual(configuration.field_types, search[Company].field_types)
+        self.assertEqual(configuration._operators, search[Company]._operators)
+
+    def test_snapshot_keeps_translated_names(self):
+        class LabelledCompanySearch(ModelSearch):
+            display_fields = ("name",)
+            search_fields = ((gettext_lazy("Name"), "name"), {"users": ("username",)})
+
+        write_snapshot({"company": LabelledCompanySearch(Company)}, path=self.path)
+        fields = load_snapshot(self.path)["configurations"]["company.Company"]["fields"]
+        self.assertEqual(
+            [info["verbose_name"] for info in fields], [None, ["users.User", "username", True]]
+        )
+
+        appsearch.snapshot._state.update(loaded=False, snapshot=None, stale=False)
+        with override_settings(APPSEARCH_SNAPSHOT_PATH=self.path), translation.override("de"):
+            with mock.patch.object(ModelSearch, "_process_searchable_fields") as process:
+                configuration = LabelledCompanySearch(Company)
+            process.assert_not_called()
+            self.assertIs(
+                configuration._fields[("name",)], LabelledCompanySearch.search_fields[0][0]
+            )
+            self.assertEqual(configuration._fields[("users__username",)], "Benutzer Benutzername")
+
+    def test_stale_snapshots_are_rebuilt(self):
+        with open(self.path, "w") as f:
+            json.dump({"version": 1, "fingerprint": "outdated", "configurations": {}}, f)
+
+        appsearch.snapshot._state.update(loaded=False, snapshot=None, stale=False)
+        with override_settings(APPSEARCH_SNAPSHOT_PATH=self.path):
+            search[Company].__class__(Company)
+            self.assertTrue(appsearch.snapshot._state["stale"])
+            appsearch.autodiscover()
+        self.assertIn("company.Company", load_snapshot(self.path)["configurations"])
+
+
+class RegistryLintTests(TestCase):
+    def test_reports(self):
+        class SprawlingCompanySearch(ModelSearch):
+            display_fields = ("name", "users__username")
+            search_fields = ("name", "description", {"users": ("first_name",)})
+
+        report = inspect_configuration(SprawlingCompanySearch(Company))
+        self.assertEqual(report.field_count, 3)
+        self.assertEqual(report.max_join_depth, 1)
+        self.assertEqual(report.max_many_valued_hops, 1)
+        self.assertFalse(report.errors)
+        messages = {(issue.path, issue.message) for issue in report.warnings}
+        self.assertIn(
+            ("users__first_name", "Unindexed search path crosses 1 relationships"), messages
+        )
+        self.assertIn(
+            ("users__username", "Display path crosses a many-valued relationship"), messages
+        )
+        self.assertIn(
+            ("description", "Equality search on a TextField can't use an index"), messages
+        )
+
+    def test_command_thresholds(self):
+        stdout = StringIO()
+        call_command("check_search_registry", stdout=stdout)
+        self.assertIn("company.Company: 2 fields", stdout.getvalue())
+
+        with self.assertRaisesMessage(CommandError, "search fields"):
+            call_command("check_search_registry", max_fields=1, stdout=StringIO())
+
+
+class QueryCountTests(SearchQueryTestMixin, TestCase):
+    def setUp(self):
+        cache.clear()
+        User = get_user_model()
+        self.request = RequestFactory().get("/search/")
+        self.request.user = User.objects.create(username="admin", is_superuser=True)
+        for i, company_type in enumerate(["builder", "rater", "provider"]):
+            company = Company.objects.create(
+                name="Company {}".format(i), slug="c{}".format(i), company_type=company_type
+            )
+            for j in range(4):
+                User.objects.create(
+                    username="user{}{}".format(i, j), first_name="Ann", company=company
+                )
+
+    def test_company_search(self):
+        querydict = get_querydict(search[Company], ("name", "contains", "company"))
+        searcher = self.assertSearchQueries(3, self.request, querydict=querydict)
+        self.assertEqual(searcher.results["count"], 3)
+
+    def test_user_search_selects_companies(self):
+        """Users display their company's name, which must not cost a query per row."""
+        User = get_user_model()
+        querydict = get_querydict(search[User], ("company__name", "contains", "company"))
+        searcher = self.assertSearchQueries(4, self.request, querydict=querydict)
+        self.assertEqual(searcher.results["count"], 12)
+
+        company = Company.objects.create(name="Company 3", slug="c3", company_type="rater")
+        for j in range(8):
+            User.objects.create(username="user3{}".format(j), company=company)
+        cache.clear()
+        searcher = self.assertSearchQueries(4, self.request, querydict=querydict)
+        self.assertEqual(searcher.results["count"], 20)
+
+    def test_budget_reports_repeated_queries(self):
+        def count_users(searcher, model, config, queryset):
+            return [(obj.pk, [obj.name, obj.users.count()]) for obj in queryset]
+
+        constraints = [("and", "name", "contains", "company")]
+        with self.assertRaisesRegex(AssertionError, "2 duplicate queries"):
+            self.assertSearchQueries(
+                None,
+                self.request,
+                model=Company,
+                constraints=constraints,
+                process_results_callback=count_users,
+            )
+
+        @QueryBudget(max_queries=1)
+        def count_companies():
+            return Company.objects.count() + Company.objects.filter(slug="c0").count()
+
+        with self.assertRaisesRegex(AssertionError, "2 queries executed on 'default'"):
+            count_companies()
+
+
+class OperatorTests(TestCase):
+    def test_operator_lookups(self):
+        configuration = search[Company]
+        lookups = configuration.get_operator_lookups(field=("name",))
+        self.assertEqual(lookups["= equal"], "iexact")
+        self.assertNotIn("exists", lookups)
+        self.assertIs(configuration.get_operator_lookups(hash=get_field_hash(("name",))), lookups)
+        self.assertEqual(configuration.get_operator_lookups(hash="unknown"), {})
+
+        engine = configuration.get_engine()
+        self.assertEqual(engine.resolve_operator(("company_type",), "is"), "exact")
+        self.assertEqual(engine.resolve_operator(("company_type",), "in"), "in")
+        with self.assertRaises(SearchSpecError):
+            engine.resolve_operator(("company_type",), "icontains")
+
+    def test_form_validates_labels(self):
+        def get_form(operator):
+            data = {
+                "type": "and",
+                "field": get_field_hash(("company_type",)),
+                "operator": operator,
+                "term": "Builder",
+            }
+            return ConstraintForm(search[Company], data)
+
+        form = get_form("is")
+        self.assertTrue(form.is_valid())
+        self.assertEqual(form.cleaned_data["operator"], "exact")
+        self.assertEqual(
+            form.fields["operator"].choices, [("is", "is"), ("is one of", "is one of")]
+        )
+
+        form = get_form("exact")
+        self.assertFalse(form.is_valid())
+        self.assertIn("operator", form.errors)
+
+
+class LimitTests(TestCase):
+    def setUp(self):
+        self.request = RequestFactory().get("/")
+        self.request.user = get_user_model().objects.create(username="admin", is_superuser=True)
+
+        class LimitedCompanySearch(ModelSearch):
+            display_fields = ("name",)
+            search_fields = ("name", "company_type")
+            max_constraints = 2
+            max_list_size = 3
+
+        class LimitedRegistry(SearchRegistry):
+            max_term_length = 10
+
+        self.registry = LimitedRegistry()
+        self.registry.register(Company, LimitedCompanySearch)
+        self.configuration = self.registry[Company]
+
+    def get_searcher(self, *constraints, total=None, files=None):
+        querydict = get_querydict(self.configuration, *constraints, total=total)
+        return Searcher(self.request, querydict=querydict, registry=self.registry, files=files)
+
+    def assertRefused(self, searcher, message):
+        self.assertFalse(searcher.ready)
+        self.assertFalse(searcher.constraint_formset.is_bound)
+        self.assertEqual(searcher.constraint_formset.non_form_errors(), [message])
+
+    def test_limits_are_inherited(self):
+        self.assertEqual(self.configuration.max_constraints, 2)
+        self.assertEqual(self.configuration.max_term_length, 10)
+        self.assertEqual(search[Company].max_constraints, SearchRegistry.max_constraints)
+
+    def test_querydict_limits(self):
+        searcher = self.get_searcher(("name", "contains", "one"), ("company_type", "is", "rater"))
+        self.assertTrue(searcher.ready)
+
+        searcher = self.get_searcher(("name", "contains", "one"), total=100000)
+        self.assertRefused(searcher, "Searches are limited to 2 constraints.")
+        searcher = self.get_searcher(("name", "contains", "a" * 11))
+        self.assertRefused(searcher, "Search terms are limited to 10 characters.")
+        searcher = self.get_searcher(("name", "is one of", "a, b, c, d"))
+        self.assertRefused(searcher, '"is one of" lists are limited to 3 values.')
+
+        # List terms are only limited by their number of values
+        self.assertTrue(self.get_searcher(("name", "is one of", "alpha, bravo, charlie")).ready)
+
+        # Values files are refused by size before they are read
+        upload = SimpleUploadedFile("values.txt", b"a\n" * 17)
+        searcher = self.get_searcher(("name", "is one of", ""), files={"form-0-term_file": upload})
+        self.assertRefused(searcher, "Values files are limited to 33 bytes.")
+        self.assertEqual(upload.tell(), 0)
+        upload = SimpleUploadedFile("values.txt", b"a\nb\n")
+        searcher = self.get_searcher(("name", "is one of", ""), files={"form-0-term_file": upload})
+        self.assertTrue(searcher.ready)
+
+    def test_constraint_limits(self):
+        def get_searcher(*constraints):
+            return Searcher(
+                self.request, model=Company, constraints=constraints, registry=self.registry
+            )
+
+        with self.assertRaisesMessage(SearchSpecError, "limited to 2 constraints"):
+            get_searcher(
+                ("and", "name", "contains", "a"),
+                ("or", [("and", "name", "contains", "b"), ("and", "name", "contains", "c")]),
+            )
+        with self.assertRaisesMessage(SearchSpecError, "limited to 10 characters"):
+            get_searcher(("and", "name", "contains", "a" * 11))
+        with self.assertRaisesMessage(SearchSpecError, "limited to 3 values"):
+            get_searcher(("and", "name", "in", ["a", "b", "c", "d"]))
@@ -3,22 +3,31 @@
 import json
 import logging
 from collections import defaultdict
-from functools import reduce
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha1 as sha
+from itertools import islice
 from operator import itemgetter
 
+from django.core.cache import cache
+from django.db import connections
 from django.db.models.constants import LOOKUP_SEP
-from django.db.models.query import Q
-from django.forms.formsets import formset_factory
+from django.forms.formsets import TOTAL_FORM_COUNT, formset_factory
 from django.template import RequestContext
 from django.template.loader import render_to_string
 from django.utils.safestring import mark_safe
 
+from .engine import CONSTRAINT_TYPES, GROUP, SearchSpecError
 from .forms import ConstraintForm, ConstraintFormset, ModelSelectionForm
-from .registry import search
+from .registry import get_field_hash, search
 
 
 log = logging.getLogger(__name__)
 
+# Left by the results list template in place of the table rows when rendered for streaming
+STREAMING_ROWS_MARKER = "<!-- appsearch:rows -->"
+
+CONSTRAINT_TYPE_NAMES = {v: k for k, v in CONSTRAINT_TYPES.items()}
+
 
 class Searcher(object):
     """Template helper, wrapping all the necessary components to render an appsearch page."""
@@ -34,6 +43,16 @@ class Searcher(object):
     # Instance data
     model_selection_form = None
     constraint_formset = None
+    model = None
+    model_config = None
+    constraints = None
+    saved_search = None
+    sort = None
+    since = None
+    incremental = False
+    database = None
+    suggestion_url = None
+    cost_warnings = ()
 
     results = None
 
@@ -45,19 +64,60 @@ class Searcher(object):
     # Fallback items normally provided by the view
     context_object_name = "search"
 
+    # Upper bound on the threads running facet count queries for one search
+    facet_max_workers = 4
+
+    # Number of rows rendered per chunk by ``stream_results_list()``
+    stream_chunk_size = 500
+
+    # Render the table rows with the configuration's compiled ``RowRenderer`` instead of the
+    # ``results_rows_template_name`` template loop
+    compiled_rows = False
+
     # Default templates
     form_template_name = "appsearch/default_form.html"
     search_form_template_name = "appsearch/search_form.html"
     results_list_template_name = "appsearch/results_list.html"
-
-    def __init__(self, request, url=None, querydict=None, registry=search, **kwargs):
+    results_rows_template_name = "appsearch/results_rows.html"
+
+    def __init__(
+        self,
+        request,
+        url=None,
+        querydict=None,
+        registry=search,
+        model=None,
+        constraints=None,
+        **kwargs,
+    ):
         self.kwargs = kwargs
         self.request = request
         self.url = url or request.path
+        self.registry = registry
+        if request.method == "POST":
+            self.querydict = request.POST if querydict is None else querydict
+            self.files = kwargs.get("files", request.FILES)
+        else:
+            self.querydict = request.GET if querydict is None else querydict
+            self.files = kwargs.get("files")
+        self.sort = kwargs.get("sort", self.querydict.get("sort")) or None
+
+        self.database = kwargs.get("database", self.database)
+        self.suggestion_url = kwargs.get("suggestion_url", self.suggestion_url)
+
+        # Incremental searches only return rows beyond the ``since`` watermark
+        self.incremental = "since" in kwargs or "since" in self.querydict
+        self.since = kwargs.get("since", self.querydict.get("since")) or None
 
         self._forms_ready = False
-        self._set_up_forms(querydict or request.GET, registry)
-        self.registry = registry
+        self.saved_search = kwargs.get("saved_search")
+        if self.saved_search is not None:
+            model = self.saved_search.model
+            constraints = self.saved_search.constraints
+        if constraints is not None:
+            self._set_up_constraints(model, constraints, registry)
+        else:
+            self._set_up_forms(self.querydict, registry)
 
         # Fallback items
         self.context_object_name = kwargs.get("context_object_name", self.context_object_name)
@@ -68,6 +128,10 @@ class Searcher(object):
         self.results_list_template_name = kwargs.get(
             "results_list_template_name", self.results_list_template_name
         )
+        self.results_rows_template_name = kwargs.get(
+            "results_rows_template_name", self.results_rows_template_name
+        )
+        self.compiled_rows = kwargs.get("compiled_rows", self.compiled_rows)
 
         self._display_fields_callback = kwargs.get("display_fields_callback")
         self._build_queryset_callback = kwargs.get("build_queryset_callback")
@@ -104,6 +168,20 @@ class Searcher(object):
             ).flatten(),
         )
 
+    def render_rows(self, rows=None):
+        """
+        Renders the table rows for ``rows`` (by default, the search's result list), using the
+        compiled ``RowRenderer`` when ``compiled_rows`` is set or else the template at
+        ``results_rows_template_name``.
+
+        """
+
+        if rows is None:
+            rows = self.results["list"]
+        if self.compiled_rows:
+            return self.model_config.get_row_renderer().render(rows)
+        return render_to_string(self.results_rows_template_name, {"rows": rows})
+
     def render_constraint_fields(self, model):
         """Renders into JSON the model's fields available for search queries."""
 
@@ -171,10 +249,6 @@ class Searcher(object):
     @property
     def ready(self):
         """Indicates if a search has been executed by the constructed state."""
-
-        if self._forms_ready:
-            self.model_config = self.model_selection_form.get_selected_configuration()
-            self.model = self.model_config.model
         return self._forms_ready
 
     def _set_up_forms(self, querydict, registry):
@@ -189,110 +263,317 @@ class Searcher(object):
 
         if self.model_selection_form.is_valid():
             model_configuration = self.model_selection_form.get_selected_configuration()
-            self.constraint_formset = ConstraintFormsetClass(model_configuration, querydict)
+            self.constraint_formset = ConstraintFormsetClass(
+                model_configuration, querydict, self.files
+            )
             if self.constraint_formset.is_valid():
+                try:
+                    since = self._clean_since(model_configuration)
+                except SearchSpecError as e:
+                    self.constraint_formset.spec_error = str(e)
+                    return
+                self.model_config = model_configuration
+                self.model = model_configuration.model
+                self.constraints = self.constraint_formset.get_constraints()
+                self.cost_warnings = self.constraint_formset.cost_warnings
+                self.since = since
                 self._forms_ready = True
         else:
             self.model_selection_form = ModelSelectionFormClass(registry, self.request.user)
             self.constraint_formset = ConstraintFormsetClass(configuration=None)
 
-    def _perform_search(self):
+    def _set_up_constraints(self, model, constraints, registry):
         """
-        Generates the query using the validated constraint formset.  Also compiles a natural
-        language string (``self.natural_string``) in the format of
-        "N [Model]s with [field] [operator] '[term]'".
+        Validates programmatic ``constraints`` for ``model`` through the configuration's
+        ``SearchEngine``, bypassing the forms entirely.  Invalid constraints, and searches refused
+        by the configuration's cost thresholds, raise ``appsearch.engine.SearchSpecError``, as does
+        a ``since`` watermark that isn't a value of the configuration's watermark field.
 
         """
 
-        natural_string = []
-
-        # 2-tuples of an operator and Q instance, sent through reduce() after it's built
-        query_list = []
-
-        for i, constraint_form in enumerate(self.constraint_formset):
-            type_operator = constraint_form.cleaned_data["type"]
-            field_list = constraint_form.cleaned_data["field"]
-            constraint_operator = constraint_form.cleaned_data["operator"]
-            term = constraint_form.cleaned_data["term"]
-            # _end_term = constraint_form.cleaned_data['end_term']
+        model_configuration = registry.get_configuration(model, user=self.request.user)
+        if model_configuration is None:
+            raise SearchSpecError("No searchable configuration for {!r}".format(model))
 
-            verbose_name = self.model_config._fields[field_list]
+        self.model_config = model_configuration
+        self.model = model_configuration.model
+        self.constraints = model_configuration.get_engine().clean_constraints(constraints)
+        self.cost_warnings = model_configuration.check_search_cost(self.constraints)
+        self.since = self._clean_since(model_configuration)
+        self._forms_ready = True
 
-            # Build this field's query.
-            # Search fields bound together in a tuple are considered OR conditions for a single
-            # virtual field name.
-            query = None
-
-            # Iterate multiple fields defined in a compound column
-            for field in field_list:
-                value = term
-                # _target_field = resolve_orm_path(self.model, field)
+        # Unbound forms are still made available for rendering
+        self.model_selection_form = self.get_model_selection_form_class()(
+            registry, self.request.user
+        )
+        ConstraintFormsetClass = formset_factory(
+            self.get_constraint_form_class(), formset=self.get_constraint_formset_class()
+        )
+        self.constraint_formset = ConstraintFormsetClass(configuration=None)
 
-                # Prep an inverted lookup
-                negative = constraint_operator.startswith("!")
-                if negative:
-                    constraint_operator = constraint_operator[1:]
+    def _clean_since(self, model_configuration):
+        """Returns the ``since`` watermark converted to the configuration's watermark field."""
+        if not self.incremental:
+            return self.since
+        return model_configuration.clean_watermark(self.since)
 
-                if constraint_operator == "isnull":
-                    value = not negative
-                    negative = False
+    def get_query(self):
+        """Returns the ``Q`` instance for the validated constraints."""
+        return self.model_config.get_engine().build_query(self.constraints)
 
-                # Bake the queryset language string
-                field_query = LOOKUP_SEP.join((field, constraint_operator))
+    def get_natural_string(self):
+        """
+        Compiles a natural language string describing the validated constraints, in the format of
+        "where [field] [operator] [term], and [field] [operator] [term]".  Groups are shown in
+        parentheses.
 
-                q = Q(
-                    **{
-                        field_query: value,
-                    }
-                )
-                log.debug(
-                    "Querying %s [%d]: %s%s=%r",
-                    self.model.__name__,
-                    i,
-                    field_query,
-                    "!" if negative else "",
-                    value,
-                )
+        """
 
-                # Negate if necessary
-                if negative:
-                    q = ~q
+        return "where " + self._get_natural_bits(self.constraints)
 
-                if query is None:
-                    query = q
+    def _get_natural_bits(self, constraints):
+        natural_string = []
+        for i, (type, field, operator, term) in enumerate(constraints):
+            if operator == GROUP:
+                bits = ["({})".format(self._get_natural_bits(term))]
+            else:
+                if operator == "in":
+                    term = ", ".join(map(str, term))
+                elif isinstance(term, (tuple, list)):
+                    term = " - ".join(list(map(str, term)))
                 else:
-                    query |= q
+                    term = str(term)
+                operator_labels = dict(self.model_config.get_operator_choices(field=field))
+                bits = [self.model_config._fields[field], operator_labels[operator], term]
+            if i != 0:  # Skip the leading "and" on the first constraint
+                bits.insert(0, CONSTRAINT_TYPE_NAMES[type])
+            natural_string.append(" ".join(filter(None, bits)))
+        return ", ".join(natural_string)
 
-            query_list.append((type_operator, query))
+    def _perform_search(self):
+        """
+        Generates the query using the validated constraints and executes it, storing the data for
+        the templates in ``self.results``.
 
-            # Do some natural processing
-            if isinstance(value, (tuple, list)):
-                value = " - ".join(list(map(str, value)))
-            else:
-                value = str(value)
-            bits = [verbose_name, constraint_form["operator"].value(), value]
-            if i != 0:  # Skip the leading "and" on the first constraint
-                bits.insert(0, constraint_form["type"].value())
-            natural_string.append(bits)
+        """
 
-        # The first query's "type" should be ignored for the sake of the reduce line below.
-        query = reduce(lambda q1, q2: q2[0](q1, q2[1]), query_list[1:], query_list[0][1])
+        query = self.get_query()
+        log.debug("Querying %s: %r", self.model.__name__, query)
 
         queryset = self.build_queryset(self.model, query)
         data_rows = self.process_results(queryset)
 
-        self.results = {
-            "count": len(queryset),
+        self.results = self._get_results(queryset, data_rows, len(queryset))
+
+    def _get_results(self, queryset, data_rows, count):
+        results = {
+            "count": count,
             "list": data_rows,
             "fields": self._get_display_fields(self.model, self.model_config),
-            "natural_string": "where " + ", ".join(map(" ".join, natural_string)),
+            "headers": self.get_result_headers(),
+            "natural_string": self.get_natural_string(),
+            "facets": self.get_facets(queryset),
         }
+        if self.incremental:
+            results["watermark"] = self.model_config.get_watermark(queryset, default=self.since)
+        return results
+
+    def stream_results_list(self):
+        """
+        Generator alternative to ``_perform_search()`` and ``render_results_list()``, suitable for
+        a ``StreamingHttpResponse``.
+
+        The template at ``results_list_template_name`` is rendered with a ``streaming`` flag, which
+        makes it leave a marker where the table rows go.  Everything up to the marker is emitted
+        first, then the rows are read from a queryset iterator and rendered ``stream_chunk_size``
+        rows at a time through ``render_rows()``, and finally the rest of the template.  Neither
+        the full result list nor the full page is ever held in memory.
+
+        """
+
+        query = self.get_query()
+        log.debug("Streaming %s: %r", self.model.__name__, query)
+
+        queryset = self.build_queryset(self.model, query)
+        self.results = self._get_results(queryset, [], queryset.count())
+
+        context = RequestContext(
+            self.request, {self.context_object_name: self, "streaming": True}
+        ).flatten()
+        head, tail = render_to_string(self.results_list_template_name, context).split(
+            STREAMING_ROWS_MARKER, 1
+        )
+        yield head
+
+        rows = queryset.iterator(chunk_size=self.stream_chunk_size)
+        while True:
+            chunk = list(islice(rows, self.stream_chunk_size))
+            if not chunk:
+                break
+            yield self.render_rows(self.process_results(chunk))
+
+        yield tail
 
     def _get_display_fields(self, model, config):
         if self._display_fields_callback:
             return self._display_fields_callback(self, model, config)
         return config.get_display_fields()
 
+    def get_ordering(self):
+        """
+        Returns the ``order_by()`` arguments for the requested ``sort``, or an empty list if no
+        sort was requested.  Sorts on fields that the configuration doesn't allow are ignored.
+
+        """
+
+        if not self.sort:
+            return []
+        try:
+            return self.model_config.get_ordering(self.sort)
+        except ValueError:
+            log.warning("Ignoring sort %r for %s", self.sort, self.model.__name__)
+            self.sort = None
+            return []
+
+    def get_facets(self, queryset):
+        """
+        Returns a list of dictionaries for the configuration's ``facet_fields``, each with the
+        field ``label`` and its ``values``: dictionaries of the value's ``label``, its ``count``
+        within ``queryset``, and a ``url`` that narrows the current search to that value.
+
+        The counts are cached for ``ModelSearch.facet_cache_timeout`` seconds, keyed on the query,
+        and the facet queries run concurrently on up to ``facet_max_workers`` threads.
+
+        """
+
+        facet_fields = self.model_config.get_facet_fields()
+        if not facet_fields:
+            return []
+
+        cache_key = None
+        if self.model_config.facet_cache_timeout:
+            query_key = "{}:{}".format(queryset.db, queryset.query)
+            cache_key = "appsearch:facets:{}".format(sha(query_key.encode("utf-8")).hexdigest())
+            counts = cache.get(cache_key)
+            if counts is not None:
+                return self._get_facet_data(facet_fields, counts)
+
+        def get_counts(field):
+            try:
+                return self.model_config.get_facet_counts(queryset, field)
+            finally:
+                # Each worker thread opened its own connection
+                connections[queryset.db].close()
+
+        # Other connections can't see data from an open transaction, so stay on this thread.
+        workers = min(len(facet_fields), self.facet_max_workers)
+        if connections[queryset.db].in_atomic_block or workers < 2:
+            counts = [self.model_config.get_facet_counts(queryset, f) for f in facet_fields]
+        else:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                counts = list(executor.map(get_counts, facet_fields))
+
+        if cache_key:
+            cache.set(cache_key, counts, self.model_config.facet_cache_timeout)
+        return self._get_facet_data(facet_fields, counts)
+
+    def _get_facet_data(self, facet_fields, counts):
+        facets = []
+        for field, field_counts in zip(facet_fields, counts):
+            field_type = self.model_config.field_types[field]
+            choices = dict(field_type.flatchoices)
+            values = []
+            for value, count in field_counts:
+                if field_type.choices:
+                    label = str(choices.get(value, value))
+                elif value is None:
+                    label = "None"
+                else:
+                    label = "true" if value else "false"
+                values.append(
+                    {
+                        "label": label,
+                        "count": count,
+                        "url": self.get_narrowed_url(field, label) if value is not None else None,
+                    }
+                )
+            facets.append({"label": self.model_config._fields[field], "values": values})
+        return facets
+
+    def get_link_querydict(self):
+        """
+        Returns a mutable copy of the submitted ``querydict`` for building links to variations of
+        the search, without the CSRF token of a POSTed search form.  Uploaded values files can't be
+        carried into a link.
+
+        """
+
+        querydict = self.querydict.copy()
+        querydict.pop("csrfmiddlewaretoken", None)
+        return querydict
+
+    def get_narrowed_url(self, field, term):
+        """
+        Returns the URL for the current search with an extra ANDed constraint requiring ``field``
+        to equal ``term``.  Only searches submitted through the forms can be narrowed.
+
+        """
+
+        formset = self.constraint_formset
+        if not formset.is_bound:
+            return None
+
+        operator_label = dict(self.model_config.get_operator_choices(field=field))["exact"]
+        querydict = self.get_link_querydict()
+        i = formset.total_form_count()
+        querydict[formset.management_form.add_prefix(TOTAL_FORM_COUNT)] = str(i + 1)
+        querydict[formset.add_prefix(i) + "-type"] = "and"
+        querydict[formset.add_prefix(i) + "-field"] = get_field_hash(field)
+        querydict[formset.add_prefix(i) + "-operator"] = operator_label
+        querydict[formset.add_prefix(i) + "-term"] = term
+        return "{}?{}".format(self.url, querydict.urlencode())
+
+    def get_result_headers(self):
+        """
+        Returns a list of dictionaries describing the results table's column headers, each with
+        the column ``label``, the ``url`` that sorts by the column (``None`` if the column isn't
+        sortable) and the current ``sort`` direction ("asc", "desc" or ``None``).
+
+        """
+
+        labels = self._get_display_fields(self.model, self.model_config)
+        if self._display_fields_callback:
+            # Custom columns can't be matched up with the configured sortable fields
+            return [{"label": label, "url": None, "sort": None} for label in labels]
+
+        sortable_fields = self.model_config.get_sortable_fields()
+        headers = []
+        for label, (_, field_name, _) in zip(labels, self.model_config._display_fields):
+            header = {"label": label, "url": None, "sort": None}
+            if field_name in sortable_fields:
+                sort = field_name
+                if self.sort == field_name:
+                    header["sort"] = "asc"
+                    sort = "-" + field_name
+                elif self.sort == "-" + field_name:
+                    header["sort"] = "desc"
+                querydict = self.get_link_querydict()
+                querydict["sort"] = sort
+                header["url"] = "{}?{}".format(self.url, querydict.urlencode())
+            headers.append(header)
+        return headers
+
+    def get_database(self):
+        """
+        Returns the database alias the search reads from: the ``database`` given to the searcher,
+        or else the one chosen by the configuration's ``get_database()``.
+
+        """
+
+        if self.database is not None:
+            return self.database
+        return self.model_config.get_database(self.request, self.request.user)
+
     def get_select_related_fields(self, model, config):
         """Returns a list of queryset language names to pass into ``.select_related()``"""
         display_fields = config._display_fields
@@ -316,6 +597,16 @@ class Searcher(object):
         being accessed for the initial queryset.  Passing up a ``queryset`` via super() will
         accomplish this, returning a fully built queryset with minimum hassle.
 
+        When the search was opened from a materialized ``saved_search``, the queryset is read from
+        its snapshot of primary keys instead of applying ``query``.
+
+        Incremental searches (given a ``since`` watermark) are limited to the rows beyond it.
+
+        The queryset reads from the database alias given by ``get_database()``, if any.
+
+        If a ``sort`` was requested on a sortable display field, the queryset is ordered by it,
+        with the primary key as a tiebreaker.
+
         If ``build_queryset`` callback was defined on the originating view, it will be called
         after the queryset is built and will be sent the searcher instance, model, config, initial
         ``Q`` query, and the derived queryset.  The callback should return the queryset in its final
@@ -328,7 +619,22 @@ class Searcher(object):
         if queryset is None:
             queryset = self.model_config.get_queryset(self.request, self.request.user)
 
-        queryset = queryset.filter(query).select_related(*related_names).distinct()
+        database = self.get_database()
+        if database is not None:
+            queryset = queryset.using(database)
+
+        if self.saved_search is not None and self.saved_search.has_snapshot():
+            # Read the materialized results instead of re-running the joins
+            queryset = queryset.filter(self.saved_search.get_snapshot_query())
+        else:
+            queryset = queryset.filter(query).distinct()
+        if self.incremental:
+            queryset = self.model_config.filter_since(queryset, self.since)
+        queryset = queryset.select_related(*related_names)
+
+        ordering = self.get_ordering()
+        if ordering:
+            queryset = queryset.order_by(*ordering)
 
         if self._build_queryset_callback:
             queryset = self._build_queryset_callback(
@@ -347,4 +653,4 @@ class Searcher(object):
         if self._process_results_callback:
             return self._process_results_callback(self, self.model, self.model_config, queryset)
 
-        return [self.model_config.get_object_data(obj) for obj in queryset]
+        return self.model_config.get_objects_data(queryset)
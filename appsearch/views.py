@@ -1,10 +1,41 @@
 """views.py: ORM Utils"""
 
-from django.views.generic import TemplateView
+import json
 
+from django.contrib.contenttypes.models import ContentType
+from django.core import signing
+from django.db.models.constants import LOOKUP_SEP
+from django.db.models.query import Q
+from django.http import HttpResponse, JsonResponse, QueryDict, StreamingHttpResponse
+from django.utils.decorators import method_decorator
+from django.views.decorators.csrf import csrf_exempt
+from django.views.generic import TemplateView, View
+
+from appsearch.admission import Admission, CacheSemaphore, SearchBusy
+from appsearch.cost import estimate_cost
+from appsearch.encoders import PreciseJSONEncoder
+from appsearch.engine import SearchSpecError
+from appsearch.registry import search
 from appsearch.utils import Searcher
 
 
+class CursorSerializer(signing.JSONSerializer):
+    """Allows dates and decimals from sort fields to be stored in API cursors."""
+
+    def dumps(self, obj):
+        return json.dumps(obj, separators=(",", ":"), cls=PreciseJSONEncoder).encode("latin-1")
+
+
+def get_path_value(obj, path):
+    """Follows the ORM ``path`` from ``obj``, returning ``None`` past an empty relationship."""
+
+    for name in path.split(LOOKUP_SEP):
+        if obj is None:
+            return None
+        obj = getattr(obj, name)
+    return obj
+
+
 class SearchMixin(object):
     searcher_class = Searcher
 
@@ -12,40 +43,168 @@ class SearchMixin(object):
     form_template_name = "appsearch/default_form.html"
     search_form_template_name = "appsearch/search_form.html"
     results_list_template_name = "appsearch/results_list.html"
+    results_rows_template_name = "appsearch/results_rows.html"
+
+    # Respond to executable searches with only the streamed results list
+    stream_results = False
+
+    # Render result rows with the compiled ``RowRenderer`` instead of the rows template
+    compiled_rows = False
+
+    # Database alias searches read from, overriding the ``ModelSearch.database`` routing
+    database = None
+
+    # URL of a ``SuggestionView`` the search form's term inputs ask for typeahead suggestions
+    suggestion_url = None
+
+    # Admission control: the in-flight search slots allowed per user and overall (None for no
+    # limit), and the estimated cost covered by each slot a search takes
+    max_user_search_slots = None
+    max_search_slots = None
+    search_slot_cost = 4
+    admission_cache_alias = "default"
+    admission_timeout = 300
+    busy_message = "The search queue is busy, please try again in a moment."
 
     # Callbacks, unprovided by default
     get_display_fields = None
     build_queryset = None
     process_results = None
 
+    def get(self, request, *args, **kwargs):
+        """
+        When ``stream_results`` is set and the request describes a valid search, responds with a
+        ``StreamingHttpResponse`` of the results list template instead of the full page.
+
+        """
+
+        try:
+            if self.get_stream_results():
+                searcher = self.get_page_searcher()
+                if searcher.ready:
+                    admission = self.get_admission(searcher).acquire()
+                    return StreamingHttpResponse(admission.wrap(searcher.stream_results_list()))
+            return super(SearchMixin, self).get(request, *args, **kwargs)
+        except SearchBusy:
+            return self.render_busy()
+
+    def post(self, request, *args, **kwargs):
+        """Runs searches posted as multipart forms, e.g., with an "is one of" values file."""
+        return self.get(request, *args, **kwargs)
+
     def get_context_data(self, **kwargs):
         context = super(SearchMixin, self).get_context_data(**kwargs)
 
         object_name = self.get_context_object_name()
-        searcher = self.get_searcher()
+        searcher = self.get_page_searcher()
 
         if searcher.ready:
-            searcher._perform_search()
+            with self.get_admission(searcher):
+                searcher._perform_search()
 
         context[object_name] = searcher
         return context
 
+    def get_search_slots(self, searcher):
+        """
+        Returns the number of in-flight slots the ready ``searcher`` takes: one, plus one for each
+        further ``search_slot_cost`` of its estimated cost.
+
+        """
+
+        cost = estimate_cost(searcher.model_config, searcher.constraints)
+        return 1 + (cost - 1) // self.search_slot_cost
+
+    def get_admission(self, searcher):
+        """
+        Returns the ``appsearch.admission.Admission`` holding the ready ``searcher``'s slots of
+        the per-user and global limits.  Acquiring it raises ``SearchBusy`` when either limit is
+        reached.
+
+        """
+
+        if self.request.user.is_authenticated:
+            user_key = self.request.user.pk
+        else:
+            user_key = self.request.META.get("REMOTE_ADDR")
+
+        semaphores = []
+        for key, limit in (
+            ("appsearch.admission.user.{}".format(user_key), self.max_user_search_slots),
+            ("appsearch.admission.all", self.max_search_slots),
+        ):
+            if limit is not None:
+                semaphores.append(
+                    CacheSemaphore(key, limit, self.admission_timeout, self.admission_cache_alias)
+                )
+        slots = self.get_search_slots(searcher) if semaphores else 0
+        return Admission(semaphores, slots)
+
+    def render_busy(self):
+        """Returns the response for a search refused by admission control."""
+        response = HttpResponse(self.busy_message, status=503, content_type="text/plain")
+        response["Retry-After"] = "5"
+        return response
+
     def get_searcher_class(self):
         """Returns the view's ``searcher_class`` attribute."""
         return self.searcher_class
 
-    def get_searcher(self):
-        """Builds and returns a ``Searcher`` instance for this search context."""
-        return self.get_searcher_class()(self.request, **self.get_searcher_kwargs())
+    def get_searcher(self, **kwargs):
+        """
+        Builds and returns a ``Searcher`` instance for this search context.  Any ``kwargs`` are
+        sent to the constructor along with ``get_searcher_kwargs()``.
+
+        """
+        kwargs = dict(self.get_searcher_kwargs(), **kwargs)
+        return self.get_searcher_class()(self.request, **kwargs)
+
+    def get_page_searcher(self):
+        """
+        Returns ``get_searcher()`` for the search page.  A saved search that no longer validates,
+        e.g., because its field was removed from ``search_fields`` or its owner lost permission,
+        opens as a blank search whose constraint formset reports why.
+
+        """
+
+        try:
+            return self.get_searcher()
+        except SearchSpecError as e:
+            message = "The saved search can't be opened: {}".format(e)
+            searcher = self.get_searcher(saved_search=None)
+            searcher.constraint_formset.spec_error = message
+            return searcher
+
+    def get_saved_search(self):
+        """
+        Returns the requesting user's ``SavedSearch`` named by the ``saved_search`` querystring
+        parameter, or ``None``.
+
+        """
+
+        from appsearch.models import SavedSearch
+
+        saved_search_id = self.request.GET.get("saved_search")
+        if not saved_search_id or not self.request.user.is_authenticated:
+            return None
+        try:
+            return SavedSearch.objects.get(owner=self.request.user, pk=int(saved_search_id))
+        except (ValueError, SavedSearch.DoesNotExist):
+            return None
 
     def get_searcher_kwargs(self):
         """Returns the dictionary of kwargs sent to the ``Searcher`` constructor."""
 
         return {
+            "saved_search": self.get_saved_search(),
             "form_template_name": self.get_form_template_name(),
             "search_form_template_name": self.get_search_form_template_name(),
             "results_list_template_name": self.get_results_list_template_name(),
+            "results_rows_template_name": self.get_results_rows_template_name(),
             "context_object_name": self.get_context_object_name(),
+            "compiled_rows": self.compiled_rows,
+            "database": self.get_database(),
+            "suggestion_url": self.suggestion_url,
             # Callbacks
             "display_fields_callback": self.get_display_fields,
             "build_queryset_callback": self.build_queryset,
@@ -64,6 +223,239 @@ class SearchMixin(object):
     def get_results_list_template_name(self):
         return self.results_list_template_name
 
+    def get_results_rows_template_name(self):
+        return self.results_rows_template_name
+
+    def get_stream_results(self):
+        return self.stream_results
+
+    def get_database(self):
+        return self.database
+
 
 class BaseSearchView(SearchMixin, TemplateView):
     pass
+
+
+@method_decorator(csrf_exempt, name="dispatch")
+class SearchAPIView(SearchMixin, View):
+    """
+    JSON search endpoint that skips the forms and templates.
+
+    The search spec is a JSON object, sent either as the request body of a POST or as the ``spec``
+    querystring parameter of a GET::
+
+        {
+            "model": <content type id>,
+            "constraints": [["and", "<field hash>", "contains", "term"], ...],
+            "limit": 50,
+            "sort": "<sortable display field, optionally prefixed with '-'>",
+            "cursor": "<value of 'next' from the previous page>",
+            "since": "<value of 'watermark' from a previous search>"
+        }
+
+    The response holds the display ``columns`` once and each of the ``rows`` as a plain list, which
+    keeps the payload compact and repetitive enough to gzip well.  ``next`` is an opaque cursor for
+    the following page, or ``null`` on the last page, and ``count`` is only sent for the first page.
+    Given a ``since`` watermark, the search is incremental and the first page also holds the
+    ``watermark`` to send as ``since`` next time.
+
+    Searches only read data, and a GET already runs them without a token, so POSTs are exempt from
+    CSRF checks for callers without a session.  Authenticating such callers, e.g., with a token
+    middleware setting ``request.user``, is left to the project.
+
+    """
+
+    page_size = 50
+    max_page_size = 500
+    cursor_salt = "appsearch.views.SearchAPIView"
+
+    def get(self, request, *args, **kwargs):
+        try:
+            spec = json.loads(request.GET.get("spec", ""))
+        except ValueError:
+            return self.render_error("Invalid JSON in 'spec'.")
+        return self.render_search(spec)
+
+    def post(self, request, *args, **kwargs):
+        try:
+            spec = json.loads(request.body)
+        except ValueError:
+            return self.render_error("Invalid JSON body.")
+        return self.render_search(spec)
+
+    def render_error(self, message, status=400):
+        return JsonResponse({"errors": [message]}, status=status)
+
+    def get_searcher_kwargs(self):
+        """
+        Returns the ``SearchMixin`` kwargs without the search page's ``saved_search`` and with an
+        empty querydict, so that the spec alone describes the search.
+
+        """
+
+        kwargs = super(SearchAPIView, self).get_searcher_kwargs()
+        kwargs.update(saved_search=None, querydict=QueryDict())
+        return kwargs
+
+    def get_spec_value(self, spec, name, types, description):
+        """Returns the spec's ``name`` item, raising ``SearchSpecError`` if it isn't of ``types``."""
+        value = spec.get(name)
+        if value is not None and not isinstance(value, types):
+            raise SearchSpecError("{!r} must be {}.".format(name, description))
+        return value
+
+    def get_page_size(self, spec):
+        """Returns the requested ``limit``, clamped to ``max_page_size``."""
+        try:
+            limit = int(spec.get("limit", self.page_size))
+        except (TypeError, ValueError):
+            raise SearchSpecError("'limit' must be an integer.")
+        return max(1, min(limit, self.max_page_size))
+
+    def get_model(self, spec):
+        """Returns the model class for the spec's content type id."""
+        try:
+            model = ContentType.objects.get_for_id(int(spec["model"])).model_class()
+        except (KeyError, TypeError, ValueError, ContentType.DoesNotExist):
+            model = None
+        if model is None:
+            raise SearchSpecError("Invalid model.")
+        return model
+
+    def encode_cursor(self, obj, sort_path=None):
+        cursor = {"pk": obj.pk}
+        if sort_path:
+            cursor["value"] = get_path_value(obj, sort_path)
+        return signing.dumps(
+            cursor, salt=self.cursor_salt, serializer=CursorSerializer, compress=True
+        )
+
+    def decode_cursor(self, cursor):
+        try:
+            return signing.loads(cursor, salt=self.cursor_salt, serializer=CursorSerializer)
+        except signing.BadSignature:
+            raise SearchSpecError("Invalid cursor.")
+
+    def get_cursor_query(self, cursor, sort_path=None, descending=False):
+        """
+        Returns the ``Q`` selecting the rows after ``cursor`` in the (sort value, pk) ordering,
+        with null sort values ordered last.
+
+        """
+
+        if not sort_path:
+            return Q(pk__gt=cursor["pk"])
+
+        value = cursor.get("value")
+        null_query = Q(**{sort_path + "__isnull": True})
+        if value is None:
+            return null_query & Q(pk__gt=cursor["pk"])
+        beyond = sort_path + ("__lt" if descending else "__gt")
+        return Q(**{beyond: value}) | Q(**{sort_path: value, "pk__gt": cursor["pk"]}) | null_query
+
+    def paginate_queryset(self, queryset, spec, searcher):
+        """
+        Returns the objects on the page selected by the spec's ``cursor`` and the cursor of the
+        next page.  Pages are walked by the searcher's sort field and the primary key instead of an
+        offset, so that each page is read in index order with a ``LIMIT``.
+
+        """
+
+        limit = self.get_page_size(spec)
+
+        sort_path, descending = None, False
+        if searcher.sort:
+            sort_path, descending, _ = searcher.model_config.get_sort_field(searcher.sort)
+        else:
+            queryset = queryset.order_by("pk")
+
+        if self.get_spec_value(spec, "cursor", str, "a string"):
+            cursor = self.decode_cursor(spec["cursor"])
+            queryset = queryset.filter(self.get_cursor_query(cursor, sort_path, descending))
+
+        objects = list(queryset[: limit + 1])
+        next_cursor = None
+        if len(objects) > limit:
+            objects = objects[:limit]
+            next_cursor = self.encode_cursor(objects[-1], sort_path)
+        return objects, next_cursor
+
+    def render_search(self, spec):
+        if not isinstance(spec, dict):
+            return self.render_error("The search spec must be an object.")
+
+        try:
+            model = self.get_model(spec)
+            kwargs = {}
+            if "since" in spec:
+                kwargs["since"] = spec["since"]
+            searcher = self.get_searcher(
+                model=model,
+                constraints=self.get_spec_value(spec, "constraints", list, "a list") or [],
+                sort=self.get_spec_value(spec, "sort", str, "a string"),
+                **kwargs,
+            )
+            if searcher.sort and searcher.sort.lstrip("-") not in (
+                searcher.model_config.get_sortable_fields()
+            ):
+                raise SearchSpecError("Invalid sort {!r}.".format(searcher.sort))
+            with self.get_admission(searcher):
+                queryset = searcher.build_queryset(searcher.model, searcher.get_query())
+                objects, next_cursor = self.paginate_queryset(queryset, spec, searcher)
+
+                data = {
+                    "columns": searcher._get_display_fields(searcher.model, searcher.model_config),
+                    "rows": searcher.process_results(objects),
+                    "next": next_cursor,
+                }
+                if not spec.get("cursor"):
+                    data["count"] = queryset.count()
+                    if searcher.incremental:
+                        data["watermark"] = searcher.model_config.get_watermark(
+                            queryset, default=searcher.since
+                        )
+        except SearchSpecError as e:
+            return self.render_error(str(e))
+        except SearchBusy:
+            return self.render_error(self.busy_message, status=503)
+        return JsonResponse(
+            data, encoder=PreciseJSONEncoder, json_dumps_params={"separators": (",", ":")}
+        )
+
+
+class SuggestionView(View):
+    """
+    JSON typeahead endpoint returning existing values of a search field that start with a prefix,
+    so that users can pick a term that matches something before running the search.
+
+    Expects the ``model`` content type id, the ``field`` hash and the ``term`` prefix as
+    querystring parameters, and responds with ``{"suggestions": [...]}``.
+
+    """
+
+    registry = search
+
+    # Shortest prefix looked up, since shorter ones match too much to be useful
+    min_term_length = 1
+
+    def get(self, request, *args, **kwargs):
+        try:
+            model = ContentType.objects.get_for_id(int(request.GET["model"])).model_class()
+        except (KeyError, TypeError, ValueError, ContentType.DoesNotExist):
+            model = None
+        configuration = None
+        if model is not None:
+            configuration = self.registry.get_configuration(model, user=request.user)
+        if configuration is None:
+            return JsonResponse({"errors": ["Invalid model."]}, status=400)
+
+        field = configuration._field_hashes.get(request.GET.get("field"))
+        if field is None:
+            return JsonResponse({"errors": ["Invalid field."]}, status=400)
+
+        term = request.GET.get("term", "")
+        suggestions = []
+        if len(term.strip()) >= self.min_term_length:
+            suggestions = configuration.get_suggestions(field, term, request, request.user)
+        return JsonResponse({"suggestions": suggestions})
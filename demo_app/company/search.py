@@ -23,6 +23,8 @@ class CompanySearch(ModelSearch):
 
     search_fields = ("name", "company_type")
 
+    facet_fields = ("company_type",)
+
     def user_has_perm(self, user):
         return True
 
@@ -18,11 +18,11 @@ from django.conf import settings
 from django.conf.urls.static import static
 from django.contrib import admin
 from django.contrib.auth.views import LoginView, LogoutView
-from django.urls import path
+from django.urls import path, reverse_lazy
 from django.views.generic import TemplateView
 
 import appsearch
-from appsearch.views import BaseSearchView
+from appsearch.views import BaseSearchView, SearchAPIView, SuggestionView
 
 
 appsearch.autodiscover()
@@ -32,7 +32,15 @@ urlpatterns = [
     path("admin/", admin.site.urls),
     path("accounts/login/", LoginView.as_view(), name="login"),
     path("accounts/logout/", LogoutView.as_view(), name="logout"),
-    path("search/", BaseSearchView.as_view(template_name="appsearch/search.html"), name="search"),
+    path(
+        "search/",
+        BaseSearchView.as_view(
+            template_name="appsearch/search.html", suggestion_url=reverse_lazy("search-suggestions")
+        ),
+        name="search",
+    ),
+    path("search/api/", SearchAPIView.as_view(), name="search-api"),
+    path("search/suggestions/", SuggestionView.as_view(), name="search-suggestions"),
 ]
 
 if settings.DEBUG:
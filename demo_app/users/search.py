@@ -43,5 +43,8 @@ class UserSearch(ModelSearch):
         ("Is Active", "is_active"),
     )
 
+    facet_fields = ("company__company_type", "is_active")
+    watermark_field = "last_update"
+
 
 search.register(User, UserSearch)